@@ -0,0 +1,328 @@
+#Real-time output stage for the ROUV_Pi, in its own process
+#Normally the PWM writes run on an executor thread of the network process, so GC pauses, log writes and socket work
+#there show up as jitter in thruster updates. With actuator_process on (rouv_pi_continuous.py), ActuatorState writes
+#to a RingOutput instead: every commit becomes one fixed-size duty frame in a shared-memory ring (DutyRing). A
+#separate process, pinned to a spare core and SCHED_FIFO if allowed, takes the frames and owns the PWM writes, the
+#current budget and the slew ramps (OutputStage). Publishing is a few writes into shared memory, so the network side
+#never waits on pigpio.
+#The ring has one producer and one consumer and no locks. Each frame carries its sequence number at both ends and
+#the published count is bumped only after the whole frame is written, so the consumer can tell a frame that was
+#overwritten under it (it fell a whole ring behind) and skip to the newest state instead.
+#python3 bench_actuator.py compares update timing with the stage in the network process and in its own.
+import gc
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+import hal
+from actuators import ActuatorState
+from latency import Histogram
+from output_filter import OutputFilter, STOP
+
+CHANNELS = 7                                    #Five thrusters and two lights, in the ROUV's channel order
+ALL_CHANNELS = (1 << CHANNELS) - 1
+NO_DUTY = 0xFFFF                                #Channel not written yet
+COUNT = struct.Struct("<Q")                     #Published count, stop request, and the sequence number at each end of a frame
+STATUS = struct.Struct("<6Q7H2x8d")             #Written by the actuator process only: frames taken, frames skipped, hardware
+                                                #updates, read-back mismatches, ticks, last tick (us), duties taken, amps,
+                                                #budget scale, Ah, budget limited seconds, tick lateness p50/p99/max (us),
+                                                #longest time between ticks (us)
+BODY = struct.Struct("<Q7HBx")                  #Publish time (us), duties, channels written
+STOP_OFFSET = COUNT.size
+STATUS_OFFSET = 64                              #Own cache lines, apart from what the network process writes
+SLOTS_OFFSET = STATUS_OFFSET + 192              #Status with its sequence number at both ends, like a slot
+SLOT_SIZE = COUNT.size + BODY.size + COUNT.size
+STATUS_EVERY = 10                               #Ticks between status updates, lateness percentiles are only sorted then
+STATUS_TRIES = 8                                #Reads of a status block being written before the last whole one is used instead
+
+
+def now_us():
+    return time.monotonic_ns() // 1000
+
+
+class DutyRing:
+
+    def __init__(self, name=None, slots=64):
+        self.slots = slots
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=SLOTS_OFFSET + slots * SLOT_SIZE)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.owner = name is None               #The creator unlinks it
+        self.name = self.memory.name
+        self.buf = self.memory.buf
+        self.written = 0                        #Producer's own count of frames published
+        self.status_written = 0                 #Consumer's own count of status updates
+        self.last_status = STATUS.unpack(bytes(STATUS.size))   #Last whole status block read
+
+    def publish(self, duties, mask):            #Producer: duties for every channel (None: not written yet), mask: channels written
+        seq = self.written + 1
+        offset = SLOTS_OFFSET + (seq % self.slots) * SLOT_SIZE
+        COUNT.pack_into(self.buf, offset, seq)
+        BODY.pack_into(self.buf, offset + COUNT.size, now_us(), *[NO_DUTY if duty is None else duty for duty in duties], mask)
+        COUNT.pack_into(self.buf, offset + COUNT.size + BODY.size, seq)
+        COUNT.pack_into(self.buf, 0, seq)       #Only now can the consumer see it
+        self.written = seq
+
+    def published(self):
+        return COUNT.unpack_from(self.buf, 0)[0]
+
+    def read(self, seq):                        #Consumer: (publish time, duties..., mask) of frame seq, None if overwritten
+        offset = SLOTS_OFFSET + (seq % self.slots) * SLOT_SIZE
+        fields = BODY.unpack_from(self.buf, offset + COUNT.size)
+        if COUNT.unpack_from(self.buf, offset)[0] != seq or COUNT.unpack_from(self.buf, offset + COUNT.size + BODY.size)[0] != seq:
+            return None
+        return fields
+
+    def request_stop(self):
+        COUNT.pack_into(self.buf, STOP_OFFSET, 1)
+
+    def stop_requested(self):
+        return COUNT.unpack_from(self.buf, STOP_OFFSET)[0] != 0
+
+    def write_status(self, *fields):            #Consumer: sequence number at the front, then the fields, then at the back
+        seq = self.status_written + 1
+        COUNT.pack_into(self.buf, STATUS_OFFSET, seq)
+        STATUS.pack_into(self.buf, STATUS_OFFSET + COUNT.size, *fields)
+        COUNT.pack_into(self.buf, STATUS_OFFSET + COUNT.size + STATUS.size, seq)
+        self.status_written = seq
+
+    def status(self):                           #Read back to front: both ends equal means no update overlapped the fields
+        for i in range(STATUS_TRIES):           #A stage killed mid-update leaves the ends apart for good
+            seq = COUNT.unpack_from(self.buf, STATUS_OFFSET + COUNT.size + STATUS.size)[0]
+            fields = STATUS.unpack_from(self.buf, STATUS_OFFSET + COUNT.size)
+            if COUNT.unpack_from(self.buf, STATUS_OFFSET)[0] == seq:
+                self.last_status = fields
+                return fields
+        return self.last_status
+
+    def close(self):
+        self.buf = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+#-----------NETWORK PROCESS SIDE-----------
+class RingOutput:                               #Backend for the network process's ActuatorState: commits go into the ring
+
+    def __init__(self, ring, pins):
+        self.ring = ring
+        self.index = {pin: i for i, pin in enumerate(pins)}
+        self.duties = [None] * CHANNELS
+        self.mask = 0
+        self.publish_time = Histogram()         #us to publish a frame, what a commit costs the network process
+
+    def set_PWM_dutycycle(self, pin, duty):
+        i = self.index[pin]
+        self.duties[i] = duty
+        self.mask |= 1 << i
+
+    def flush(self):                            #ActuatorState calls this once per commit that wrote anything
+        start = time.perf_counter()
+        self.ring.publish(self.duties, self.mask)
+        self.publish_time.add((time.perf_counter() - start) * 1e6)
+        self.mask = 0
+
+    def get_PWM_dutycycle(self, pin):           #Duty the actuator process last took for the channel
+        duty = self.ring.status()[6 + self.index[pin]]
+        return None if duty == NO_DUTY else duty
+
+
+class StageStatus:                              #The actuator process's output filter as the network process sees it
+    ramping = False                             #The stage carries on its own ramps
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.started = time.monotonic()
+
+    @property
+    def amps(self):
+        return self.ring.status()[13]
+
+    @property
+    def scale(self):
+        return self.ring.status()[14]
+
+    @property
+    def amp_hours(self):
+        return self.ring.status()[15]
+
+    def limited_fraction(self):
+        status = self.ring.status()
+        elapsed = time.monotonic() - self.started
+        return status[16] / elapsed if elapsed > 0 else 0.0
+
+    def samples(self):                          #For Metrics.collector()
+        status = self.ring.status()
+        yield "rouv_actuator_frames", {"result": "taken"}, status[0]
+        yield "rouv_actuator_frames", {"result": "skipped"}, status[1]
+        yield "rouv_actuator_updates", {}, status[2]
+        yield "rouv_actuator_tick_age_seconds", {}, (now_us() - status[5]) / 1e6 if status[5] else None
+        for name, value in (("0.5", status[17]), ("0.99", status[18]), ("1", status[19])):
+            yield "rouv_actuator_late_us", {"quantile": name}, value
+        yield "rouv_actuator_longest_interval_us", {}, status[20]
+
+
+class ActuatorProcess:                          #Starts the output stage and stops it again
+
+    def __init__(self, backend, pins, thrusters, budget_amps=40.0, slew_rate=2000.0, rate=100, cpu=None,
+                 priority=None, verify_period=5.0, pipelined=True, slots=64):
+        self.ring = DutyRing(slots=slots)
+        self.output = RingOutput(self.ring, pins)
+        self.status = StageStatus(self.ring)
+        context = multiprocessing.get_context("spawn")      #A fresh interpreter: none of the network process's threads or sockets
+        self.process = context.Process(target=stage_main, name="actuators", daemon=True,
+                                       args=(self.ring.name, slots, backend, pipelined, tuple(pins), tuple(thrusters),
+                                             budget_amps, slew_rate, rate, cpu, priority, verify_period))
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def drain(self, timeout=0.1):               #Wait until the stage has taken every frame published. True if it has.
+        deadline = time.monotonic() + timeout
+        while self.ring.status()[0] < self.ring.written:
+            if time.monotonic() > deadline or not self.alive():
+                return False
+            time.sleep(0.0005)
+        return True
+
+    def stop(self, timeout=1.0):                #The stage writes whatever is still in the ring first
+        self.ring.request_stop()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.ring.close()
+
+
+#-----------ACTUATOR PROCESS SIDE-----------
+class OutputStage:
+
+    def __init__(self, ring, pi, pins, output_filter=None, rate=100, verify_period=5.0, stop_duties=None, poll=0.0005):
+        self.ring = ring
+        self.pins = tuple(pins)
+        self.actuators = ActuatorState(pi, pins, verify_period, output_filter)
+        self.output_filter = output_filter
+        self.rate = rate                        #Hz, commits while ramping, read-backs and status
+        self.poll = poll                        #Seconds between looks at the ring
+        self.stop_duties = stop_duties or {}    #Written if the network process dies
+        self.taken = 0                          #Sequence number of the last frame taken
+        self.skipped = 0                        #Frames overwritten before they were taken, only the newest state counts
+        self.updates = 0                        #Commits that wrote the hardware
+        self.ticks = 0
+        self.last_tick = 0
+        self.late = Histogram()                 #us each tick ran after it was due
+        self.longest_interval = 0.0             #us, longest time between two ticks
+        self.percentiles = [0.0, 0.0, 0.0]      #Lateness p50, p99, max as last published
+        self.targets = [NO_DUTY] * CHANNELS     #Duties taken from the ring, before the budget and ramps
+        self.parent = os.getppid()
+
+    def take(self):                             #Every frame published since the last call. True if there were any.
+        published = self.ring.published()
+        if published == self.taken:
+            return False
+        while self.taken < published:
+            seq = self.taken + 1
+            if published - self.taken > self.ring.slots:    #Fell a whole ring behind: only the newest state counts
+                seq = published
+            frame = self.ring.read(seq)
+            if frame is None:                   #Overwritten while being read, so now it is a whole ring behind
+                published = self.ring.published()
+                continue
+            mask = frame[-1] if seq == self.taken + 1 else ALL_CHANNELS     #Every channel of the newest frame after a skip
+            self.skipped += seq - self.taken - 1
+            self.taken = seq
+            for i, pin in enumerate(self.pins):
+                if mask & (1 << i) and frame[1 + i] != NO_DUTY:
+                    self.actuators.set(pin, frame[1 + i])
+                    self.targets[i] = frame[1 + i]
+        return True
+
+    def commit(self):                           #Frames' channels are written even if unchanged, as the network process asked
+        if self.actuators.commit(force=True):
+            self.updates += 1
+
+    def publish_status(self):
+        output_filter = self.output_filter
+        if self.ticks % STATUS_EVERY == 0:
+            self.percentiles = [self.late.percentile(0.5) or 0.0, self.late.percentile(0.99) or 0.0, float(self.late.max)]
+        self.ring.write_status(self.taken, self.skipped, self.updates, self.actuators.mismatches, self.ticks, self.last_tick,
+                               *self.targets, output_filter.amps if output_filter else 0.0, output_filter.scale if output_filter else 1.0,
+                               output_filter.amp_hours if output_filter else 0.0,
+                               output_filter.limited_seconds if output_filter else 0.0, *self.percentiles, self.longest_interval)
+
+    def run(self):                              #Until the network process asks it to stop, or dies
+        period = 1.0 / self.rate
+        deadline = time.monotonic() + period
+        last = None
+        while not self.ring.stop_requested():
+            if self.take():
+                self.commit()                   #New duties go out at once, not at the next tick
+                self.publish_status()
+            now = time.monotonic()
+            if now >= deadline:
+                self.late.add((now - deadline) * 1e6)
+                if last is not None:
+                    self.longest_interval = max(self.longest_interval, (now - last) * 1e6)
+                last = now
+                self.commit()                   #Ramps carry on between frames
+                self.actuators.verify()
+                self.ticks += 1
+                self.last_tick = now_us()
+                self.publish_status()
+                if os.getppid() != self.parent:
+                    self.actuators.set_frame(self.stop_duties)
+                    self.commit()
+                    print("Network process gone, thrusters stopped")
+                    return
+                deadline += period
+                if deadline < now:              #Overran: start again from now instead of bursting
+                    deadline = now + period
+            time.sleep(max(0.0, min(self.poll, deadline - time.monotonic())))
+        self.take()                             #Whatever was published last, e.g. the power cut on shutdown
+        self.commit()
+        self.publish_status()
+
+
+def realtime(cpu=None, priority=None):          #Pin this process to one core and/or make it SCHED_FIFO. Returns what took effect.
+    applied = []
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+            applied.append("cpu %d" % cpu)
+        except (OSError, AttributeError) as e:
+            print("Actuator process not pinned to cpu %d: %s" % (cpu, e))
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            applied.append("SCHED_FIFO %d" % priority)
+        except (OSError, AttributeError) as e:  #Needs root or CAP_SYS_NICE
+            print("Actuator process not SCHED_FIFO: %s" % e)
+    return applied
+
+def stage_main(ring_name, slots, backend, pipelined, pins, thrusters, budget_amps, slew_rate, rate, cpu, priority,
+               verify_period):              #Entry point of the actuator process
+    ring = DutyRing(ring_name, slots)
+    applied = realtime(cpu, priority)
+    pi = hal.open_backend(backend, pipelined)
+    for pin in pins:
+        pi.setup_output(pin, 100, 9999)         #Same settings the network process made, its own connection to the daemon
+    if pi.flush is not None:
+        pi.flush()
+    output_filter = OutputFilter(thrusters, budget_amps, slew_rate, 1.0 / rate)
+    stage = OutputStage(ring, pi, pins, output_filter, rate, verify_period, dict.fromkeys(thrusters, STOP))
+    print("Actuator process running: %s" % (", ".join(applied) or "normal scheduling"))
+    gc.collect()
+    gc.freeze()
+    gc.disable()                                #Nothing in the loop makes reference cycles, so there is nothing to collect
+    try:
+        stage.run()
+    finally:
+        pi.stop()
+        ring.close()
@@ -0,0 +1,72 @@
+#Cached output state for the ROUV_Pi's PWM channels (five thrusters, two lights)
+#Handlers set() target duties, and commit() sends only the channels whose duty actually changed, so
+#re-sending STOP to a stopped thruster costs nothing. Read-backs come from the cache instead of the daemon.
+#verify() compares the cache against the hardware, at most once every verify_period seconds.
+#An output filter (see output_filter.py) can be given to limit what is written on the way out.
+import time
+
+
+class ActuatorState:
+
+    def __init__(self, pi, pins, verify_period=5.0, output_filter=None):
+        self.pi = pi
+        self.flush = getattr(pi, "flush", None)         #PipelinedPi sends queued writes in one batch on flush()
+        self.pins = tuple(pins)
+        self.commanded = dict.fromkeys(self.pins)       #Duty last sent to the daemon, None until the first write
+        self.target = {}                                #Dirty channels: pin -> duty waiting for commit()
+        self.verify_period = verify_period
+        self.last_verify = None
+        self.writes = 0                                 #set_PWM_dutycycle calls made
+        self.writes_saved = 0                           #set_PWM_dutycycle calls skipped, channel already held the duty
+        self.reads_saved = 0                            #get_PWM_dutycycle calls answered from the cache
+        self.mismatches = 0                             #Channels verify() found out of step with the cache
+        self.output_filter = output_filter              #apply(target, commanded) -> duties to write now
+
+    def set(self, pin, duty):
+        self.target[pin] = duty
+
+    def set_frame(self, duties):                        #pin -> duty for several channels at once
+        self.target.update(duties)
+
+    def get(self, pin):                                 #Duty the channel will hold after the next commit()
+        self.reads_saved += 1
+        return self.target.get(pin, self.commanded[pin])
+
+    def commit(self, force=False):                      #force=True writes every target, even unchanged ones
+        target, self.target = self.target, {}
+        if self.output_filter is not None:
+            target = self.output_filter.apply(target, self.commanded)
+        written = []
+        for pin, duty in target.items():
+            if not force and self.commanded[pin] == duty:
+                self.writes_saved += 1
+                continue
+            self.pi.set_PWM_dutycycle(pin, duty)
+            self.commanded[pin] = duty
+            self.writes += 1
+            written.append(pin)
+        if written and self.flush is not None:
+            self.flush()
+        return written
+
+    def verify(self, force=False):                      #Read the hardware back, rate limited. Returns mismatched pins.
+        now = time.monotonic()
+        if not force and self.last_verify is not None and now - self.last_verify < self.verify_period:
+            return []
+        self.last_verify = now
+        mismatched = []
+        for pin in self.pins:
+            if self.commanded[pin] is None:
+                continue
+            try:
+                actual = self.pi.get_PWM_dutycycle(pin)
+            except Exception:                           #pigpio raises if the channel isn't running PWM
+                actual = None
+            if actual != self.commanded[pin]:
+                mismatched.append(pin)
+                self.commanded[pin] = actual            #Next commit() will rewrite it
+        self.mismatches += len(mismatched)
+        return mismatched
+
+    def calls_saved(self):                              #Daemon round trips saved this session
+        return self.writes_saved + self.reads_saved
@@ -0,0 +1,154 @@
+#Closed-loop depth, heading and pitch hold for the ROUV_Pi
+#A fixed-rate loop on its own thread reads the motion sensors (depth, heading, pitch and the gyro rates), runs one
+#PID per axis and hands the resulting motion vector to apply() (see mixer.py for what the numbers mean). Engaging
+#holds whatever depth/heading/pitch the ROUV is at right then. The pilot can still drive forward and back (surge).
+#Loop timing is measured every tick: how late each tick woke up (jitter), how long it took, and overruns (ticks
+#that finished after the next one was due).
+import threading
+import time
+from latency import Histogram
+
+#(kp, ki, kd) per axis. Errors are metres and degrees, output is -1~1 of full thrust. Tuned on the simulated
+#vehicle (python3 bench_hold.py), re-tune at the pool.
+DEPTH_GAINS = (4.8, 1.0, 0.75)
+HEADING_GAINS = (0.08, 0.002, 0.024)
+PITCH_GAINS = (0.2, 0.08, 0.064)
+DEPTH_RATE_SMOOTHING = 0.1                      #Weight of the newest sample in the filtered depth rate, depth has no gyro
+
+
+def wrap_degrees(angle):                        #-180 ~ 180
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+class PID:
+
+    def __init__(self, kp, ki, kd, limit=1.0, bias=0.0):
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.limit = limit                      #Output and integral are clamped to +/- limit
+        self.bias = bias                        #Integral starts here, e.g. the thrust that holds the ROUV up
+        self.integral = bias
+        self.output = 0.0
+
+    def reset(self):
+        self.integral = self.bias
+        self.output = 0.0
+
+    def update(self, error, error_rate, dt):   #error_rate: d(error)/dt, from the gyro where there is one
+        saturated = abs(self.output) >= self.limit and (error > 0) == (self.output > 0)
+        if not saturated:                       #Don't wind up while the thrusters are already flat out
+            self.integral = max(-self.limit, min(self.limit, self.integral + self.ki * error * dt))
+        self.output = max(-self.limit, min(self.limit, self.kp * error + self.integral + self.kd * error_rate))
+        return self.output
+
+
+class Autopilot:
+
+    def __init__(self, sensors, apply, rate=100, hover_heave=0.0):
+        self.sensors = sensors                  #read() -> (depth m, heading deg, pitch deg, yaw rate deg/s, pitch rate deg/s)
+        self.apply = apply                      #apply(motion), motion is [surge, heave, yaw, pitch, roll]
+        self.rate = rate                        #Hz
+        self.depth_pid = PID(*DEPTH_GAINS, bias=hover_heave)
+        self.heading_pid = PID(*HEADING_GAINS)
+        self.pitch_pid = PID(*PITCH_GAINS)
+        self.lock = threading.Lock()
+        self.engaged = False
+        self.target = None                      #(depth, heading, pitch) being held
+        self.surge = 0.0                        #Pilot's forward/back while holding, -1~1
+        self.reading = None                     #Last sensor reading
+        self.last_depth = None
+        self.depth_rate = 0.0                   #m/s, + going deeper
+        self.jitter = Histogram()               #us each tick woke up after it was due
+        self.tick_time = Histogram()            #us each tick took
+        self.ticks = 0
+        self.overruns = 0
+        self.running = False
+        self.thread = None
+
+    def engage(self, target=None):             #Hold the current depth/heading/pitch, or the given (depth, heading, pitch)
+        with self.lock:
+            reading = self.reading if self.reading is not None else self.sensors.read()
+            self.target = target if target is not None else reading[:3]
+            for pid in (self.depth_pid, self.heading_pid, self.pitch_pid):
+                pid.reset()
+            self.surge = 0.0
+            self.engaged = True
+
+    def disengage(self):
+        with self.lock:
+            self.engaged = False
+            self.surge = 0.0
+
+    def tick(self, dt):                         #One sensor read and, if engaged, one correction
+        reading = self.sensors.read()
+        depth, heading, pitch, yaw_rate, pitch_rate = reading
+        if self.last_depth is not None and dt > 0:
+            self.depth_rate += DEPTH_RATE_SMOOTHING * ((depth - self.last_depth) / dt - self.depth_rate)
+        self.last_depth = depth
+        with self.lock:
+            self.reading = reading
+            if not self.engaged:
+                return None
+            target_depth, target_heading, target_pitch = self.target
+            heave = self.depth_pid.update(depth - target_depth, self.depth_rate, dt)    #Too deep: go up
+            yaw = self.heading_pid.update(wrap_degrees(target_heading - heading), -yaw_rate, dt)
+            pitch = self.pitch_pid.update(target_pitch - pitch, -pitch_rate, dt)
+            motion = [self.surge, heave, yaw, pitch, 0.0]
+        self.apply(motion)
+        return motion
+
+    def run(self):                              #Deadlines are absolute, so a late tick doesn't push the rest back
+        period = 1.0 / self.rate
+        deadline = time.monotonic()
+        last = deadline
+        while self.running:
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            woke = time.monotonic()
+            self.jitter.add((woke - deadline) * 1e6)
+            self.tick(woke - last)
+            last = woke
+            done = time.monotonic()
+            self.tick_time.add((done - woke) * 1e6)
+            self.ticks += 1
+            if done > deadline + period:        #Next tick is already late: count it and start again from now
+                self.overruns += 1
+                deadline = done
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="autopilot", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def errors(self):                           #(depth m, heading deg, pitch deg) from the target, None if not holding
+        with self.lock:
+            if not self.engaged or self.reading is None:
+                return None
+            return (self.reading[0] - self.target[0], wrap_degrees(self.reading[1] - self.target[1]),
+                    self.reading[2] - self.target[2])
+
+    def samples(self):                          #For Metrics.collector()
+        yield "rouv_hold_ticks", {}, self.ticks
+        yield "rouv_hold_overruns", {}, self.overruns
+        for name, histogram in (("jitter", self.jitter), ("tick", self.tick_time)):
+            for quantile in (0.5, 0.99):
+                yield "rouv_hold_loop_us", {"measure": name, "quantile": str(quantile)}, histogram.percentile(quantile)
+            yield "rouv_hold_loop_us", {"measure": name, "quantile": "1"}, histogram.max if histogram.count else None
+        errors = self.errors()
+        if errors is not None:
+            for axis, error in zip(("depth", "heading", "pitch"), errors):
+                yield "rouv_hold_error", {"axis": axis}, error
+
+    def report(self):
+        if not self.ticks:
+            return "Hold loop never ran"
+        return ("Hold loop at %gHz: %d ticks, %d overruns, jitter p50 %.0fus p99 %.0fus max %.0fus, tick p99 %.0fus max %.0fus" %
+                (self.rate, self.ticks, self.overruns, self.jitter.percentile(0.5), self.jitter.percentile(0.99),
+                 self.jitter.max, self.tick_time.percentile(0.99), self.tick_time.max))
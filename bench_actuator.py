@@ -0,0 +1,111 @@
+#Benchmark: thruster update timing with the output stage in the network process and in its own (actuator_process.py)
+#Both runs feed the same OutputStage through the same DutyRing on the sim backend, with a sweep on every thruster,
+#while the publishing process is kept as busy as the ROUV's network process gets: a thread allocating objects with
+#reference cycles (GC pauses), a thread writing log lines, and frames being built and parsed between publishes.
+#single: the stage runs on a thread of that busy process, as the output executor does now.
+#split:  the stage runs in its own process, pinned to a core and SCHED_FIFO where allowed (root on the Pi).
+#Reports how late each output tick ran, the longest gap between ticks, and what a publish costs the busy process.
+#Usage: python3 bench_actuator.py [seconds] [cpu]
+import json
+import os
+import sys
+import threading
+import time
+import actuator_process
+import hal
+import protocol
+import rouv_pi_continuous as rouv
+from output_filter import OutputFilter
+
+PINS = tuple(rouv.channel_names)
+SWEEP_RATE = 50                                 #Hz, new duties published (the BUOY's snapshot rate)
+PRIORITY = 50                                   #Same as the ROUV's actuator_priority
+
+
+def churn(running):                             #Cyclic garbage, so the collector keeps stopping the world
+    while running:
+        nodes = [{"seq": i} for i in range(5000)]
+        for a, b in zip(nodes, nodes[1:] + nodes[:1]):
+            a["next"], b["prev"] = b, a
+        del nodes
+
+def logger(running):                            #Log lines, as BufferedLog writes them
+    with open(os.devnull, "w") as out:
+        while running:
+            for i in range(100):
+                out.write(json.dumps({"ts": time.time(), "cat": "frame", "msg": "L3_UP", "seq": i}) + "\n")
+            out.flush()
+            time.sleep(0.001)
+
+def publish(ring, seconds):                     #Sweep every thruster, build and parse frames in between
+    output = actuator_process.RingOutput(ring, PINS)
+    period = 1.0 / SWEEP_RATE
+    deadline = time.monotonic()
+    end = deadline + seconds
+    i = 0
+    while time.monotonic() < end:
+        for pin in rouv.thrusters:
+            output.set_PWM_dutycycle(pin, 1500 + (i * 7 + pin) % 300)
+        output.flush()
+        i += 1
+        deadline += period
+        while time.monotonic() < deadline:      #Socket and decode work, holding the GIL
+            protocol.decode_frame(protocol.encode_frame(protocol.OP_SNAPSHOT, payload=protocol.encode_snapshot((i,) * 6))[2:])
+    return output
+
+def loaded(ring, seconds):                      #Runs the publisher with the background load, returns the RingOutput
+    running = [True]
+    threads = [threading.Thread(target=churn, args=(running,), daemon=True),
+               threading.Thread(target=logger, args=(running,), daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        return publish(ring, seconds)
+    finally:
+        running.clear()
+        for thread in threads:
+            thread.join()
+
+def single(seconds):
+    ring = actuator_process.DutyRing()
+    backend = hal.SimBackend()
+    for pin in PINS:
+        backend.setup_output(pin, 100, 9999)
+    stage = actuator_process.OutputStage(ring, backend, PINS, OutputFilter(rouv.thrusters, rouv.current_budget, rouv.slew_rate,
+                                         1.0 / rouv.ramp_rate), rouv.ramp_rate)
+    thread = threading.Thread(target=stage.run, name="pigpio-out", daemon=True)
+    thread.start()
+    output = loaded(ring, seconds)
+    ring.request_stop()
+    thread.join()
+    result = (stage.taken, stage.ticks, stage.late.percentile(0.5), stage.late.percentile(0.99), stage.late.max,
+              stage.longest_interval, output)
+    ring.close()
+    return result
+
+def split(seconds, cpu):
+    stage = actuator_process.ActuatorProcess("sim", PINS, rouv.thrusters, rouv.current_budget, rouv.slew_rate,
+                                             rouv.ramp_rate, cpu, PRIORITY).start()
+    while not stage.ring.status()[4]:           #First tick: the process is up
+        time.sleep(0.01)
+    output = loaded(stage.ring, seconds)
+    stage.drain(1.0)
+    status = stage.ring.status()
+    stage.stop()
+    return status[0], status[4], status[17], status[18], status[19], status[20], output
+
+def report(name, result):
+    taken, ticks, p50, p99, worst, longest, output = result
+    print("%-7s %7d frames %6d ticks  late p50 %6.0fus p99 %6.0fus max %6.0fus  longest gap %6.1fms  publish p99 %5.1fus" %
+          (name, taken, ticks, p50, p99, worst, longest / 1000, output.publish_time.percentile(0.99)))
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    cpu = int(sys.argv[2]) if len(sys.argv) > 2 else max(os.sched_getaffinity(0))
+    print("Output ticks at %gHz, %gHz sweep, %gs each, busy publisher (GC churn, logging, frame work)" %
+          (rouv.ramp_rate, SWEEP_RATE, seconds))
+    report("single", single(seconds))
+    report("split", split(seconds, cpu))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#Benchmark: emergency stop latency while the ROUV is saturated with commands, with and without the priority lane
+#Uses bench_storm.py's setup: the ROUV's runtime on the sim backend over loopback, and a generator process sending
+#stick sweeps as fast as the socket takes them, so seconds of commands queue up ahead of anything new. Every so often
+#the generator presses PS the way the BUOY does: a datagram to the safety port (priority lane on), then the same
+#press down the stream. A stop counts as applied when its outputs have been written, whichever copy got there first.
+#The leak pin's edge callback is timed the same way, from the edge to the thrusters being cut.
+#Usage: python3 bench_estop.py [seconds] [stops per second] [results.json]
+#Without results.json the results are printed as JSON instead, so a run leaves nothing behind in the checkout.
+import json
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+import bench_storm
+import buoy_pi_continuous as buoy
+import protocol
+import rouv_pi_continuous as rouv
+from latency import Histogram
+
+MIX = "sweep"
+LEAKS = 20                                      #Leak edges timed, pin and thrusters are reset after each
+LEAK_BATCH = 2000                               #Frames being applied when the leak edge comes
+
+
+#-----------LOAD GENERATOR-----------
+def generate(address, safety_address, seconds, stop_rate, lane, sent, ready, stops):
+    commands = bench_storm.MIXES[MIX]
+    s = bench_storm.connect(address)
+    safety = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    running = [True]
+    threading.Thread(target=bench_storm.drain, args=(s, running), daemon=True).start()
+    ready.set()
+    count = 0
+    start = time.monotonic()
+    next_stop = start + 1.0 / stop_rate
+    try:
+        while time.monotonic() < start + seconds:
+            batch = [bench_storm.frame(*commands[(count + i) % len(commands)], "binary")
+                     for i in range(bench_storm.FLAT_OUT_BATCH)]
+            count += len(batch)
+            if time.monotonic() >= next_stop:   #PS press: MyController.on_playstation_button_press()
+                datagram = protocol.encode_frame(protocol.OP_PS_PRESS)
+                if lane:
+                    safety.sendto(datagram, safety_address)
+                stream = buoy.create_command(protocol.OP_PS_PRESS)
+                batch.append(stream)
+                count += 1
+                stops.put((protocol.HEADER.unpack_from(datagram, protocol.LENGTH.size)[5],
+                           protocol.HEADER.unpack_from(stream, protocol.LENGTH.size)[5]))
+                next_stop += 1.0 / stop_rate
+            s.sendall(b"".join(batch))
+            sent.value = count
+    finally:
+        running.clear()
+        time.sleep(bench_storm.DRAIN_TIMEOUT)
+        s.close()
+
+
+#-----------ROUV-----------
+class StopProbe(bench_storm.Probe):             #When each stop's outputs were written, by the BUOY timestamp it carried
+
+    def __init__(self):
+        bench_storm.Probe.__init__(self)
+        self.apply_stop = rouv.apply_stop
+        self.applied_at = {}                    #BUOY timestamp -> us
+
+    def reset(self):
+        bench_storm.Probe.reset(self)
+        self.applied_at = {}
+
+    def __call__(self, frames, received_at=None):   #Stream copies, applied in order (or dropped once the datagram got there)
+        bench_storm.Probe.__call__(self, frames, received_at)
+        applied_at = protocol.now_us()
+        for msg in frames:
+            if protocol.message_opcode(msg) == protocol.OP_PS_PRESS:
+                self.applied_at.setdefault(protocol.HEADER.unpack_from(msg)[5], applied_at)
+
+    def stop(self):                             #Stands in for rouv.apply_stop(): priority lane copies
+        request = rouv.stop_requested
+        self.apply_stop()
+        if request is not None and request[1] is not None:
+            self.applied_at.setdefault(request[1], protocol.now_us())
+
+def run(address, safety_address, probe, seconds, stop_rate, lane):
+    rouv.priority_lane = lane
+    context = multiprocessing.get_context("spawn")
+    sent = context.Value("Q", 0, lock=False)
+    ready = context.Event()
+    stops = context.Queue()
+    generator = context.Process(target=generate, args=(address, safety_address, seconds, stop_rate, lane, sent, ready,
+                                                       stops), daemon=True)
+    generator.start()
+    ready.wait()
+    probe.reset()
+    time.sleep(seconds)
+    stopped = time.monotonic()
+    while (not sent.value or probe.applied < sent.value) and time.monotonic() < stopped + bench_storm.DRAIN_TIMEOUT:
+        time.sleep(0.001)
+    pressed = []
+    while not stops.empty():
+        pressed.append(stops.get())
+    generator.terminate()
+    generator.join()
+    while rouv.pilot_link is not None:
+        time.sleep(0.01)
+    latency = Histogram()
+    missed = 0
+    for datagram_at, stream_at in pressed:
+        applied = [probe.applied_at[at] for at in (datagram_at, stream_at) if at in probe.applied_at]
+        if applied:
+            latency.add(min(applied) - datagram_at)
+        else:
+            missed += 1
+    return {"priority_lane": lane, "seconds": seconds, "commands_per_second": round(sent.value / seconds),
+            "stops": len(pressed), "stops_missed": missed, **summary("stop_latency_us", latency)}
+
+def summary(name, histogram):                   #p50, p99 and max in whole us, None without samples
+    if not histogram.count:
+        return {name + "_p50": None, name + "_p99": None, name + "_max": None}
+    return {name + "_p50": round(histogram.percentile(0.5)), name + "_p99": round(histogram.percentile(0.99)),
+            name + "_max": round(histogram.max)}
+
+def leaks(sim, count):                          #Edge on the leak pin -> thrusters cut, while the output thread is busy
+    latency = Histogram()
+    commands = bench_storm.MIXES[MIX]
+    for i in range(count):
+        frames = [memoryview(buoy.create_command(*commands[n % len(commands)]))[protocol.LENGTH.size:]
+                  for n in range(LEAK_BATCH)]
+        rouv.leak_detected = False
+        for thruster in rouv.thrusters:
+            rouv.set_duty(thruster, 1700)
+        rouv.commit_outputs()
+        sim.set_input(rouv.leak_sensor, 0)
+        sim.take_trace()
+        busy = rouv.output_executor.submit(rouv.handle_frames, frames)
+        time.sleep(0.001)                       #Part way through the batch
+        edge = time.monotonic()
+        sim.set_input(rouv.leak_sensor, 1)      #leak_edge() runs here, as on pigpio's thread
+        busy.result()
+        deadline = time.monotonic() + 1.0
+        cut = None
+        while cut is None and time.monotonic() < deadline:
+            cut = next((when for when, pin, duty in sim.take_trace() if pin == rouv.thrust1 and duty == 1500), None)
+            time.sleep(0.0005)
+        if cut is not None:
+            latency.add((cut - edge) * 1e6)
+    rouv.leak_detected = False
+    sim.set_input(rouv.leak_sensor, 0)
+    return {"leaks": count, **summary("leak_latency_us", latency)}
+
+def report(result):
+    print("priority lane %-3s %7d commands/s  %3d stops  p50 %9.0fus  p99 %9.0fus  max %9.0fus  %d never applied" %
+          ("on" if result["priority_lane"] else "off", result["commands_per_second"], result["stops"],
+           result["stop_latency_us_p50"] or 0, result["stop_latency_us_p99"] or 0, result["stop_latency_us_max"] or 0,
+           result["stops_missed"]))
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    stop_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 4.0
+    path = sys.argv[3] if len(sys.argv) > 3 else None
+    probe = rouv.handle_frames = StopProbe()
+    rouv.apply_stop = probe.stop
+    sim = bench_storm.setup_rouv()
+    leak = leaks(sim, LEAKS)                    #Before the runtime starts: its safety_tick() would end it on the first leak
+    address, safety_address = bench_storm.start_rouv()
+    print("Stop latency, PS pressed %g times a second under a flat-out %s stream, %gs per run" % (stop_rate, MIX, seconds))
+    runs = []
+    for lane in (False, True):
+        result = run(address, safety_address, probe, seconds, stop_rate, lane)
+        report(result)
+        runs.append(result)
+        sim.take_trace()
+    print("leak edge to thrusters cut: p50 %.0fus  p99 %.0fus  max %.0fus (%d edges)" %
+          (leak["leak_latency_us_p50"], leak["leak_latency_us_p99"], leak["leak_latency_us_max"], leak["leaks"]))
+    results = {"version": bench_storm.version(), "backend": "sim", "runs": runs, "leak": leak}
+    if path is None:
+        print(json.dumps(results, indent=1))
+        return
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Results written to " + path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#Benchmark: FrameReader vs the old recv_all() receive path
+#Sends a burst of command frames over a local socket pair and measures frames/sec, recv calls per frame
+#and receive-buffer allocations per frame for both readers. Runs anywhere, no Pi needed.
+#Usage: python3 bench_framing.py [frames] [burst]
+import socket
+import sys
+import threading
+import time
+import protocol
+import framing
+
+COMMANDS = [(protocol.OP_L3_UP, 1), (protocol.OP_L3_UP, 2), (protocol.OP_L3_UP, 3), (protocol.OP_L3_Y_REST, 0),
+            (protocol.OP_L1_PRESS, 0), (protocol.OP_L1_RELEASE, 0), (protocol.OP_X_PRESS, 0), (protocol.OP_X_RELEASE, 0)]
+
+
+#-----------OLD RECEIVE PATH-----------
+#Copy of recv_all()/handle_client() from before FrameReader, with counters for every bytes object they build
+class LegacyReader:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reads = 0
+        self.allocations = 0
+
+    def recv(self, size):
+        self.reads += 1
+        self.allocations += 1                   #Every recv() returns a new bytes object
+        return self.sock.recv(size)
+
+    def recv_all(self, packet_size):
+        data = bytes()
+        while len(data) < packet_size:
+            data += self.recv(packet_size - len(data))
+            self.allocations += 1               #data += ... reallocates
+        return data
+
+    def next_frame(self):
+        packet_len = self.recv(2)
+        return self.recv_all(int.from_bytes(packet_len, "little"))
+
+
+#-----------BENCHMARK-----------
+def sender(sock, frames, burst):
+    stream = b"".join(protocol.encode_frame(op, arg, seq) for seq, (op, arg) in
+                      zip(range(frames), COMMANDS * (frames // len(COMMANDS) + 1)))
+    frame_len = len(stream) // frames
+    for i in range(0, frames, burst):                                       #Controller events arrive in clumps
+        sock.sendall(stream[i * frame_len:(i + burst) * frame_len])
+    sock.shutdown(socket.SHUT_WR)
+
+def run(name, make_reader, frames, burst):
+    rx, tx = socket.socketpair()
+    reader = make_reader(rx)
+    thread = threading.Thread(target=sender, args=(tx, frames, burst))
+    received = 0
+    start = time.perf_counter()
+    thread.start()
+    if isinstance(reader, framing.FrameReader):
+        while received < frames:
+            for frame in reader.recv_frames():
+                protocol.decode_frame(frame)
+                received += 1
+        allocations = received                                             #One memoryview per frame, recv_into() builds nothing
+    else:
+        while received < frames:
+            protocol.decode_frame(reader.next_frame())
+            received += 1
+        allocations = reader.allocations
+    elapsed = time.perf_counter() - start
+    thread.join()
+    rx.close()
+    tx.close()
+    print("%-12s %10.0f frames/s  %7.4f recv/frame  %6.3f allocs/frame" %
+          (name, received / elapsed, reader.reads / received, allocations / received))
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    print("%d frames, bursts of %d" % (frames, burst))
+    run("recv_all", LegacyReader, frames, burst)
+    run("FrameReader", framing.FrameReader, frames, burst)
+
+if __name__ == "__main__":
+    main()
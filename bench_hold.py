@@ -0,0 +1,96 @@
+#Benchmark: closed-loop depth/heading/pitch hold (autopilot.py) on the simulated vehicle (vehicle_sim.py)
+#Offline: runs the loop in simulated time (no sleeping) through a series of target steps and reports how each axis
+#settles, so gains can be tuned in seconds. Then runs the real threaded loop for a few seconds at each rate and
+#reports tick jitter, tick time and overruns. No Pi needed.
+#Usage: python3 bench_hold.py [seconds per rate] [rate ...]
+import sys
+import time
+import autopilot
+import hal
+import mixer
+import rouv_pi_continuous as rouv
+
+STEPS = ((0.0, (1.0, 0.0, 0.0)),                #(time s, (depth m, heading deg, pitch deg)) targets
+         (10.0, (2.0, 0.0, 0.0)),
+         (20.0, (2.0, 45.0, 0.0)),
+         (30.0, (2.0, 45.0, 10.0)),
+         (40.0, (0.5, 350.0, 0.0)))
+PHASE = 10.0                                    #Seconds each target is held
+BANDS = (0.05, 2.0, 1.0)                        #Settled once within this of the target (m, deg, deg)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulated(clock=time.monotonic):            #Sim backend, vehicle and an autopilot writing straight to the backend
+    backend = hal.SimBackend()
+    for pin in rouv.thrusters:
+        backend.setup_output(pin, 100, 9999)
+        backend.set_PWM_dutycycle(pin, mixer.STOP)
+    vehicle = backend.motion_sensors(rouv.thrusters)
+    vehicle.clock = clock
+    vehicle.last_time = clock()
+
+    def apply(motion):
+        for pin, duty in zip(rouv.thrusters, mixer.mix(motion)):
+            backend.set_PWM_dutycycle(pin, int(duty))
+    return backend, vehicle, autopilot.Autopilot(vehicle, apply, rouv.hold_rate, rouv.hover_heave)
+
+def step_response():
+    clock = FakeClock()
+    backend, vehicle, pilot = simulated(clock)
+    dt = 1.0 / pilot.rate
+    pilot.engage(STEPS[0][1])
+    print("Step responses at %gHz (simulated time)" % pilot.rate)
+    print("%-22s %-8s %10s %10s %10s %10s" % ("target", "axis", "settled s", "overshoot", "max error", "rms error"))
+    for start, target in STEPS:
+        pilot.target = target
+        before = pilot.reading[:3] if pilot.reading else target
+        errors = []
+        while clock.now < start + PHASE:
+            clock.now += dt
+            pilot.tick(dt)
+            errors.append((clock.now - start, pilot.errors()))
+        for axis, name in enumerate(("depth", "heading", "pitch")):
+            step = autopilot.wrap_degrees(target[axis] - before[axis]) if axis else target[axis] - before[axis]
+            stepped = abs(step) > BANDS[axis]   #Otherwise it's only disturbed by the other axes moving
+            settled = 0.0
+            overshoot = 0.0
+            for when, error in errors:
+                if abs(error[axis]) > BANDS[axis]:
+                    settled = when
+                if stepped:
+                    overshoot = max(overshoot, error[axis] * (1 if step > 0 else -1))   #Past the target, in the step's direction
+            worst = max(abs(error[axis]) for when, error in errors)
+            tail = [error[axis] for when, error in errors if when > PHASE - 3.0]
+            rms = (sum(e * e for e in tail) / len(tail)) ** 0.5
+            print("%-22s %-8s %10.2f %10s %10s %10.3f" % ("%.1fm %.0fdeg %.0fdeg" % target if axis == 0 else "", name, settled,
+                                                          "%.3f" % overshoot if stepped else "", "" if stepped else "%.3f" % worst, rms))
+    print("Duty range used: %d ~ %d" % (min(duty for when, pin, duty in backend.trace), max(duty for when, pin, duty in backend.trace)))
+
+def loop_timing(rate, seconds):
+    backend, vehicle, pilot = simulated()
+    pilot.rate = rate
+    pilot.engage()
+    pilot.start()
+    time.sleep(seconds)
+    pilot.stop()
+    print(pilot.report())
+    return pilot
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    rates = [float(rate) for rate in sys.argv[2:]] or [100.0, 200.0]
+    step_response()
+    print()
+    for rate in rates:
+        loop_timing(rate, seconds)
+
+if __name__ == "__main__":
+    main()
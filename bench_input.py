@@ -0,0 +1,136 @@
+#Benchmark: batched controller input (js_input.py) vs pyPS4Controller's one event per read() and callback
+#Records a pilot working both sticks and both triggers, with button presses mixed in, as joystick API bytes (what
+#/dev/input/js0 gives), then reads it back both ways through the same callbacks and counts the work: read() calls,
+#callbacks made and CPU per event. Then streams the same bytes through a FIFO in bursts, as the kernel queues them
+#between reads, to check the batched reader keeps every button and ends with the same state. Runs anywhere.
+#Usage: python3 bench_input.py [events] [burst]
+import os
+import sys
+import tempfile
+import threading
+import time
+import js_input
+
+
+#-----------RECORDED INPUT-----------
+def record(count, burst):                       #Joystick API events: stick sweeps, trigger pulls, a button every burst
+    events = []
+    ms = 0
+    while len(events) < count:
+        for i in range(burst):
+            phase = len(events) + i
+            axis = phase % 6
+            value = (phase * 911) % (2 * js_input.AXIS_MAX) - js_input.AXIS_MAX
+            events.append((ms, value, js_input.JS_AXIS, axis))
+        button = (len(events) // burst) % 6
+        events.append((ms, 1, js_input.JS_BUTTON, button))
+        events.append((ms, 0, js_input.JS_BUTTON, button))
+        ms += 4                                 #DualShock 4 reports every 4ms over Bluetooth
+    return events
+
+
+class Counter(js_input.JoystickController):    #Callbacks that only count, like MyController's bookkeeping
+
+    def __init__(self, path):
+        js_input.JoystickController.__init__(self, path)
+        self.presses = 0
+        self.releases = 0
+        for names in js_input.BUTTON_CALLBACKS.values():
+            setattr(self, names[0], self.press)
+            setattr(self, names[1], self.release)
+        for table in (js_input.STICK_CALLBACKS, js_input.TRIGGER_CALLBACKS, js_input.HAT_CALLBACKS):
+            for names in table.values():
+                for name in names:
+                    setattr(self, name, self.axis)
+
+    def press(self):
+        self.presses += 1
+
+    def release(self):
+        self.releases += 1
+
+    def axis(self, value=0):
+        pass
+
+
+#-----------PER-EVENT PATH-----------
+#pyPS4Controller's loop: read() one 8 byte event, unpack it, one callback for it
+def per_event(path):
+    controller = Counter(path)
+    device = js_input.EventReader(path)         #Only for its fd and merge(), one event at a time
+    state = controller.state
+    reads = 0
+    try:
+        while True:
+            data = os.read(device.fd, js_input.JS_EVENT.size)
+            reads += 1
+            if not data:
+                break
+            state.clear()
+            device.merge(data, state)
+            controller.dispatch(state)
+    finally:
+        device.close()
+    return controller, reads
+
+
+def batched(path):
+    controller = Counter(path)
+    controller.listen(timeout=1)
+    return controller, controller.device.reads
+
+
+def run(name, read, path, count):
+    start_cpu = time.process_time()
+    controller, reads = read(path)
+    cpu = time.process_time() - start_cpu
+    print("%-9s %7d reads %7d callbacks %6d presses  %5.2fus CPU/event" %
+          (name, reads, controller.callbacks, controller.presses, cpu / count * 1e6))
+    return controller, reads
+
+
+#-----------FIFO-----------
+def stream(path, data, burst_bytes):            #Writes the recording in bursts, with a pause the reader can catch up in
+    fd = os.open(path, os.O_WRONLY)
+    for start in range(0, len(data), burst_bytes):
+        os.write(fd, data[start:start + burst_bytes])
+        time.sleep(0.0005)
+    os.close(fd)
+
+
+def fifo(data, burst_bytes):
+    path = os.path.join(tempfile.mkdtemp(), "js0")
+    os.mkfifo(path)
+    writer = threading.Thread(target=stream, args=(path, data, burst_bytes))
+    writer.start()
+    controller = Counter(path)
+    controller.listen(timeout=1)
+    writer.join()
+    os.unlink(path)
+    return controller
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+    events = record(count, burst)
+    data = js_input.encode_js(events)
+    presses = sum(1 for event in events if event[2] == js_input.JS_BUTTON and event[1])
+    with tempfile.NamedTemporaryFile(suffix=".js") as recording:
+        recording.write(data)
+        recording.flush()
+        print("%d events (%d button presses), %d bytes recorded" % (len(events), presses, len(data)))
+        single, single_reads = run("per-event", per_event, recording.name, len(events))
+        batch, batch_reads = run("batched", batched, recording.name, len(events))
+    print("batched makes %.1fx fewer reads and %.1fx fewer callbacks" %
+          (single_reads / max(1, batch_reads), single.callbacks / max(1, batch.callbacks)))
+
+    odd_burst = js_input.JS_EVENT.size * burst + 3  #Split events across writes
+    streamed = fifo(data, odd_burst)
+    same = streamed.state.axes == single.state.axes and streamed.state.buttons == single.state.buttons
+    print("FIFO: %d reads, %d batches, %d/%d presses, %d releases, final state %s" %
+          (streamed.device.reads, streamed.batches, streamed.presses, presses, streamed.releases,
+           "matches" if same else "DIFFERS"))
+
+if __name__ == "__main__":
+    main()
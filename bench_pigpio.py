@@ -0,0 +1,126 @@
+#Benchmark: one pigpio round trip per command vs PipelinedPi batches
+#Runs a local stand-in daemon that speaks the pigpio socket protocol, then times the ROUV's pin setup
+#(22 commands) and a five thruster update, once flushing after every command (what pigpio.pi() does) and
+#once batched. Also checks the stand-in ended up with the duties that were written. Runs anywhere, no Pi needed.
+#Usage: python3 bench_pigpio.py [updates]
+import socket
+import statistics
+import sys
+import threading
+import time
+import pigpio_pipeline
+from pigpio_pipeline import COMMAND, REPLY
+
+THRUSTERS = (12, 16, 13, 25, 18)
+LIGHTS = (27, 17)
+LEAK_SENSOR = 23
+
+
+#-----------STAND-IN DAEMON-----------
+class FakePigpiod:
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        self.modes = {}
+        self.duty = {}
+        self.levels = {}
+        self.commands = 0
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def execute(self, cmd, p1, p2):
+        self.commands += 1
+        if cmd == pigpio_pipeline.CMD_MODES:
+            self.modes[p1] = p2
+        elif cmd == pigpio_pipeline.CMD_PWM:
+            self.duty[p1] = p2
+        elif cmd in (pigpio_pipeline.CMD_PFS, pigpio_pipeline.CMD_PRS):
+            return p2
+        elif cmd == pigpio_pipeline.CMD_GDC:
+            return self.duty.get(p1, -92)                       #PI_NOT_PWM_GPIO
+        elif cmd == pigpio_pipeline.CMD_READ:
+            return self.levels.get(p1, 0)
+        return 0
+
+    def serve(self, conn):
+        buffer = b""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                conn.close()
+                return
+            buffer += data
+            count = len(buffer) // COMMAND.size
+            replies = []
+            for cmd, p1, p2, p3 in COMMAND.iter_unpack(buffer[:count * COMMAND.size]):
+                replies.append(REPLY.pack(cmd, p1, p2, self.execute(cmd, p1, p2)))
+            buffer = buffer[count * COMMAND.size:]
+            if replies:
+                conn.sendall(b"".join(replies))
+
+    def close(self):
+        self.server.close()
+
+
+#-----------BENCHMARK-----------
+def setup_pins(pi, each):                                       #The ROUV's pigpio setup, flush() after every call if each
+    calls = [(pi.set_mode, pin, pigpio_pipeline.OUTPUT) for pin in THRUSTERS + LIGHTS]
+    calls.append((pi.set_mode, LEAK_SENSOR, pigpio_pipeline.INPUT))
+    calls += [(pi.set_PWM_frequency, pin, 100) for pin in THRUSTERS + LIGHTS]
+    calls += [(pi.set_PWM_range, pin, 9999) for pin in THRUSTERS + LIGHTS]
+    for fn, pin, value in calls:
+        fn(pin, value)
+        if each:
+            pi.flush()
+    pi.flush()
+    return len(calls)
+
+def update(pi, duties, each):
+    for pin, duty in zip(THRUSTERS, duties):
+        pi.set_PWM_dutycycle(pin, duty)
+        if each:
+            pi.flush()
+    pi.flush()
+
+def run(name, daemon, updates, each):
+    pi = pigpio_pipeline.PipelinedPi("127.0.0.1", daemon.port)
+    start = time.perf_counter()
+    commands = setup_pins(pi, each)
+    setup_time = time.perf_counter() - start
+    latencies = []
+    duties = None
+    setup_round_trips = pi.round_trips
+    for i in range(updates):
+        duties = [1500 + ((i + k) % 8) * 50 for k in range(len(THRUSTERS))]
+        start = time.perf_counter()
+        update(pi, duties, each)
+        latencies.append(time.perf_counter() - start)
+    round_trips = (pi.round_trips - setup_round_trips) / updates
+    assert [pi.get_PWM_dutycycle(pin) for pin in THRUSTERS] == duties, "stand-in daemon state doesn't match"
+    pi.stop()
+    latencies.sort()
+    print("%-10s setup %7.1fus (%d commands, %d round trips)  update p50 %6.1fus  p99 %6.1fus  %.0f round trips/update" %
+          (name, setup_time * 1e6, commands, setup_round_trips, statistics.median(latencies) * 1e6,
+           latencies[int(len(latencies) * 0.99)] * 1e6, round_trips))
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    daemon = FakePigpiod()
+    run("unbatched", daemon, updates, True)
+    run("pipelined", daemon, updates, False)
+    daemon.close()
+
+if __name__ == "__main__":
+    main()
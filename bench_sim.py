@@ -0,0 +1,28 @@
+#Benchmark: the ROUV's whole command path on the simulated backend, no Pi or pigpio daemon needed
+#Decodes, dispatches and commits a mix of level-mode commands through handle_frames(), in batches like ingest_task()
+#hands them over, and reports commands per second and how many duty writes reached the (simulated) hardware.
+#Usage: python3 bench_sim.py [commands] [batch]
+import sys
+import time
+import protocol
+import rouv_pi_continuous as rouv
+
+COMMANDS = ((protocol.OP_L3_UP, 1), (protocol.OP_L3_UP, 2), (protocol.OP_L3_UP, 3), (protocol.OP_L3_Y_REST, 0),
+            (protocol.OP_X_PRESS, 0), (protocol.OP_X_RELEASE, 0), (protocol.OP_L1_PRESS, 0), (protocol.OP_L1_RELEASE, 0),
+            (protocol.OP_UP_ARROW_PRESS, 0), (protocol.OP_UP_DOWN_ARROW_RELEASE, 0), (protocol.OP_HEARTBEAT, 0))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    sim = rouv.setup_hardware("sim")
+    frames = [memoryview(protocol.encode_frame(opcode, arg, seq))[protocol.LENGTH.size:]
+              for seq, (opcode, arg) in enumerate(COMMANDS[i % len(COMMANDS)] for i in range(count))]
+    start = time.perf_counter()
+    for i in range(0, count, batch):
+        rouv.handle_frames(frames[i:i + batch])
+    elapsed = time.perf_counter() - start
+    print("%d commands in batches of %d: %.0f commands/s, %.1fus per batch, %d duty writes, %d skipped as unchanged" %
+          (count, batch, count / elapsed, elapsed / (count / batch) * 1e6, len(sim.take_trace()), rouv.actuators.writes_saved))
+
+if __name__ == "__main__":
+    main()
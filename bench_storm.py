@@ -0,0 +1,228 @@
+#Load test: how many commands per second the ROUV absorbs before its latency blows up
+#Runs the ROUV's asyncio runtime on the simulated backend, listening on loopback like on the tether, and a load
+#generator in its own process that connects the way the BUOY does (HELLO, wait for READY) and fires BUOY frames at
+#a fixed rate: stick sweeps, button mashing, release storms or all of them mixed. Rate 0 sends as fast as the
+#socket takes them. For every step it reports the commands/s the ROUV applied, how far it fell behind (frames sent
+#but not yet applied, and bytes waiting in its reader), and the apply latency of every frame: from the generator
+#building it to handle_frames() (what handle_client() and ingest_task() call) having written the outputs.
+#Text frames (create_message(), for old ROUVs) carry no timestamp, so only their throughput is measured.
+#Results also go to a JSON file, to compare protocol, dispatch and output stage changes between versions. Without
+#one (or with "-" so the later arguments can be given) they are printed as JSON, so a run leaves nothing in the checkout.
+#Usage: python3 bench_storm.py [seconds] [results.json] [mix,...] [rate,...] [binary|text]
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+os.environ["BUOY_BACKEND"] = "sim"              #Frames are built with the BUOY's own functions, no controller needed
+import buoy_pi_continuous as buoy
+import framing
+import protocol
+import rouv_pi_continuous as rouv
+from latency import Histogram
+
+MIXES = {                                       #(opcode, arg) cycles, what a pilot's controller produces
+    "sweep": [(protocol.OP_L3_UP, 1), (protocol.OP_L3_UP, 2), (protocol.OP_L3_UP, 3), (protocol.OP_L3_UP, 2),
+              (protocol.OP_L3_UP, 1), (protocol.OP_L3_Y_REST, 0), (protocol.OP_L3_DOWN, 1), (protocol.OP_L3_DOWN, 2),
+              (protocol.OP_L3_DOWN, 3), (protocol.OP_L3_DOWN, 2), (protocol.OP_L3_DOWN, 1), (protocol.OP_L3_X_REST, 0)],
+    "mash": [(protocol.OP_X_PRESS, 0), (protocol.OP_X_RELEASE, 0), (protocol.OP_SQUARE_PRESS, 0),
+             (protocol.OP_SQUARE_RELEASE, 0), (protocol.OP_CIRCLE_PRESS, 0), (protocol.OP_CIRCLE_RELEASE, 0),
+             (protocol.OP_L1_PRESS, 0), (protocol.OP_L1_RELEASE, 0), (protocol.OP_R1_PRESS, 0), (protocol.OP_R1_RELEASE, 0),
+             (protocol.OP_UP_ARROW_PRESS, 0), (protocol.OP_UP_DOWN_ARROW_RELEASE, 0)],
+    "release": [(protocol.OP_X_RELEASE, 0), (protocol.OP_SQUARE_RELEASE, 0), (protocol.OP_CIRCLE_RELEASE, 0),
+                (protocol.OP_L1_RELEASE, 0), (protocol.OP_R1_RELEASE, 0), (protocol.OP_L2_RELEASE, 0),
+                (protocol.OP_R2_RELEASE, 0), (protocol.OP_L3_Y_REST, 0), (protocol.OP_L3_X_REST, 0),
+                (protocol.OP_UP_DOWN_ARROW_RELEASE, 0), (protocol.OP_LEFT_RIGHT_ARROW_RELEASE, 0)],
+}
+MIXES["mixed"] = [command for commands in zip(*MIXES.values()) for command in commands] + [(protocol.OP_HEARTBEAT, 0)]
+DEFAULT_MIXES = ("sweep", "mash", "release", "mixed")
+DEFAULT_RATES = (1000, 5000, 20000, 0)          #Commands/s offered, 0: as fast as possible
+TICK = 0.001                                    #Seconds between the generator's sends
+FLAT_OUT_BATCH = 64                             #Frames per send at rate 0
+SAMPLE_PERIOD = 0.01                            #Seconds between backlog samples
+DRAIN_TIMEOUT = 10.0                            #Seconds the ROUV gets to catch up after the generator stops
+
+
+#-----------LOAD GENERATOR-----------
+#Own process, so building and sending frames doesn't take the ROUV's GIL
+def frame(opcode, arg, encoding):               #What the BUOY sends, built now (binary frames carry the time)
+    if encoding == "text":
+        return buoy.create_message(protocol.legacy_text(opcode, arg) or "Heartbeat")
+    return buoy.create_command(opcode, arg)
+
+def connect(address):                           #HELLO, then wait for READY, like open_link()
+    s = socket.create_connection(address)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.sendall(buoy.create_command(protocol.OP_HELLO))
+    reader = framing.FrameReader(s)
+    while True:
+        for msg in reader.recv_frames():
+            if protocol.message_opcode(msg) == protocol.OP_READY:
+                return s
+
+def drain(s, running):                          #Telemetry and echoes from the ROUV, so its sends never block
+    try:
+        while running:
+            if not s.recv(65536):
+                return
+    except OSError:
+        pass
+
+def generate(address, mix, rate, seconds, encoding, sent, ready):
+    commands = MIXES[mix]
+    s = connect(address)
+    running = [True]
+    threading.Thread(target=drain, args=(s, running), daemon=True).start()
+    ready.set()
+    count = 0
+    start = time.monotonic()
+    end = start + seconds
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            due = FLAT_OUT_BATCH if not rate else int((now - start) * rate) - count
+            if due > 0:
+                s.sendall(b"".join(frame(*commands[(count + i) % len(commands)], encoding) for i in range(due)))
+                count += due
+                sent.value = count
+            if rate:
+                time.sleep(TICK)
+    finally:
+        running.clear()
+        time.sleep(DRAIN_TIMEOUT)               #Held open until the main process has seen everything applied
+        s.close()
+
+
+#-----------ROUV-----------
+class Probe:                                    #Wraps handle_frames(): frames applied and their latency
+
+    def __init__(self):
+        self.handle_frames = rouv.handle_frames
+        self.reset()
+
+    def reset(self):
+        self.applied = 0
+        self.batches = 0
+        self.latency = Histogram()              #Frame built -> outputs written, us
+        self.handle = Histogram()               #Frames read -> outputs written, per batch, us
+
+    def __call__(self, frames, received_at=None):
+        self.handle_frames(frames, received_at)
+        applied_at = protocol.now_us()
+        self.batches += 1
+        self.handle.add(rouv.last_apply_us)
+        applied = len(frames)
+        for msg in frames:
+            if msg[0] == protocol.PROTOCOL_MAGIC and len(msg) >= protocol.HEADER.size:
+                if msg[2] == protocol.OP_HELLO:     #Can be applied after READY, it isn't load
+                    applied -= 1
+                    continue
+                self.latency.add(applied_at - protocol.HEADER.unpack_from(msg)[5])
+        self.applied += applied
+
+def setup_rouv():                               #Sim backend, same starting point as main()
+    sim = rouv.setup_hardware("sim")
+    for pin in rouv.thrusters:
+        rouv.set_duty(pin, 1500)
+    rouv.set_duty(rouv.left_light, 1100)
+    rouv.set_duty(rouv.right_light, 1100)
+    rouv.commit_outputs()
+    return sim
+
+def start_rouv():                               #Runtime on its own loop and thread, returns its stream and safety addresses
+    listener = socket.create_server(("127.0.0.1", 0))
+    safety_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)    #Priority lane, as main() opens it
+    safety_sock.bind(("127.0.0.1", 0))
+    thread = threading.Thread(target=lambda: asyncio.run(rouv.serve(listener, safety_sock)), name="rouv", daemon=True)
+    thread.start()
+    return listener.getsockname(), safety_sock.getsockname()
+
+def run_step(address, probe, mix, rate, seconds, encoding):
+    context = multiprocessing.get_context("spawn")
+    sent = context.Value("Q", 0, lock=False)
+    ready = context.Event()
+    generator = context.Process(target=generate, args=(address, mix, rate, seconds, encoding, sent, ready), daemon=True)
+    generator.start()
+    ready.wait()
+    probe.reset()
+    backlog = Histogram()
+    rx_bytes = 0
+    start = time.monotonic()
+    while time.monotonic() < start + seconds:   #Sampled while the generator is sending
+        time.sleep(SAMPLE_PERIOD)
+        backlog.add(max(0, sent.value - probe.applied))
+        link = rouv.pilot_link
+        if link is not None:
+            rx_bytes = max(rx_bytes, link.reader.pending())
+    applied_in_time = probe.applied
+    total = sent.value
+    stopped = time.monotonic()
+    while probe.applied < total and time.monotonic() < stopped + DRAIN_TIMEOUT:
+        time.sleep(0.001)
+    drained = time.monotonic() - stopped
+    percentiles = {}
+    for name, histogram in (("backlog_frames", backlog), ("apply_latency_us", probe.latency), ("handle_us", probe.handle)):
+        for label, fraction in (("p50", 0.5), ("p99", 0.99)):
+            value = histogram.percentile(fraction)
+            percentiles[name + "_" + label] = round(value) if value is not None else None
+        percentiles[name + "_max"] = histogram.max if histogram.count else None
+    generator.terminate()
+    generator.join()
+    while rouv.pilot_link is not None:          #Connection closed, so the next step's HELLO gets control
+        time.sleep(0.01)
+    return {
+        "mix": mix, "encoding": encoding, "offered_per_second": rate or None, "seconds": seconds,
+        "sent": total, "applied": probe.applied, "batches": probe.batches,
+        "sent_per_second": round(total / seconds), "applied_per_second": round(applied_in_time / seconds),
+        "drain_seconds": round(drained, 3), "rx_bytes_max": rx_bytes, **percentiles,
+    }
+
+def report(step):
+    latency = ("latency p50 %7.0fus p99 %8.0fus" % (step["apply_latency_us_p50"], step["apply_latency_us_p99"])
+               if step["apply_latency_us_p50"] is not None else "latency n/a (text frames)")
+    print("%-7s %6s/s offered  %7d/s applied  backlog p99 %6.0f max %6d frames  %s  drain %.2fs" %
+          (step["mix"], step["offered_per_second"] or "max", step["applied_per_second"], step["backlog_frames_p99"] or 0,
+           step["backlog_frames_max"], latency, step["drain_seconds"]))
+
+def version():                                  #Commit the results belong to, None outside a git checkout
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    path = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != "-" else None
+    mixes = sys.argv[3].split(",") if len(sys.argv) > 3 else DEFAULT_MIXES
+    rates = [int(rate) for rate in sys.argv[4].split(",")] if len(sys.argv) > 4 else DEFAULT_RATES
+    encoding = sys.argv[5] if len(sys.argv) > 5 else "binary"
+    probe = rouv.handle_frames = Probe()
+    sim = setup_rouv()
+    address, safety_address = start_rouv()
+    print("ROUV on the sim backend at %s:%d, %gs per step, %s frames" % (address[0], address[1], seconds, encoding))
+    steps = []
+    for mix in mixes:
+        for rate in rates:
+            step = run_step(address, probe, mix, rate, seconds, encoding)
+            report(step)
+            steps.append(step)
+            sim.take_trace()                    #The trace would grow for the whole run
+    results = {"version": version(), "python": platform.python_version(), "machine": platform.machine(),
+               "backend": "sim", "actuator_process": rouv.actuator_process, "steps": steps}
+    if path is None:
+        print(json.dumps(results, indent=1))
+        return
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Results written to " + path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#Benchmark: tail latency of pilot inputs over TCP vs the UDP transport on a lossy, reordering link
+#A relay between a BUOY stand-in and a ROUV stand-in drops and delays traffic. For UDP it drops/delays each datagram
+#(acks included). TCP can't be made to lose segments from user space, so its relay models what the kernel does:
+#a lost segment arrives after the retransmission timeout (Linux minimum 200ms) and everything behind it waits
+#(head-of-line blocking), and a late segment holds back the ones after it too.
+#Latency is from the BUOY sending an input until the ROUV has applied it or a newer input on the same channel.
+#Runs anywhere, no Pi needed.
+#Usage: python3 bench_udp.py [events] [rate]
+import bisect
+import heapq
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import framing
+import protocol
+import udp_transport
+from sender import FrameSender
+
+BASE_DELAY = 0.001                              #Seconds, one way
+REORDER_DELAY = 0.010                           #Extra delay for a reordered packet
+TCP_RETRANSMIT = 0.200                          #Linux minimum RTO
+SCENARIOS = ((0.0, 0.0), (0.01, 0.02), (0.05, 0.05), (0.10, 0.10))     #(loss, reorder)
+LEVELS = ((protocol.OP_L3_UP, 1), (protocol.OP_L3_UP, 2), (protocol.OP_L3_UP, 3), (protocol.OP_L3_Y_REST, 0),
+          (protocol.OP_L3_DOWN, 1), (protocol.OP_L3_DOWN, 2), (protocol.OP_L3_X_REST, 0))
+TOGGLE_EVERY = 25                               #Every 25th input is a light toggle, acked over UDP
+
+
+#-----------LINK MODEL-----------
+class Scheduler:                                #Runs fn() at a given time on one thread
+
+    def __init__(self):
+        self.heap = []
+        self.count = 0
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def at(self, when, fn):
+        with self.cond:
+            self.count += 1
+            heapq.heappush(self.heap, (when, self.count, fn))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(None if not self.heap else self.heap[0][0] - time.monotonic())
+                if not self.running:
+                    return
+                when, n, fn = heapq.heappop(self.heap)
+            try:
+                fn()
+            except OSError:
+                pass
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+def link_delay(rng, reorder):
+    return BASE_DELAY + (REORDER_DELAY if rng.random() < reorder else 0.0)
+
+def udp_relay(rng, scheduler, loss, reorder, src, dst, peers, source, target):    #One direction, until src is closed
+    while True:
+        try:
+            data, addr = src.recvfrom(udp_transport.MAX_DATAGRAM)
+        except OSError:
+            return
+        peers[source] = addr                    #So the other direction knows where to send
+        if rng.random() < loss:
+            continue
+        scheduler.at(time.monotonic() + link_delay(rng, reorder), lambda d=data: dst.sendto(d, peers[target]))
+
+def tcp_relay(rng, scheduler, loss, reorder, src, dst):                #In order, a lost frame holds back the rest
+    reader = framing.FrameReader(src)
+    last = 0.0
+    while True:
+        try:
+            frames = [bytes(frame) for frame in reader.recv_frames()]
+        except OSError:
+            return
+        for frame in frames:
+            delay = TCP_RETRANSMIT + BASE_DELAY if rng.random() < loss else link_delay(rng, reorder)
+            last = max(last, time.monotonic() + delay)
+            scheduler.at(last, lambda f=protocol.LENGTH.pack(len(frame)) + frame: dst.sendall(f))
+
+def tcp_pair():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    client = socket.create_connection(server.getsockname())
+    accepted, addr = server.accept()
+    server.close()
+    for sock in (client, accepted):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client, accepted
+
+
+#-----------ENDPOINTS-----------
+def rouv(recv_frames, applied):                 #Records (channel, seq, time) of every frame applied
+    while True:
+        try:
+            frames = recv_frames()
+        except OSError:                         #Socket closed or timed out, the run is over
+            return
+        now = time.monotonic()
+        for msg in frames:
+            opcode, arg, seq, payload, timestamp = protocol.decode_frame(msg)
+            applied.append((protocol.CHANNELS.get(opcode, seq), seq, now))
+
+def send_inputs(sender, events, rate):          #Returns (channel, seq, time sent) for every input
+    sent = []
+    period = 1.0 / rate
+    deadline = time.monotonic()
+    for seq in range(1, events + 1):
+        if seq % TOGGLE_EVERY == 0:
+            opcode, arg = protocol.OP_SHARE_PRESS, 0
+        else:
+            opcode, arg = LEVELS[seq % len(LEVELS)]
+        sent.append((protocol.CHANNELS.get(opcode, seq), seq, time.monotonic()))
+        sender.enqueue(protocol.encode_frame(opcode, arg, seq))
+        deadline += period
+        time.sleep(max(0.0, deadline - time.monotonic()))
+    return sent
+
+def latencies(sent, applied):                   #Time until each input, or a newer one on its channel, was applied
+    by_channel = {}
+    for channel, seq, when in applied:
+        by_channel.setdefault(channel, []).append((seq, when))
+    earliest = {}                               #channel -> (seqs ascending, earliest apply time of that seq or any later one)
+    for channel, entries in by_channel.items():
+        entries.sort()
+        times = [when for seq, when in entries]
+        for i in range(len(times) - 2, -1, -1):
+            times[i] = min(times[i], times[i + 1])
+        earliest[channel] = ([seq for seq, when in entries], times)
+    results = []
+    for channel, seq, sent_at in sent:
+        seqs, times = earliest.get(channel, ((), ()))
+        first = bisect.bisect_left(seqs, seq)
+        if first < len(seqs):
+            results.append(times[first] - sent_at)
+    return results
+
+
+#-----------RUNS-----------
+def run_tcp(events, rate, loss, reorder, seed):
+    rng = random.Random(seed)
+    scheduler = Scheduler()
+    buoy_sock, relay_in = tcp_pair()
+    relay_out, rouv_sock = tcp_pair()
+    rouv_sock.settimeout(1.0)
+    applied = []
+    threads = [threading.Thread(target=tcp_relay, args=(rng, scheduler, loss, reorder, relay_in, relay_out), daemon=True),
+               threading.Thread(target=rouv, args=(framing.FrameReader(rouv_sock).recv_frames, applied), daemon=True)]
+    for thread in threads:
+        thread.start()
+    sender = FrameSender(buoy_sock).start()
+    sent = send_inputs(sender, events, rate)
+    sender.stop()
+    threads[1].join()                           #Returns after a second without frames
+    scheduler.stop()
+    for sock in (buoy_sock, relay_in, relay_out, rouv_sock):
+        sock.close()
+    return sent, applied
+
+def run_udp(events, rate, loss, reorder, seed):
+    rng = random.Random(seed)
+    scheduler = Scheduler()
+    relay_buoy_side, relay_rouv_side, rouv_sock, buoy_sock = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(4)]
+    for sock in (relay_buoy_side, relay_rouv_side, rouv_sock):
+        sock.bind(("127.0.0.1", 0))
+    rouv_sock.settimeout(1.0)
+    buoy_sock.connect(relay_buoy_side.getsockname())
+    peers = {"rouv": rouv_sock.getsockname()}
+    receiver = udp_transport.UdpReceiver(rouv_sock)
+    sender = udp_transport.UdpSender(buoy_sock).start()
+    applied = []
+    threads = [threading.Thread(target=udp_relay, args=(rng, scheduler, loss, reorder, relay_buoy_side, relay_rouv_side,
+                                                        peers, "buoy", "rouv"), daemon=True),
+               threading.Thread(target=udp_relay, args=(rng, scheduler, loss, reorder, relay_rouv_side, relay_buoy_side,
+                                                        peers, "rouv", "buoy"), daemon=True),
+               threading.Thread(target=receive_acks, args=(sender,), daemon=True),
+               threading.Thread(target=rouv, args=(receiver.recv_frames, applied), daemon=True)]
+    for thread in threads:
+        thread.start()
+    sent = send_inputs(sender, events, rate)
+    threads[3].join()                           #Returns after a second without frames
+    sender.stop()
+    scheduler.stop()
+    for sock in (buoy_sock, relay_buoy_side, relay_rouv_side, rouv_sock):
+        sock.close()
+    return sent, applied
+
+def receive_acks(sender):                       #The BUOY's receive thread
+    while True:
+        try:
+            sender.recv_frames()
+        except OSError:
+            return
+
+def summary(results):
+    results.sort()
+    return "p50 %7.1fms  p99 %7.1fms  max %7.1fms" % (statistics.median(results) * 1000,
+                                                       results[int(len(results) * 0.99)] * 1000, results[-1] * 1000)
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print("%d inputs at %gHz, 1 in %d a light toggle" % (events, rate, TOGGLE_EVERY))
+    for seed, (loss, reorder) in enumerate(SCENARIOS):
+        for name, run in (("tcp", run_tcp), ("udp", run_udp)):
+            sent, applied = run(events, rate, loss, reorder, seed)
+            results = latencies(sent, applied)
+            toggles = [seq for channel, seq, when in sent if seq % TOGGLE_EVERY == 0]
+            toggled = [seq for channel, seq, when in applied if seq % TOGGLE_EVERY == 0]
+            print("loss %3.0f%% reorder %3.0f%%  %s  %s  lost inputs %d  toggles applied %d/%d (%d twice)" %
+                  (loss * 100, reorder * 100, name, summary(results), len(sent) - len(results),
+                   len(set(toggled)), len(toggles), len(toggled) - len(set(toggled))))
+
+if __name__ == "__main__":
+    main()
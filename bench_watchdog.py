@@ -0,0 +1,74 @@
+#Benchmark: how long the ROUV's link watchdog takes to notice the tether is gone
+#Runs the ROUV's own runtime (connection() under supervise(), with its watchdog task) on the sim backend over a
+#loopback socket pair. A BUOY stand-in thread says HELLO and sends heartbeats built by the BUOY's create_command() at
+#its HEARTBEAT_RATE, then the link is cut mid-stream, either by going silent with the socket left open (cable cut,
+#BUOY hung) or by closing it (BUOY script crashed). The time link_lost() fires is taken from the ROUV's watchdog.
+#Usage: python3 bench_watchdog.py [trials]
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+os.environ["BUOY_BACKEND"] = "sim"              #Frames are built with the BUOY's own functions, no controller needed
+import bench_storm
+import buoy_pi_continuous as buoy
+import protocol
+import replay
+import rouv_pi_continuous as rouv
+
+HEARTBEATS = 10                                 #Sent before each cut
+
+
+def send_heartbeats(sock, cut, cut_at):         #HELLO, heartbeats, then the link is cut one period after the last one
+    period = 1.0 / buoy.HEARTBEAT_RATE
+    sock.sendall(buoy.create_command(protocol.OP_HELLO))
+    for i in range(HEARTBEATS):
+        sock.sendall(buoy.create_command(protocol.OP_HEARTBEAT))
+        time.sleep(period)
+    cut_at.append(time.monotonic())
+    if cut == "closed":
+        sock.shutdown(socket.SHUT_RDWR)
+
+def trial(cut, lost_at):
+    buoy_sock, rouv_sock = socket.socketpair()
+    running = [True]
+    threading.Thread(target=bench_storm.drain, args=(buoy_sock, running), daemon=True).start()   #READY, echoes, telemetry
+    del lost_at[:]
+    cut_at = []
+    stop_rouv = replay.start_rouv(rouv_sock)
+    sender = threading.Thread(target=send_heartbeats, args=(buoy_sock, cut, cut_at), daemon=True)
+    sender.start()
+    sender.join()
+    deadline = time.monotonic() + 1.0
+    while not lost_at and time.monotonic() < deadline:
+        time.sleep(0.001)
+    stop_rouv()
+    running.clear()
+    buoy_sock.close()
+    rouv_sock.close()
+    (detected, reason), = lost_at
+    assert reason == ("closed" if cut == "closed" else "timeout"), reason
+    return detected - cut_at[0], rouv.link_watchdog.last_detection
+
+def main():
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    bench_storm.setup_rouv()
+    lost_at = []
+    link_lost = rouv.link_watchdog.on_loss
+
+    def record(reason, silent):                 #Then the ROUV's own failsafe
+        lost_at.append((time.monotonic(), reason))
+        link_lost(reason, silent)
+    rouv.link_watchdog.on_loss = record
+    print("heartbeat %dHz, timeout %.0fms, watchdog %dHz" % (buoy.HEARTBEAT_RATE, rouv.link_timeout * 1000, rouv.watchdog_rate))
+    for cut in ("silent", "closed"):
+        results = [trial(cut, lost_at) for i in range(trials)]
+        latencies = sorted(after_cut for after_cut, silent in results)
+        silences = sorted(silent for after_cut, silent in results)
+        print("%-7s cut: detection after cut p50 %6.1fms  max %6.1fms, after last frame p50 %6.1fms  max %6.1fms  (%d trials)" %
+              (cut, statistics.median(latencies) * 1000, latencies[-1] * 1000,
+               statistics.median(silences) * 1000, silences[-1] * 1000, trials))
+
+if __name__ == "__main__":
+    main()
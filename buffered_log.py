@@ -0,0 +1,66 @@
+#Buffered, sampled logging for the control path, shared by the BUOY_Pi and ROUV_Pi
+#write() only appends a record to an in-memory queue. A background thread formats and writes everything queued
+#every flush_interval seconds, so the control path never waits on stdout/journald.
+#Chatty categories can be sampled: sample_every={"stick": 20} keeps 1 in 20 "stick" records.
+import collections
+import sys
+import threading
+import time
+
+
+class BufferedLog:
+
+    def __init__(self, sample_every=None, capacity=4096, flush_interval=0.1, stream=None):
+        self.sample_every = dict(sample_every or {})
+        self.seen = collections.Counter()               #Records offered per category, sampled or not
+        self.records = collections.deque(maxlen=capacity)       #Oldest records are dropped if the writer falls behind
+        self.capacity = capacity
+        self.dropped = 0
+        self.flush_interval = flush_interval
+        self.stream = stream if stream is not None else sys.stdout
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def write(self, category, message, **fields):
+        self.seen[category] += 1
+        every = self.sample_every.get(category, 1)
+        if every > 1 and self.seen[category] % every != 1:
+            return
+        if len(self.records) == self.capacity:
+            self.dropped += 1
+        self.records.append((time.time(), category, message, fields))
+
+    def depth(self):                                    #Records waiting for the writer
+        return len(self.records)
+
+    def format(self, record):
+        stamp, category, message, fields = record
+        line = "%.3f [%s] %s" % (stamp, category, message)
+        if fields:
+            line += " " + " ".join("%s=%s" % item for item in fields.items())
+        return line
+
+    def flush(self):
+        lines = []
+        while self.records:
+            lines.append(self.format(self.records.popleft()))
+        if lines:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        else:
+            self.flush()
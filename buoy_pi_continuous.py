@@ -1,17 +1,55 @@
 #Continuous Listening Mode
+import os
 import socket
 import struct
-import RPi.GPIO as GPIO
 import time
 import math
 import threading
-from pyPS4Controller.controller import Controller
+import protocol
+import framing
+import hal
+import js_input
+import session
+import udp_transport
+from coalescer import EventCoalescer
+from sender import FrameSender
+from buffered_log import BufferedLog
+from metrics import Metrics
 
-ROUV_ADDR = ('169.254.186.103', 42069)       
+ROUV_ADDR = (os.getenv("ROUV_HOST", '169.254.186.103'), 42069)     #ROUV_HOST=127.0.0.1 for a simulated ROUV on this machine
 
 #-------CONSTANTS-------
 L2_press = False                             #L2 has not been pressed yet
 R2_press = False                             #R2 has not been pressed yet
+BINARY_PROTOCOL = True                       #Set to False when talking to a ROUV that only understands text frames
+seq_num = 0                                  #Sequence number of the last binary frame sent
+seq_lock = threading.Lock()                  #Frames are built on the coalescer, snapshot and receive threads
+MAX_AXIS_RATE = 50                           #Hz, most joystick level updates sent per second
+PROPORTIONAL_MODE = False                    #True: send full-resolution stick/trigger snapshots instead of levels
+SNAPSHOT_RATE = 50                           #Hz, snapshot rate in proportional mode
+CONTROLLER_BACKEND = os.getenv("BUOY_BACKEND", "ps4")      #"ps4" reads the DualShock, "js" reads it in batches, "sim" replays events (see hal.py)
+CONTROLLER_INPUT = os.getenv("BUOY_INPUT", "/dev/input/js0")   #Joystick or evdev device, or a FIFO/file of recorded events for "js"
+RECORD_SESSION = os.getenv("BUOY_RECORD")    #File to record the pilot's controller events to, for replay.py (None: don't record)
+USE_UDP = False                              #UDP datagrams instead of the TCP stream, same port. Must match the ROUV's use_udp.
+SAFETY_PORT = 42070                          #ROUV's UDP port for emergency stops that skip the queue. Must match its safety_port (None: stream only).
+HEARTBEAT_RATE = 50                          #Hz, keeps the ROUV's link watchdog fed while the pilot is idle. Its timeout is 4 of these.
+CONNECT_BACKOFF = (0.1, 5.0)                  #Seconds between connection attempts: first, and the most it doubles up to
+READY_TIMEOUT = 15.0                         #Seconds to wait for the ROUV's READY before sending anyway (older ROUVs never send it)
+HELLO_RESEND = 0.5                           #Seconds between HELLOs over UDP while waiting for READY
+TAKE_CONTROL = os.getenv("BUOY_TAKE_CONTROL") == "1"     #Take control from a pilot already connected instead of observing
+in_control = True                            #False while another console pilots the ROUV and this BUOY only observes
+LINK_DEAD_TIMEOUT = 3.0                      #Seconds of unacknowledged TCP data before the connection counts as dead
+SEND_QUEUE_SIZE = 256                        #Frames waiting for the tether before the oldest are dropped
+METRICS_PORT = int(os.getenv("BUOY_METRICS_PORT", "9421"))     #Prometheus-style text on http://127.0.0.1:9421/metrics, apart from the ROUV's 9420
+
+#-------LOGGING + METRICS-------
+log = BufferedLog(sample_every={"stick": 20})                 #Stick events arrive hundreds of times a second
+metrics = Metrics()
+metrics.describe("buoy_frames_sent_total", "Frames sent to the ROUV, by command")
+metrics.describe("buoy_connect_seconds", "Seconds the last connection took, from the first attempt to READY")
+metrics.describe("buoy_reconnects_total", "Connections to the ROUV made again after losing one")
+metrics.gauge_function("buoy_queue_depth", log.depth, queue="log")
+metrics.gauge_function("buoy_in_control", lambda: int(in_control))
 
 
 #-------SOCKET FUNCTIONS-------
@@ -19,187 +57,487 @@ def create_message(text):                                       #Message format:
     return struct.pack("<H", len(text)) + bytes(text, 'utf-8')  #Struct is a bytes object. "<H" is for formatting (< for little endian, H denotes short). 
                                                                 #This function provides the fully formatted message.
 
-def recv_all(socket, packet_size):                                  #Receive until all bytes have been accounted for.
-    data = bytes()
-    while len(data) < packet_size:
-        data += socket.recv(packet_size - len(data))
-    return data
-
-def handle_client(csock):
-    packet_len = csock.recv(2)                                      #Receive 2 bytes of data. First two bytes of every packet will contain packet length.
-    print(int.from_bytes(packet_len, "little"))                     #Print number of bytes of message
-    msg = recv_all(csock, int.from_bytes(packet_len, "little"))     #Little endian, most significant bit on the right
-    return msg
+def priority_socket():                                          #UDP socket for emergency stops, None without a SAFETY_PORT
+    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if SAFETY_PORT else None
+
+def create_command(opcode, arg=0, payload=b""):                 #Binary version of create_message(): fixed header with opcode, axis/level and sequence number
+    global seq_num
+    if not BINARY_PROTOCOL:
+        text = protocol.legacy_text(opcode, arg)
+        return create_message(text) if text is not None else b""    #Snapshots have no text form
+    with seq_lock:
+        seq_num = (seq_num + 1) & protocol.SEQ_MASK
+        seq = seq_num
+    return protocol.encode_frame(opcode, arg, seq, payload)     #Stamped with this Pi's clock for the ROUV's latency tracing
+
+def handle_client(reader):
+    msg = reader.next_frame()                                       #Length header and message may arrive in any number of reads
+    print(len(msg))                                                 #Print number of bytes of message
+    return bytes(msg)
     
-def send_recv(msg, socket):
+def send_recv(msg, socket, reader):
     socket.send(create_message(msg))
-    recv_msg = handle_client(socket)
+    recv_msg = handle_client(reader)
     print(recv_msg)
     return recv_msg
 
+def connect_once():
+    if USE_UDP:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)    #connect() only fixes the address, nothing is sent
+        s.connect(ROUV_ADDR)
+        return s
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)       #Using TCP/IP, generic socket setup
+    try:
+        s.settimeout(CONNECT_BACKOFF[1])
+        s.connect(ROUV_ADDR)                                    #Connect to this address "Opening the door"
+        s.settimeout(None)
+        if hasattr(socket, "TCP_USER_TIMEOUT"):                 #A cut tether errors the socket in seconds, not the kernel's 15 minutes
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(LINK_DEAD_TIMEOUT * 1000))
+    except OSError:
+        s.close()
+        raise
+    return s
+
+def wait_ready(s, reader):                                      #True once the ROUV sends READY, False after READY_TIMEOUT
+    deadline = time.monotonic() + READY_TIMEOUT
+    try:
+        while time.monotonic() < deadline:
+            left = max(0.001, deadline - time.monotonic())
+            s.settimeout(min(HELLO_RESEND, left) if USE_UDP else left)
+            try:
+                frames = udp_transport.split_frames(s.recv(udp_transport.MAX_DATAGRAM)) if USE_UDP else reader.recv_frames()
+            except socket.timeout:
+                if USE_UDP:
+                    s.send(create_command(protocol.OP_HELLO))   #It may have been lost, or the ROUV not up yet
+                continue
+            except ConnectionRefusedError:                      #UDP: the ROUV isn't listening yet
+                time.sleep(HELLO_RESEND)
+                s.send(create_command(protocol.OP_HELLO))
+                continue
+            for msg in frames:
+                command = protocol.decode_frame(msg)
+                if command is not None and command[0] == protocol.OP_READY:
+                    set_in_control(True)
+                    return True
+                if command is not None and command[0] == protocol.OP_CONTROL and command[1] == protocol.CONTROL_OBSERVER:
+                    set_in_control(False)
+                    return True                                 #No READY is coming while another console pilots
+        return False
+    finally:
+        s.settimeout(None)
+
+def set_in_control(control):                                    #The ROUV ignores this BUOY's commands while another console pilots
+    global in_control
+    if control != in_control:
+        log.write("status", "In control of the ROUV" if control else "Another console has control of the ROUV, observing")
+    in_control = control
+
+def open_link():                                                #Connects, retrying with backoff for as long as it takes. Returns (socket, reader).
+    start = time.monotonic()
+    delay = CONNECT_BACKOFF[0]
+    while True:
+        s = None
+        try:
+            s = connect_once()
+            reader = framing.FrameReader(s)
+            if TAKE_CONTROL:
+                s.send(create_command(protocol.OP_CONTROL, protocol.CONTROL_TAKE))
+            else:
+                s.send(create_command(protocol.OP_HELLO))       #Hello frame, "Hello World!" for legacy ROUVs
+            if wait_ready(s, reader):
+                log.write("status", "ROUV ready", seconds=round(time.monotonic() - start, 2))
+            else:
+                log.write("status", "No READY from the ROUV, sending anyway", seconds=READY_TIMEOUT)
+            metrics.set("buoy_connect_seconds", time.monotonic() - start)
+            return s, reader
+        except OSError as e:                                    #ROUV not up yet, or went away mid-handshake
+            if s is not None:
+                s.close()
+            log.write("status", "ROUV not reachable, retrying", error=str(e), retry_in=delay)
+            time.sleep(delay)
+            delay = min(delay * 2, CONNECT_BACKOFF[1])
+
 #------CONTROLLER CLASS & FUNCTIONS------
+Controller = hal.controller_base(CONTROLLER_BACKEND)            #pyPS4Controller is only imported for "ps4"
+
 class MyController(Controller):
 
-    def __init__(self, socket, *args, **kwargs):
+    def __init__(self, socket, *args, reader=None, **kwargs):
         Controller.__init__(self, *args, **kwargs)
+        self.closed = False
+        self.coalescer = EventCoalescer(self.send_command, MAX_AXIS_RATE).start()    #Every command goes through here
+        self.attach(socket, reader)
+        if USE_UDP:
+            metrics.gauge_function("buoy_udp_retries", lambda: self.sender.retries)
+        metrics.gauge_function("buoy_queue_depth", lambda: self.sender.depth(), queue="send")      #Lambdas: the sender changes on reconnect
+        metrics.gauge_function("buoy_send_oldest_wait_seconds", lambda: self.sender.oldest_wait())
+        metrics.gauge_function("buoy_send_last_batch_wait_seconds", lambda: self.sender.last_wait)
+        metrics.gauge_function("buoy_send_dropped", lambda: self.sender.dropped)
+        metrics.gauge_function("buoy_sendmsg_calls", lambda: self.sender.sendmsg_calls)
+        metrics.gauge_function("buoy_events_sent", lambda: self.coalescer.sent)
+        metrics.gauge_function("buoy_events_suppressed", lambda: self.coalescer.suppressed)
+        metrics.gauge_function("buoy_queue_depth", lambda: len(self.coalescer.pending), queue="coalescer")
+        if CONTROLLER_BACKEND == "js":
+            metrics.gauge_function("buoy_input_events", lambda: self.device.events if self.device else 0)
+            metrics.gauge_function("buoy_input_reads", lambda: self.device.reads if self.device else 0)
+            metrics.gauge_function("buoy_input_batches", lambda: self.batches)
+            metrics.gauge_function("buoy_input_callbacks", lambda: self.callbacks)
+        self.safety_sock = priority_socket()                    #Priority lane to the ROUV, see send_priority()
+        self.axes = [0] * protocol.AXIS_COUNT                   #Latest stick/trigger values for proportional mode
+        self.telemetry = None                                   #Latest vehicle state from the ROUV (protocol.decode_telemetry())
+        self.telemetry_at = None                                #time.monotonic() it arrived
+        metrics.collector(self.telemetry_samples)
+        if PROPORTIONAL_MODE:
+            threading.Thread(target=self.send_snapshots, name="snapshots", daemon=True).start()
+        threading.Thread(target=self.send_heartbeats, name="heartbeat", daemon=True).start()
+
+    def attach(self, socket, reader=None):                      #Start sending on a (new) connection
         self.s = socket
+        if USE_UDP:
+            self.sender = udp_transport.UdpSender(socket, SEND_QUEUE_SIZE).start()     #Sends at once, repeats and retries in the background
+        else:
+            self.sender = FrameSender(socket, SEND_QUEUE_SIZE).start()     #Callbacks only enqueue, the sender thread writes
+        self.reader = reader or framing.FrameReader(socket)    #Used by the receive thread over TCP (and send_recv())
+        threading.Thread(target=self.receive, args=(self.sender, self.reader), name="receive", daemon=True).start()
+
+    def reconnect(self):                                        #On the receive thread, the old connection is dead
+        log.write("status", "Lost the ROUV, reconnecting")
+        self.sender.stop()
+        self.s.close()
+        s, reader = open_link()
+        if self.closed:
+            s.close()
+            return
+        self.coalescer.forget()                                 #The ROUV restored its safe state, resend stick levels even if unchanged
+        self.attach(s, reader)
+        metrics.inc("buoy_reconnects_total")
+
+    def close(self):
+        self.closed = True
+        self.coalescer.stop()                                   #Sends anything still pending
+        self.sender.stop()
+
+    def send_command(self, opcode, arg=0, payload=b""):
+        self.sender.enqueue(create_command(opcode, arg, payload))
+        metrics.inc("buoy_frames_sent_total", command=protocol.OPCODE_NAMES.get(opcode, "UNKNOWN"))
+
+    def send_priority(self, opcode):                            #One datagram to the ROUV's safety port, nothing queued ahead of it
+        if self.safety_sock is None:
+            return
+        try:
+            self.safety_sock.sendto(protocol.encode_frame(opcode), (ROUV_ADDR[0], SAFETY_PORT))
+            metrics.inc("buoy_priority_frames_sent_total", command=protocol.OPCODE_NAMES.get(opcode, "UNKNOWN"))
+        except OSError:                                         #Tether down, the stream copy goes when it's back
+            pass
+
+    def receive(self, sender, reader):                          #Frames from the ROUV. Echoes are answered straight away.
+        recv_frames = sender.recv_frames if USE_UDP else reader.recv_frames     #UdpSender handles acks itself
+        while True:
+            try:
+                frames = recv_frames()
+            except ConnectionRefusedError:                      #UDP: the ROUV isn't listening (restarting), it says READY again when back
+                time.sleep(0.1)
+                continue
+            except OSError:                                     #TCP: ROUV closed, restarted or the tether went dead
+                if not self.closed and not USE_UDP:
+                    self.reconnect()                            #Starts a new receive thread
+                return
+            for msg in frames:
+                command = protocol.decode_frame(msg)
+                if command is None:
+                    if bytes(msg) == b"LEAK":                   #Older ROUVs' only message
+                        self.on_leak()
+                elif command[0] == protocol.OP_ECHO and len(command[3]) >= protocol.ECHO.size:
+                    sent_at, = protocol.ECHO.unpack_from(command[3])
+                    self.send_command(protocol.OP_ECHO_REPLY, 0, protocol.ECHO_REPLY.pack(sent_at, protocol.now_us()))
+                elif command[0] == protocol.OP_TELEMETRY and len(command[3]) >= protocol.TELEMETRY.size:
+                    self.on_telemetry(protocol.decode_telemetry(command[3]))
+                elif command[0] == protocol.OP_CONTROL:
+                    set_in_control(command[1] == protocol.CONTROL_PILOT)
+
+    def on_telemetry(self, telemetry):                          #On the receive thread, controller callbacks never wait for it
+        if telemetry["leak"] and not (self.telemetry and self.telemetry["leak"]):
+            self.on_leak()
+        if telemetry["overheat"] and not (self.telemetry and self.telemetry["overheat"]):
+            log.write("safety", "ROUV overheating, thrusters cut", temp=telemetry["temp"])
+        self.telemetry = telemetry
+        self.telemetry_at = time.monotonic()
+
+    def on_leak(self):
+        log.write("safety", "LEAK on the ROUV, surfacing")
+        metrics.inc("buoy_rouv_leaks_total")
+
+    def telemetry_samples(self):                                #For Metrics.collector(), the ROUV's state as last reported
+        telemetry = self.telemetry
+        if telemetry is None:
+            return
+        yield "buoy_telemetry_age_seconds", {}, time.monotonic() - self.telemetry_at
+        for channel in protocol.TELEMETRY_CHANNELS:
+            yield "buoy_rouv_duty", {"channel": channel}, telemetry[channel]
+        yield "buoy_rouv_cpu_temp_celsius", {}, telemetry["temp"]
+        for name, flag in protocol.TELEMETRY_FLAGS:
+            yield "buoy_rouv_" + name, {}, int(telemetry[name])
+        yield "buoy_rouv_apply_us", {}, telemetry["apply_us"]
+        yield "buoy_rouv_hold_jitter_us", {}, telemetry["hold_jitter_us"]
+        yield "buoy_rouv_hold_overruns", {}, telemetry["hold_overruns"]
+        yield "buoy_frames_unapplied", {}, (seq_num - telemetry["seq"]) & protocol.SEQ_MASK    #Sent, not yet applied (includes heartbeats)
+
+    def send_heartbeats(self):                                  #The ROUV stops its thrusters if these stop arriving
+        period = 1.0 / HEARTBEAT_RATE
+        deadline = time.monotonic()
+        while not self.closed:
+            self.send_command(protocol.OP_HEARTBEAT)
+            deadline += period
+            time.sleep(max(0.0, deadline - time.monotonic()))
+
+    def send_snapshots(self):                                   #Whole controller state at a fixed rate, held inputs included
+        period = 1.0 / SNAPSHOT_RATE
+        deadline = time.monotonic()
+        while not self.closed:                                  #Stops with the link, like the heartbeats
+            self.coalescer.send_now(protocol.OP_SNAPSHOT, 0, protocol.encode_snapshot(self.axes))
+            deadline += period
+            time.sleep(max(0.0, deadline - time.monotonic()))
+
+    def set_axis(self, axis, value):
+        self.axes[axis] = max(-protocol.AXIS_MAX, min(protocol.AXIS_MAX, value))
+
+    def on_state(self, state):                                  #"js" backend only: one call per batch of controller events
+        if not PROPORTIONAL_MODE or RECORD_SESSION:             #Recordings need every stick callback
+            self.dispatch(state)
+            return
+        axes = state.axes                                       #Snapshots carry the whole state, copy it in one go
+        self.axes[protocol.AXIS_LX] = axes[js_input.AXIS_LX]
+        self.axes[protocol.AXIS_LY] = axes[js_input.AXIS_LY]
+        self.axes[protocol.AXIS_RX] = axes[js_input.AXIS_RX]
+        self.axes[protocol.AXIS_RY] = axes[js_input.AXIS_RY]
+        self.axes[protocol.AXIS_L2] = (axes[js_input.AXIS_L2] + protocol.AXIS_MAX) // 2
+        self.axes[protocol.AXIS_R2] = (axes[js_input.AXIS_R2] + protocol.AXIS_MAX) // 2
+        self.dispatch(state, sticks=False)                      #Buttons and arrows still send their commands
         
     def on_x_press(self):
-        print("X press detected on BUOY")
-        self.s.send(create_message("X press"))
-        #send_recv("X press", self.s)
+        log.write("button", "X press")
+        self.coalescer.send_now(protocol.OP_X_PRESS)
+        #send_recv("X press", self.s, self.reader)
 
     def on_x_release(self):
-        print("X release detected on BUOY")
-        self.s.send(create_message("X release"))
-        #send_recv("X release", self.s)
+        log.write("button", "X release")
+        self.coalescer.send_now(protocol.OP_X_RELEASE)
+        #send_recv("X release", self.s, self.reader)
         
     def on_square_press(self):
-        print("Square press detected on BUOY")
-        self.s.send(create_message("Square press"))
+        log.write("button", "Square press")
+        self.coalescer.send_now(protocol.OP_SQUARE_PRESS)
                     
     def on_square_release(self):
-        print("Square release detected on BUOY")
-        self.s.send(create_message("Square release"))
+        log.write("button", "Square release")
+        self.coalescer.send_now(protocol.OP_SQUARE_RELEASE)
 
     def on_triangle_press(self):
-        print("Triangle press detected on BUOY")
-        self.s.send(create_message("Triangle press"))
+        log.write("button", "Triangle press")
+        self.coalescer.send_now(protocol.OP_TRIANGLE_PRESS)
         
     def on_triangle_release(self):
-        print("Triangle release detected on BUOY")
-        self.s.send(create_message("Triangle release"))
+        log.write("button", "Triangle release")
+        self.coalescer.send_now(protocol.OP_TRIANGLE_RELEASE)
 
     def on_circle_press(self):
-        print("Circle press detected on BUOY")
-        self.s.send(create_message("Circle press"))
+        log.write("button", "Circle press")
+        self.coalescer.send_now(protocol.OP_CIRCLE_PRESS)
                     
     def on_circle_release(self):
-        print("Circle release detected on BUOY")
-        self.s.send(create_message("Circle release"))
+        log.write("button", "Circle release")
+        self.coalescer.send_now(protocol.OP_CIRCLE_RELEASE)
 
     def on_L1_press(self):
-        print("L1 press detected on BUOY")
-        self.s.send(create_message("L1 press"))
+        log.write("button", "L1 press")
+        self.coalescer.send_now(protocol.OP_L1_PRESS)
         
     def on_L1_release(self):
-        print("L1 release detected on BUOY")
-        self.s.send(create_message("L1 release"))
+        log.write("button", "L1 release")
+        self.coalescer.send_now(protocol.OP_L1_RELEASE)
 
     def on_L2_press(self, value):
         global L2_press
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_L2, (value + protocol.AXIS_MAX) // 2)   #Trigger reads -32767 (released) ~ 32767
+            return
         if (L2_press == False):
-            print("L2 press detected on BUOY")
-            self.s.send(create_message("L2 press"))
+            log.write("button", "L2 press")
+            self.coalescer.send_now(protocol.OP_L2_PRESS)
             L2_press = True
     
     def on_L2_release(self):
         global L2_press
-        print("L2 release detected on BUOY")
-        self.s.send(create_message("L2 release"))
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_L2, 0)
+            return
+        log.write("button", "L2 release")
+        self.coalescer.send_now(protocol.OP_L2_RELEASE)
         L2_press = False
 
     def on_R1_press(self):
-        print("R1 press detected on BUOY")
-        self.s.send(create_message("R1 press"))
+        log.write("button", "R1 press")
+        self.coalescer.send_now(protocol.OP_R1_PRESS)
         
     def on_R1_release(self):
-        print("R1 release detected on BUOY")
-        self.s.send(create_message("R1 release"))
+        log.write("button", "R1 release")
+        self.coalescer.send_now(protocol.OP_R1_RELEASE)
 
     def on_R2_press(self, value):
         global R2_press
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_R2, (value + protocol.AXIS_MAX) // 2)
+            return
         if (R2_press == False):
-            print("R2 press detected on BUOY")
-            self.s.send(create_message("R2 press"))
+            log.write("button", "R2 press")
+            self.coalescer.send_now(protocol.OP_R2_PRESS)
             R2_press = True
     
     def on_R2_release(self):
         global R2_press
-        print("R2 release detected on BUOY")
-        self.s.send(create_message("R2 release"))
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_R2, 0)
+            return
+        log.write("button", "R2 release")
+        self.coalescer.send_now(protocol.OP_R2_RELEASE)
         R2_press = False
 
     def on_up_arrow_press(self):
-        print("UpArrow press detected on BUOY")
-        self.s.send(create_message("UpArrow press"))
+        log.write("button", "UpArrow press")
+        self.coalescer.send_now(protocol.OP_UP_ARROW_PRESS)
         
     def on_down_arrow_press(self):
-        print("DownArrow press detected on BUOY")
-        self.s.send(create_message("DownArrow press"))
+        log.write("button", "DownArrow press")
+        self.coalescer.send_now(protocol.OP_DOWN_ARROW_PRESS)
 
     def on_up_down_arrow_release(self):
-        print("UpDownArrow release detected on BUOY")
-        self.s.send(create_message("UpDownArrow release"))
+        log.write("button", "UpDownArrow release")
+        self.coalescer.send_now(protocol.OP_UP_DOWN_ARROW_RELEASE)
         
     def on_left_arrow_press(self):
-        print("LeftArrow press detected on BUOY")
-        self.s.send(create_message("LeftArrow press"))
+        log.write("button", "LeftArrow press")
+        self.coalescer.send_now(protocol.OP_LEFT_ARROW_PRESS)
 
     def on_right_arrow_press(self):
-        print("RightArrow press detected on BUOY")
-        self.s.send(create_message("RightArrow press"))
+        log.write("button", "RightArrow press")
+        self.coalescer.send_now(protocol.OP_RIGHT_ARROW_PRESS)
 
     def on_left_right_arrow_release(self):
-        print("LeftRightArrow release detected on BUOY")
-        self.s.send(create_message("LeftRightArrow release"))
+        log.write("button", "LeftRightArrow release")
+        self.coalescer.send_now(protocol.OP_LEFT_RIGHT_ARROW_RELEASE)
 
     def on_playstation_button_press(self):
-        print("PS press detected on BUOY")
-        self.s.send(create_message("PS press"))
+        log.write("button", "PS press")
+        self.send_priority(protocol.OP_PS_PRESS)                #Straight to the ROUV, ahead of anything still queued
+        self.coalescer.send_now(protocol.OP_PS_PRESS)           #And in order on the stream, in case the datagram is lost
         
     def on_share_press(self):
-        print("Share press detected on BUOY")
-        self.s.send(create_message("Share press"))    
+        log.write("button", "Share press")
+        self.coalescer.send_now(protocol.OP_SHARE_PRESS)    
         
     def on_options_press(self):
-        print("Options press detected on BUOY")
-        self.s.send(create_message("Options press"))
+        log.write("button", "Options press")
+        self.coalescer.send_now(protocol.OP_OPTIONS_PRESS)
         
     def on_L3_up(self, value):
-        print("L3 up detected on BUOY, value: " + str(value))
-        c_value = math.ceil(abs(value)/100)
-        print("Converted value: " + str(c_value))
-        if (c_value >= 1 and c_value <= 100):
-            self.s.send(create_message("L3 up 1"))
-        if (c_value > 100 and c_value <= 200):
-            self.s.send(create_message("L3 up 2"))
-        if (c_value > 200):
-            self.s.send(create_message("L3 up 3"))
+        log.write("stick", "L3 up", value=value)
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_LY, value)
+            return
+        level = stick_level(value)
+        if level:
+            self.coalescer.update("L3", protocol.OP_L3_UP, level)      #Only sent when the level changes
 
     def on_L3_down(self, value):
-        print("L3 down detected on BUOY, value: " + str(value))
-        c_value = math.ceil(abs(value)/100)
-        print("Converted value: " + str(c_value))
-        if (c_value >= 1 and c_value <= 100):
-            self.s.send(create_message("L3 down 1"))
-        if (c_value > 100 and c_value <= 200):
-            self.s.send(create_message("L3 down 2"))
-        if (c_value > 200):
-            self.s.send(create_message("L3 down 3"))
+        log.write("stick", "L3 down", value=value)
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_LY, value)
+            return
+        level = stick_level(value)
+        if level:
+            self.coalescer.update("L3", protocol.OP_L3_DOWN, level)
     
     def on_L3_y_at_rest(self):
-        print("L3 Y at rest detected on BUOY")
-        self.s.send(create_message("L3 y rest"))
+        log.write("button", "L3 Y at rest")
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_LY, 0)
+            return
+        self.coalescer.update("L3", protocol.OP_L3_Y_REST)
 
     def on_L3_x_at_rest(self):
-        print("L3 X at rest detected on BUOY")
-        self.s.send(create_message("L3 x rest"))
+        log.write("button", "L3 X at rest")
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_LX, 0)
+            return
+        self.coalescer.update("L3", protocol.OP_L3_X_REST)
+
+    #Only used in proportional mode, level mode has no commands for these axes
+    def on_L3_left(self, value):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_LX, value)
+
+    def on_L3_right(self, value):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_LX, value)
+
+    def on_R3_up(self, value):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_RY, value)
+
+    def on_R3_down(self, value):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_RY, value)
+
+    def on_R3_left(self, value):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_RX, value)
+
+    def on_R3_right(self, value):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_RX, value)
+
+    def on_R3_y_at_rest(self):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_RY, 0)
+
+    def on_R3_x_at_rest(self):
+        if PROPORTIONAL_MODE:
+            self.set_axis(protocol.AXIS_RX, 0)
+
+
+def stick_level(value):                                         #Joystick value -> level 1~3, 0 if the stick is centred
+    c_value = math.ceil(abs(value)/100)
+    if (c_value >= 1 and c_value <= 100):
+        return 1
+    if (c_value > 100 and c_value <= 200):
+        return 2
+    if (c_value > 200):
+        return 3
+    return 0
     
             
 #-----------MAIN-----------
 def main():
-    time.sleep(20)
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)       #Using TCP/IP, generic socket setup
-    s.settimeout(300)
-    s.connect(ROUV_ADDR)                                        #Connect to this address "Opening the door"
-    s.settimeout(None)
-    msg = create_message("Hello World!")                        #Message, self-explanatory
-    s.send(msg)                                                 #Send
-    print(msg)
-
-    controller = MyController(s, interface="/dev/input/js0", connecting_using_ds4drv=False)
-    controller.listen(timeout = 300)
+    log.start()
+    try:
+        metrics.serve(METRICS_PORT)
+    except OSError as e:                                        #Port taken: fly without metrics rather than not at all
+        log.write("status", "Metrics not served", port=METRICS_PORT, error=str(e))
+    print("Connecting to the ROUV at %s:%d" % ROUV_ADDR)
+    s, reader = open_link()                                     #Retries until the ROUV is up and says READY, no fixed wait
+    print("Connected")
+
+    controller = MyController(s, interface=CONTROLLER_INPUT, connecting_using_ds4drv=False, reader=reader)
+    recorder = session.SessionRecorder(RECORD_SESSION).attach(controller) if RECORD_SESSION else None
+    try:
+        controller.listen(timeout = 300)
+    finally:
+        if recorder is not None:
+            recorder.close()
+            print("Recorded %d controller events to %s" % (recorder.events, RECORD_SESSION))
+    controller.close()
+    print(controller.coalescer.stats())                        #How many joystick events never had to be sent
+    log.stop()
 
 if __name__ == "__main__":
     main()
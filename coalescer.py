@@ -0,0 +1,83 @@
+#Change-only, rate-limited sending of controller events on the BUOY_Pi
+#Joystick callbacks fire for every raw axis event, even when the level sent to the ROUV hasn't changed.
+#Axis states go through update(): a state equal to the last one sent is dropped, only the newest state per axis
+#is kept (latest wins), and pending states are flushed at most max_rate times a second.
+#Button events go through send_now(), which flushes pending axis states first so the ROUV sees events in order.
+import threading
+import time
+
+
+class EventCoalescer:
+
+    def __init__(self, send, max_rate=50):
+        self.send = send                        #send(opcode, arg, payload=b"") puts one command on the wire
+        self.interval = 1.0 / max_rate          #Minimum seconds between axis flushes
+        self.cond = threading.Condition()
+        self.last_state = {}                    #Axis -> (opcode, arg) last sent to the ROUV
+        self.pending = {}                       #Axis -> newest (opcode, arg) not sent yet
+        self.next_flush = 0.0
+        self.sent = 0                           #Events put on the wire
+        self.suppressed = 0                     #Events dropped as duplicates or overwritten by a newer state
+        self.running = False
+        self.thread = None
+
+    def update(self, axis, opcode, arg=0):
+        state = (opcode, arg)
+        with self.cond:
+            if self.pending.pop(axis, None) is not None:
+                self.suppressed += 1            #Older state never made it out
+            if self.last_state.get(axis) == state:
+                self.suppressed += 1            #ROUV already has this one
+                return
+            self.pending[axis] = state
+            self.cond.notify()
+
+    def send_now(self, opcode, arg=0, payload=b""):
+        with self.cond:
+            self.flush_locked()
+            self.send(opcode, arg, payload)
+            self.sent += 1
+
+    def flush_locked(self):
+        for axis, state in self.pending.items():
+            self.send(*state)
+            self.last_state[axis] = state
+            self.sent += 1
+        self.pending.clear()
+        self.next_flush = time.monotonic() + self.interval
+
+    def run(self):
+        with self.cond:
+            while self.running:
+                if not self.pending:
+                    self.cond.wait()
+                    continue
+                delay = self.next_flush - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)       #Newer states keep replacing pending ones while we wait
+                    continue
+                self.flush_locked()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="coalescer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.flush_locked()
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def forget(self):                           #The ROUV has started over (reconnect), so every state is new to it
+        with self.cond:
+            self.last_state.clear()
+
+    def stats(self):
+        with self.cond:
+            total = self.sent + self.suppressed
+            return {"sent": self.sent, "suppressed": self.suppressed,
+                    "saved": self.suppressed / total if total else 0.0}
@@ -0,0 +1,104 @@
+#Read-only subscribers on the ROUV_Pi: consoles, loggers and dashboards that watch the pilot's session
+#Every frame is encoded once and the same bytes object is queued for every subscriber. Each subscriber has its own
+#writer task on the event loop, so a slow one only falls behind itself: when its queue is full the oldest frame is
+#dropped, and the control path never waits on it. Whatever has queued up goes out in one sendmsg() (see sender.py).
+import asyncio
+import collections
+
+MAX_IOV = 512                                   #Frames per sendmsg(), Linux refuses more than IOV_MAX (1024)
+
+
+class Subscriber:
+
+    def __init__(self, sock, capacity=64, lock=None):
+        self.sock = sock                        #Non-blocking socket, shared with the connection's reader
+        self.capacity = capacity
+        self.lock = lock or asyncio.Lock()      #Held for each frame, so other writers to the socket can't interleave
+        self.queue = collections.deque()
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0                        #Oldest frames thrown away because the subscriber fell behind
+        self.task = None
+        self.open = True
+
+    def push(self, frame):                      #Never blocks
+        if len(self.queue) >= self.capacity:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(frame)
+        self.ready.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.open:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue and self.open:
+                    batch = [self.queue.popleft() for i in range(min(len(self.queue), MAX_IOV))]
+                    async with self.lock:
+                        await self.send(loop, batch)
+                    self.sent += len(batch)
+        except OSError:                         #Gone, the connection's reader notices and removes it
+            pass
+
+    async def send(self, loop, batch):          #One sendmsg() for the batch, the loop finishes it if the socket fills up
+        try:
+            sent = self.sock.sendmsg(batch)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        for frame in batch:
+            if sent >= len(frame):
+                sent -= len(frame)
+                continue
+            await loop.sock_sendall(self.sock, memoryview(frame)[sent:])
+            sent = 0
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self
+
+    def stop(self):                             #Connection gone, a half-sent frame doesn't matter
+        if self.task is not None:
+            self.task.cancel()
+
+    async def close(self):                      #Connection stays: finish the frame being sent, drop the rest
+        self.open = False
+        self.queue.clear()
+        self.ready.set()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+class Fanout:
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity                #Frames each subscriber may have waiting
+        self.subscribers = set()
+        self.published = 0
+        self.dropped = 0                        #Dropped by subscribers that have since gone
+
+    def add(self, sock, lock=None):
+        subscriber = Subscriber(sock, self.capacity, lock).start()
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def remove(self, subscriber):
+        subscriber.stop()
+        self.subscribers.discard(subscriber)
+        self.dropped += subscriber.dropped
+
+    async def detach(self, subscriber):         #Stop observing without breaking the stream (observer promoted to pilot)
+        self.subscribers.discard(subscriber)
+        await subscriber.close()
+        self.dropped += subscriber.dropped
+
+    def publish(self, frame):                   #Same buffer to everyone
+        if not self.subscribers:
+            return
+        self.published += 1
+        for subscriber in self.subscribers:
+            subscriber.push(frame)
+
+    def dropped_total(self):
+        return self.dropped + sum(subscriber.dropped for subscriber in self.subscribers)
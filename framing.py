@@ -0,0 +1,79 @@
+#Stream decoder for length-prefixed frames, shared by the BUOY_Pi and ROUV_Pi
+#Every frame is 2 bytes of little endian length followed by the message (see create_message()).
+#Data is read with recv_into() straight into one preallocated buffer, and every complete frame in a read
+#is handed out as a memoryview into that buffer, so no bytes objects are built on the receive path.
+#A view stays valid until the next fill(), so copy it with bytes(frame) if it needs to be kept longer.
+
+MAX_FRAME = 2 + 0xFFFF                          #Largest possible frame, length prefix included
+MIN_READ = 4096                                 #Compact the buffer when less than this is free at the end
+
+
+class FrameReader:
+
+    def __init__(self, sock, buffer_size=2 * MAX_FRAME):
+        self.sock = sock
+        self.buffer = bytearray(max(buffer_size, MAX_FRAME + MIN_READ))
+        self.view = memoryview(self.buffer)
+        self.start = 0                          #First byte not yet handed out as a frame
+        self.end = 0                            #End of the bytes received so far
+        self.reads = 0                          #Number of recv_into() calls, for benchmarks
+
+    def pending(self):                          #Bytes received but not yet returned as a frame
+        return self.end - self.start
+
+    def compact(self):                          #Move a partial frame to the front of the buffer
+        remaining = self.end - self.start
+        if remaining:
+            self.buffer[:remaining] = bytes(self.view[self.start:self.end])     #Only ever the tail of one partial frame
+        self.start = 0
+        self.end = remaining
+
+    def free_space(self):                       #View of the buffer the next read should land in
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < MIN_READ:
+            self.compact()
+        return self.view[self.end:]
+
+    def commit(self, received):                 #Account for bytes a read placed in free_space()
+        if received == 0:
+            raise ConnectionResetError("Connection closed by peer")
+        self.reads += 1
+        self.end += received
+        return received
+
+    def fill(self):                             #One recv_into(), as large as the free space allows
+        return self.commit(self.sock.recv_into(self.free_space()))
+
+    async def fill_async(self, loop):           #Same as fill(), for a non-blocking socket on an asyncio loop
+        return self.commit(await loop.sock_recv_into(self.sock, self.free_space()))
+
+    def feed(self, data):                       #Append bytes that did not come from the socket (datagrams, recorded sessions)
+        if len(self.buffer) - self.end < len(data):
+            self.compact()
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):                           #Every complete frame already in the buffer, without the length prefix
+        buffer = self.buffer
+        while self.end - self.start >= 2:
+            length = buffer[self.start] | (buffer[self.start + 1] << 8)     #The length header may have arrived split across two reads
+            begin = self.start + 2
+            if self.end - begin < length:
+                break
+            self.start = begin + length
+            yield self.view[begin:self.start]
+
+    def recv_frames(self):                      #One read, then every complete frame it finished
+        self.fill()
+        return self.frames()
+
+    async def recv_frames_async(self, loop):
+        await self.fill_async(loop)
+        return self.frames()
+
+    def next_frame(self):                       #Block until one whole frame is available
+        while True:
+            for frame in self.frames():
+                return frame
+            self.fill()
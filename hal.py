@@ -0,0 +1,169 @@
+#Hardware backends for the ROUV_Pi and BUOY_Pi
+#The scripts talk to hardware only through a backend: PWM outputs, digital inputs and CPU temperature on the ROUV,
+#the controller event source on the BUOY. "pigpio"/"ps4"/"js" drive the real hardware and are only imported when
+#chosen. "sim" keeps everything in memory, records every duty cycle change with a timestamp, simulates the vehicle
+#for the IMU/depth readings (vehicle_sim.py), and runs on any Linux machine, so the whole command path can be
+#imported, benchmarked and tested off the Pi.
+#Pick one with ROUV_BACKEND / BUOY_BACKEND in the environment (see the CONSTANTS in each script).
+import threading
+import time
+import thermal
+
+ROUV_BACKENDS = ("pigpio", "sim")
+BUOY_BACKENDS = ("ps4", "js", "sim")
+
+
+#-----------ROUV: PIGPIO-----------
+class PigpioBackend:                            #pigpio daemon, through PipelinedPi (batched) or pigpio.pi()
+
+    def __init__(self, pipelined=True):
+        if pipelined:
+            import pigpio_pipeline
+            self.pi = pigpio_pipeline.PipelinedPi()
+            self.OUTPUT, self.INPUT = pigpio_pipeline.OUTPUT, pigpio_pipeline.INPUT
+        else:
+            import pigpio
+            self.pi = pigpio.pi()
+            self.OUTPUT, self.INPUT = pigpio.OUTPUT, pigpio.INPUT
+        self.flush = getattr(self.pi, "flush", None)    #None for pigpio.pi(), every call is already sent
+        self.set_PWM_dutycycle = self.pi.set_PWM_dutycycle
+        self.get_PWM_dutycycle = self.pi.get_PWM_dutycycle
+        self.read = self.pi.read
+        self.notifier = None                    #pigpio.pi() delivering edge callbacks, PipelinedPi has no notifications
+        self.watches = []
+
+    def setup_output(self, pin, frequency, range_):
+        self.pi.set_mode(pin, self.OUTPUT)
+        self.pi.set_PWM_frequency(pin, frequency)
+        self.pi.set_PWM_range(pin, range_)
+
+    def setup_input(self, pin):
+        self.pi.set_mode(pin, self.INPUT)
+
+    def watch_input(self, pin, callback):       #callback() from pigpio's notification thread as soon as the pin goes high
+        import pigpio
+        if self.notifier is None:
+            self.notifier = self.pi if hasattr(self.pi, "callback") else pigpio.pi()
+        self.watches.append(self.notifier.callback(pin, pigpio.RISING_EDGE, lambda gpio, level, tick: callback()))
+
+    def thermal_monitor(self, period):
+        return thermal.ThermalMonitor(period=period)
+
+    def motion_sensors(self, thrusters):        #No IMU or depth sensor fitted yet, so no closed-loop hold
+        return None
+
+    def stop(self):
+        for watch in self.watches:
+            watch.cancel()
+        if self.notifier is not None and self.notifier is not self.pi:
+            self.notifier.stop()
+        self.pi.stop()
+
+
+#-----------ROUV: SIMULATED-----------
+class SimThermalMonitor(thermal.ThermalMonitor):    #Same smoothing, temperature comes from the backend instead of sysfs
+
+    def __init__(self, backend, period=1.0, smoothing=0.3):
+        thermal.ThermalMonitor.__init__(self, path="<sim>", period=period, smoothing=smoothing)
+        self.backend = backend
+
+    def read(self):
+        return self.backend.temperature
+
+
+class SimBackend:
+
+    def __init__(self, temperature=45.0):
+        self.lock = threading.Lock()
+        self.duty = {}                          #pin -> duty cycle
+        self.frequency = {}
+        self.range = {}
+        self.levels = {}                        #Input pin -> level, set_input() to change one (e.g. a leak)
+        self.watches = {}                       #Input pin -> callbacks for a rising edge, called by set_input()
+        self.temperature = temperature          #deg C, change it to simulate an overheat
+        self.trace = []                         #(time.monotonic(), pin, duty) for every duty written
+        self.flushes = 0
+        self.vehicle = None                     #vehicle_sim.SimVehicle, once motion_sensors() is asked for
+
+    def setup_output(self, pin, frequency, range_):
+        self.frequency[pin] = frequency
+        self.range[pin] = range_
+        self.duty[pin] = 0
+
+    def setup_input(self, pin):
+        self.levels.setdefault(pin, 0)
+
+    def set_PWM_dutycycle(self, pin, duty):
+        with self.lock:
+            self.duty[pin] = int(duty)
+            self.trace.append((time.monotonic(), pin, int(duty)))
+
+    def get_PWM_dutycycle(self, pin):
+        return self.duty[pin]
+
+    def read(self, pin):
+        return self.levels.get(pin, 0)
+
+    def set_input(self, pin, level):            #On the caller's thread, like pigpio's notification thread
+        rising = level and not self.levels.get(pin, 0)
+        self.levels[pin] = level
+        if rising:
+            for callback in self.watches.get(pin, ()):
+                callback()
+
+    def watch_input(self, pin, callback):
+        self.watches.setdefault(pin, []).append(callback)
+
+    def flush(self):
+        self.flushes += 1
+
+    def thermal_monitor(self, period):
+        return SimThermalMonitor(self, period)
+
+    def motion_sensors(self, thrusters):        #IMU and depth sensor on a simulated vehicle driven by these thrusters
+        import vehicle_sim
+        self.vehicle = vehicle_sim.SimVehicle(self, thrusters)
+        return self.vehicle
+
+    def take_trace(self):                       #Trace so far, and start a new one
+        with self.lock:
+            trace, self.trace = self.trace, []
+        return trace
+
+    def stop(self):
+        pass
+
+
+def open_backend(name, pipelined=True):
+    if name == "pigpio":
+        return PigpioBackend(pipelined)
+    if name == "sim":
+        return SimBackend()
+    raise ValueError("Unknown ROUV backend %r, expected one of %s" % (name, ", ".join(ROUV_BACKENDS)))
+
+
+#-----------BUOY: CONTROLLER EVENTS-----------
+class SimController:                            #Stands in for pyPS4Controller's Controller
+
+    def __init__(self, interface=None, connecting_using_ds4drv=False, events=(), **kwargs):
+        self.interface = interface
+        self.events = events                    #(seconds from start, callback name, args), in order
+
+    def listen(self, timeout=None, speed=1.0):  #Calls the on_* callbacks at their times (speed 0: as fast as possible)
+        start = time.monotonic()
+        for offset, name, args in self.events:
+            if speed:
+                time.sleep(max(0.0, start + offset / speed - time.monotonic()))
+            getattr(self, name)(*args)
+
+
+def controller_base(name):                      #Base class for MyController
+    if name == "ps4":
+        from pyPS4Controller.controller import Controller
+        return Controller
+    if name == "js":                            #Batched reads of the same device, no pyPS4Controller (js_input.py)
+        from js_input import JoystickController
+        return JoystickController
+    if name == "sim":
+        return SimController
+    raise ValueError("Unknown BUOY backend %r, expected one of %s" % (name, ", ".join(BUOY_BACKENDS)))
@@ -0,0 +1,249 @@
+#Batched controller input for the BUOY_Pi, in place of pyPS4Controller's one-event-at-a-time loop
+#pyPS4Controller reads /dev/input/js0 eight bytes at a time and makes a method call for every event, so continuous
+#stick movement costs a read() and a callback per axis report. JoystickController opens the device non-blocking,
+#reads everything that has queued up into one preallocated buffer, decodes it with struct.iter_unpack and merges
+#it into one controller state per batch: only the newest value of each stick and trigger is kept, every button and
+#arrow press and release is kept, all in the order they arrived. on_state() then gets one call per batch. By default
+#it calls the same on_* callbacks as pyPS4Controller, once per changed stick or trigger, so MyController works unchanged.
+#Reads the joystick API (js0, 8 byte events) or evdev (eventN, 24 byte events, 16 on 32-bit Pi OS). A regular file
+#or FIFO of recorded event bytes works the same way, which is how bench_input.py tests it without a controller.
+import os
+import select
+import stat
+import struct
+import time
+
+AXIS_MAX = 32767                                #Same range as pyPS4Controller's callbacks
+
+#-----------JOYSTICK API (js0)-----------
+JS_EVENT = struct.Struct("<IhBB")               #ms timestamp, value, type, number
+JS_BUTTON = 0x01
+JS_AXIS = 0x02
+JS_INIT = 0x80                                  #Initial state reported when the device is opened
+
+#DualShock 4 on the kernel's hid-sony/hid-playstation driver, ds4drv off (connecting_using_ds4drv=False)
+AXIS_LX, AXIS_LY, AXIS_L2, AXIS_RX, AXIS_RY, AXIS_R2, AXIS_HAT_X, AXIS_HAT_Y = range(8)
+AXES = 8
+BUTTONS = 13
+BUTTON_CALLBACKS = {                            #Button number -> (press callback, release callback)
+    0: ("on_x_press", "on_x_release"),
+    1: ("on_circle_press", "on_circle_release"),
+    2: ("on_triangle_press", "on_triangle_release"),
+    3: ("on_square_press", "on_square_release"),
+    4: ("on_L1_press", "on_L1_release"),
+    5: ("on_R1_press", "on_R1_release"),        #6 and 7 are L2/R2, reported through their axes
+    8: ("on_share_press", "on_share_release"),
+    9: ("on_options_press", "on_options_release"),
+    10: ("on_playstation_button_press", "on_playstation_button_release"),
+    11: ("on_L3_press", "on_L3_release"),
+    12: ("on_R3_press", "on_R3_release"),
+}
+STICK_CALLBACKS = {                             #Axis -> (negative, positive, centred)
+    AXIS_LX: ("on_L3_left", "on_L3_right", "on_L3_x_at_rest"),
+    AXIS_LY: ("on_L3_up", "on_L3_down", "on_L3_y_at_rest"),
+    AXIS_RX: ("on_R3_left", "on_R3_right", "on_R3_x_at_rest"),
+    AXIS_RY: ("on_R3_up", "on_R3_down", "on_R3_y_at_rest"),
+}
+TRIGGER_CALLBACKS = {                           #Axis -> (pressed, with value, released)
+    AXIS_L2: ("on_L2_press", "on_L2_release"),
+    AXIS_R2: ("on_R2_press", "on_R2_release"),
+}
+HAT_CALLBACKS = {                               #Axis -> (negative, positive, centred), no values
+    AXIS_HAT_X: ("on_left_arrow_press", "on_right_arrow_press", "on_left_right_arrow_release"),
+    AXIS_HAT_Y: ("on_up_arrow_press", "on_down_arrow_press", "on_up_down_arrow_release"),
+}
+ARROW_AXES = tuple(HAT_CALLBACKS)
+
+#-----------EVDEV (eventN)-----------
+EV_EVENT_64 = struct.Struct("<qqHHi")           #struct timeval (64-bit), type, code, value
+EV_EVENT_32 = struct.Struct("<llHHi")           #32-bit userland (Raspberry Pi OS armhf)
+EV_KEY = 0x01
+EV_ABS = 0x03
+EV_ABS_AXES = {0x00: AXIS_LX, 0x01: AXIS_LY, 0x02: AXIS_L2, 0x03: AXIS_RX, 0x04: AXIS_RY, 0x05: AXIS_R2,
+               0x10: AXIS_HAT_X, 0x11: AXIS_HAT_Y}     #ABS_X.. ABS_RZ, ABS_HAT0X/Y
+EV_KEY_BUTTONS = {0x130: 0, 0x131: 1, 0x133: 2, 0x134: 3, 0x136: 4, 0x137: 5, 0x138: 6, 0x139: 7,
+                  0x13a: 8, 0x13b: 9, 0x13c: 10, 0x13d: 11, 0x13e: 12}     #BTN_SOUTH.. BTN_THUMBR
+EV_STICK_CENTRE = 128                           #hid-playstation reports sticks and triggers as 0~255, hats as -1~1
+
+
+def evdev_value(axis, value):                   #evdev reading -> the joystick API's range
+    if axis in ARROW_AXES:
+        return value * AXIS_MAX
+    if axis in TRIGGER_CALLBACKS:
+        return value * 2 * AXIS_MAX // 255 - AXIS_MAX
+    return max(-AXIS_MAX, min(AXIS_MAX, (value - EV_STICK_CENTRE) * AXIS_MAX // 127))
+
+
+class ControllerState:                          #Merged state after a batch, and what changed in it
+
+    def __init__(self):
+        self.axes = [0] * AXES
+        self.axes[AXIS_L2] = self.axes[AXIS_R2] = -AXIS_MAX     #Triggers rest at the bottom of the range
+        self.buttons = [0] * BUTTONS
+        self.changed = {}                       #Stick/trigger axis -> newest value, this batch only
+        self.events = []                        #Button and arrow callback names and changed axes in arrival order, this batch only
+
+    def clear(self):
+        self.changed.clear()
+        del self.events[:]
+
+    def change_axis(self, axis, value):
+        if axis in HAT_CALLBACKS:               #Arrows are presses, a press and release in one batch both count
+            negative, positive, centred = HAT_CALLBACKS[axis]
+            self.events.append(centred if not value else negative if value < 0 else positive)
+            return
+        if axis in self.changed:                #Only the newest value is kept, where it arrived: L3 up, PS, L3 rest -> PS, L3 rest
+            self.events.remove(axis)
+        self.changed[axis] = value
+        self.events.append(axis)
+
+    def change_button(self, button, value):
+        names = BUTTON_CALLBACKS.get(button)
+        if names is not None:
+            self.events.append(names[0] if value else names[1])
+
+
+class EventReader:                              #Non-blocking reads of whole events into one preallocated buffer
+
+    def __init__(self, path, event_format=None, batch_events=64):
+        self.path = path
+        if event_format is None:
+            event_format = "evdev" if os.path.basename(path).startswith("event") else "js"
+        self.event_format = event_format
+        self.event = {"js": JS_EVENT, "evdev": EV_EVENT_64, "evdev32": EV_EVENT_32}[event_format]
+        self.buffer = bytearray(self.event.size * batch_events)
+        self.view = memoryview(self.buffer)
+        self.kept = 0                           #Bytes of a partial event at the front of the buffer (files and FIFOs only)
+        if stat.S_ISFIFO(os.stat(path).st_mode):  #Wait for the writer, a FIFO without one reads as ended
+            self.fd = os.open(path, os.O_RDONLY)
+            os.set_blocking(self.fd, False)
+        else:
+            self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.is_file = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.reads = 0
+        self.events = 0
+
+    def read(self):                             #Whole events waiting, empty if there are none yet, None at the end
+        try:
+            received = os.readv(self.fd, [self.view[self.kept:]])
+        except BlockingIOError:
+            return self.view[:0]
+        if received == 0:                       #End of a file, or a FIFO's writer closed
+            return None
+        self.reads += 1
+        end = self.kept + received
+        whole = end - end % self.event.size
+        events = bytes(self.view[:whole])       #Copied, the partial event is moved to the front for the next read
+        self.kept = end - whole
+        self.buffer[:self.kept] = self.buffer[whole:end]
+        self.events += whole // self.event.size
+        return events
+
+    def wait(self, timeout):                    #True once there is something to read
+        if self.is_file:
+            return True
+        readable, writable, errors = select.select([self.fd], [], [], timeout)
+        return bool(readable)
+
+    def merge(self, data, state):               #Fold a batch of events into state
+        if self.event_format == "js":
+            for timestamp, value, kind, number in JS_EVENT.iter_unpack(data):
+                if kind & JS_AXIS:
+                    if number < AXES:
+                        state.axes[number] = value
+                        if not kind & JS_INIT:
+                            state.change_axis(number, value)
+                elif kind & JS_BUTTON and number < BUTTONS:
+                    state.buttons[number] = value
+                    if not kind & JS_INIT:
+                        state.change_button(number, value)
+            return
+        for seconds, micros, kind, code, value in self.event.iter_unpack(data):
+            if kind == EV_ABS:
+                axis = EV_ABS_AXES.get(code)
+                if axis is not None:
+                    state.axes[axis] = value = evdev_value(axis, value)
+                    state.change_axis(axis, value)
+            elif kind == EV_KEY:
+                button = EV_KEY_BUTTONS.get(code)
+                if button is not None and value != 2:   #2 is key repeat
+                    state.buttons[button] = value
+                    state.change_button(button, value)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JoystickController:                       #Stands in for pyPS4Controller's Controller
+
+    def __init__(self, interface="/dev/input/js0", connecting_using_ds4drv=False, event_format=None, **kwargs):
+        self.interface = interface
+        self.event_format = event_format        #None: from the device name, "js", "evdev" or "evdev32"
+        self.state = ControllerState()
+        self.device = None
+        self.batches = 0                        #on_state() calls
+        self.callbacks = 0                      #on_* calls made from them
+
+    def listen(self, timeout=30, poll=1.0):     #Waits up to timeout seconds for the device, then reads until it goes away
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.device = EventReader(self.interface, self.event_format)
+                break
+            except FileNotFoundError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+        try:
+            while True:
+                if not self.device.wait(poll):
+                    continue
+                data = self.device.read()
+                if data is None:
+                    return
+                if not data:
+                    continue
+                self.state.clear()
+                self.device.merge(data, self.state)
+                if self.state.events:
+                    self.batches += 1
+                    self.on_state(self.state)
+        except OSError:                         #Controller disconnected (ENODEV)
+            return
+        finally:
+            self.device.close()
+
+    def on_state(self, state):                  #Once per batch. By default: pyPS4Controller's callbacks for what changed.
+        self.dispatch(state)
+
+    def dispatch(self, state, sticks=True):     #In arrival order. sticks=False: buttons and arrows only.
+        for event in state.events:
+            if isinstance(event, str):
+                self.call(event)
+                continue
+            if not sticks:
+                continue
+            axis = event
+            value = state.changed[axis]
+            if axis in STICK_CALLBACKS:
+                negative, positive, centred = STICK_CALLBACKS[axis]
+                if value:
+                    self.call(negative if value < 0 else positive, value)
+                else:
+                    self.call(centred)
+            elif axis in TRIGGER_CALLBACKS:
+                pressed, released = TRIGGER_CALLBACKS[axis]
+                if value <= -AXIS_MAX:
+                    self.call(released)
+                else:
+                    self.call(pressed, value)
+
+    def call(self, name, *args):
+        callback = getattr(self, name, None)    #Like pyPS4Controller's defaults, a callback nobody wrote does nothing
+        if callback is not None:
+            self.callbacks += 1
+            callback(*args)
+
+
+def encode_js(events):                          #(ms, value, type, number) tuples -> joystick API bytes, for tests and benchmarks
+    return b"".join(JS_EVENT.pack(*event) for event in events)
@@ -0,0 +1,106 @@
+#End-to-end latency tracing on the ROUV_Pi, from the BUOY's controller event to the PWM write
+#Every binary frame carries the BUOY's monotonic clock (us) and a sequence number. The ROUV notes when each frame
+#was received, decoded, dispatched and when its PWM writes completed. The two Pis' clocks are unrelated, so the
+#ROUV sends ECHO frames, the BUOY answers straight away with its own clock, and the offset is estimated from the
+#round trip with the smallest delay (the one least affected by queueing).
+import collections
+import math
+import threading
+
+STAGES = ("link", "decode", "dispatch", "pwm", "total")
+#link:     BUOY send -> ROUV recv (needs the clock offset)
+#decode:   recv -> frame decoded
+#dispatch: decoded -> handler done
+#pwm:      handler done -> set_PWM_dutycycle complete
+#total:    BUOY send -> set_PWM_dutycycle complete (needs the clock offset)
+
+BUCKET_GROWTH = 1.1                             #Each bucket is 10% wider than the last, ~1us to ~1 hour
+
+
+def bucket_of(us):
+    return 0 if us < 1 else int(math.log(us) / math.log(BUCKET_GROWTH)) + 1
+
+def bucket_top(bucket):                         #Largest latency (us) counted in a bucket
+    return 0.0 if bucket == 0 else BUCKET_GROWTH ** bucket
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.max = 0
+
+    def add(self, us):
+        us = max(us, 0)
+        self.buckets[bucket_of(us)] += 1
+        self.count += 1
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, fraction):             #Upper edge of the bucket holding the given fraction of samples
+        if not self.count:
+            return None
+        needed = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= needed:
+                return min(bucket_top(bucket), self.max)
+        return self.max
+
+
+class LatencyTracker:
+
+    def __init__(self, echo_window=16):
+        self.lock = threading.Lock()
+        self.histograms = {}                    #(command, stage) -> Histogram
+        self.echoes = collections.deque(maxlen=echo_window)    #(round trip, offset) of recent echoes
+        self.offset = None                      #ROUV clock - BUOY clock (us), None until the first echo reply
+        self.round_trip = None
+
+    def on_echo_reply(self, sent_at, buoy_time, received_at):   #All in us. sent_at/received_at are the ROUV's clock.
+        round_trip = received_at - sent_at
+        with self.lock:
+            self.echoes.append((round_trip, (sent_at + received_at) // 2 - buoy_time))
+            self.round_trip, self.offset = min(self.echoes)     #Least queued round trip gives the best estimate
+
+    def add(self, command, stage, us):
+        key = (command, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(us)
+
+    def record(self, command, buoy_time, received_at, decoded_at, dispatched_at, pwm_at):
+        with self.lock:
+            self.add(command, "decode", decoded_at - received_at)
+            self.add(command, "dispatch", dispatched_at - decoded_at)
+            self.add(command, "pwm", pwm_at - dispatched_at)
+            if buoy_time is not None and self.offset is not None:
+                sent_at = buoy_time + self.offset
+                self.add(command, "link", received_at - sent_at)
+                self.add(command, "total", pwm_at - sent_at)
+
+    def summary(self):                          #(command, stage, count, p50, p99, max), all in us
+        with self.lock:
+            return [(command, stage, h.count, h.percentile(0.5), h.percentile(0.99), h.max)
+                    for (command, stage), h in sorted(self.histograms.items(), key=lambda item: (item[0][0], STAGES.index(item[0][1])))]
+
+    def samples(self):                          #For the metrics endpoint
+        for command, stage, count, p50, p99, worst in self.summary():
+            for quantile, value in (("0.5", p50), ("0.99", p99), ("1", worst)):
+                yield "rouv_latency_us", {"command": command, "stage": stage, "quantile": quantile}, value
+        if self.offset is not None:
+            yield "rouv_clock_offset_us", {}, self.offset
+            yield "rouv_echo_round_trip_us", {}, self.round_trip
+
+    def report(self):
+        lines = ["%-24s %-9s %8s %10s %10s %10s" % ("command", "stage", "count", "p50 us", "p99 us", "max us")]
+        for command, stage, count, p50, p99, worst in self.summary():
+            lines.append("%-24s %-9s %8d %10.0f %10.0f %10.0f" % (command, stage, count, p50, p99, worst))
+        if self.offset is not None:
+            lines.append("Clock offset %dus (round trip %dus)" % (self.offset, self.round_trip))
+        else:
+            lines.append("No echo replies, link and total latency not measured")
+        return "\n".join(lines)
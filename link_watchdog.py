@@ -0,0 +1,54 @@
+#Link watchdog for the ROUV_Pi
+#The BUOY sends a HEARTBEAT frame at a fixed rate on top of its commands. Every frame received feeds the
+#watchdog. If nothing arrives for longer than the timeout (the tether is cut, or the BUOY script hung), check()
+#calls on_loss once so the ROUV can stop its thrusters instead of holding the last command. The next frame re-arms it.
+#Timeouts only start counting after the first heartbeat, so a BUOY that doesn't send heartbeats (older script,
+#text frames) is not cut off whenever the pilot holds still.
+import time
+
+
+class LinkWatchdog:
+
+    def __init__(self, timeout=0.08, on_loss=None):
+        self.timeout = timeout                  #Seconds of silence before the link counts as lost
+        self.on_loss = on_loss                  #on_loss(reason, silent): silent = seconds since the last frame
+        self.last_frame = None
+        self.armed = False                      #Set by arm() on the first heartbeat
+        self.lost = False
+        self.losses = 0
+        self.last_detection = None              #Seconds of silence when the last loss was detected
+
+    def feed(self, now=None):
+        self.last_frame = time.monotonic() if now is None else now
+        self.lost = False
+
+    def arm(self):
+        self.armed = True
+
+    def reset(self):                            #New connection: wait for its first heartbeat again
+        self.last_frame = None
+        self.armed = False
+        self.lost = False
+
+    def silent_for(self, now=None):
+        if self.last_frame is None:
+            return 0.0
+        return (time.monotonic() if now is None else now) - self.last_frame
+
+    def check(self, now=None):                  #Call much faster than the timeout. True when the link was just lost.
+        if not self.armed or self.last_frame is None or self.lost:
+            return False
+        silent = self.silent_for(now)
+        if silent <= self.timeout:
+            return False
+        self.trip("timeout", silent)
+        return True
+
+    def trip(self, reason, silent=None):        #Also used when the socket reports the connection is gone
+        if self.lost:
+            return
+        self.lost = True
+        self.losses += 1
+        self.last_detection = self.silent_for() if silent is None else silent
+        if self.on_loss is not None:
+            self.on_loss(reason, self.last_detection)
@@ -0,0 +1,100 @@
+#Counters and gauges, served as Prometheus text on localhost, shared by the BUOY_Pi and ROUV_Pi
+#curl http://127.0.0.1:9420/metrics
+import http.server
+import threading
+
+METRICS_PORT = 9420
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}                              #(name, labels) -> value
+        self.gauges = {}                                #(name, labels) -> value
+        self.gauge_functions = {}                       #(name, labels) -> fn(), read when scraped
+        self.collectors = []                            #fn() yielding (name, labels dict, value), read when scraped
+        self.help = {}
+        self.server = None
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, label_key(labels))] = value
+
+    def gauge_function(self, name, fn, **labels):       #For values that already live somewhere else (queue lengths, cached temp)
+        self.gauge_functions[(name, label_key(labels))] = fn
+
+    def collector(self, fn):                            #For families of values whose labels aren't known up front (latency histograms)
+        self.collectors.append(fn)
+
+    def get(self, name, **labels):
+        key = (name, label_key(labels))
+        if key in self.counters:
+            return self.counters[key]
+        if key in self.gauge_functions:
+            return self.gauge_functions[key]()
+        return self.gauges.get(key)
+
+    def render(self):                                   #Prometheus text exposition format
+        with self.lock:
+            counters = list(self.counters.items())
+        samples = [(key, value, "counter") for key, value in counters]
+        samples += [(key, value, "gauge") for key, value in list(self.gauges.items())]
+        for key, fn in list(self.gauge_functions.items()):
+            try:
+                samples.append((key, fn(), "gauge"))
+            except Exception:
+                pass
+        for fn in list(self.collectors):
+            try:
+                samples += [((name, label_key(labels)), value, "gauge") for name, labels, value in fn()]
+            except Exception:
+                pass
+        lines = []
+        typed = set()
+        for (name, labels), value, kind in sorted(samples, key=lambda sample: sample[0]):
+            if value is None:
+                continue
+            if name not in typed:
+                if name in self.help:
+                    lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+                typed.add(name)
+            label_text = ",".join('%s="%s"' % item for item in labels)
+            lines.append("%s%s %s" % (name, "{" + label_text + "}" if label_text else "", float(value)))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=METRICS_PORT, host="127.0.0.1"):     #Background HTTP server, localhost only
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):               #Scrapes shouldn't end up in the journal
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        return self.server
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,54 @@
+#Thrust allocation for proportional control mode on the ROUV_Pi
+#A desired motion vector [surge, heave, yaw, pitch, roll] is turned into all five thruster duty cycles
+#with one matrix multiply, so every input held at once is blended instead of the last write winning.
+import numpy as np
+import protocol
+
+STOP = 1500                                     #15% DC
+MIN_DUTY = 1100                                 #Thruster duty limits, 11% ~ 19% DC
+MAX_DUTY = 1900
+SPAN = 400                                      #Duty change for full thrust in one direction
+
+SURGE = 0                                       #+ forward
+HEAVE = 1                                       #+ up
+YAW = 2                                         #+ right turn
+PITCH = 3                                       #+ nose up
+ROLL = 4                                        #+ right roll
+DOF_COUNT = 5
+
+#Share of each motion given to each thruster, in thrust direction (+ pushes the way the motion wants).
+#Signs follow the hand-tuned button commands: UpArrow uses 1, 2 & 3, L3 uses 4 & 5, L1/R1 use 1, 2 and one
+#rear thruster, L2/R2 use 1 & 2, Left/RightArrow use 2 or 1.
+ALLOCATION = np.array([
+    #surge heave yaw  pitch roll
+    [0.0,  1.0,  1.0,  1.0,  1.0],              #Thruster 1 (left offset)
+    [0.0,  1.0, -1.0,  1.0, -1.0],              #Thruster 2 (right offset)
+    [0.0,  1.0,  0.0,  0.0,  0.0],              #Thruster 3 (center vertical)
+    [1.0,  0.0,  1.0,  0.0,  0.0],              #Thruster 4 (left rear)
+    [1.0,  0.0, -1.0,  0.0,  0.0],              #Thruster 5 (right rear)
+])
+
+#Thrusters 1 and 4 have reversed propellers, so forward thrust is a duty below STOP
+DIRECTION = np.array([-1.0, 1.0, 1.0, -1.0, 1.0])
+
+MIX = (DIRECTION * SPAN)[:, None] * ALLOCATION  #Motion vector -> duty offset from STOP
+
+#Controller snapshot -> motion vector. UP and LEFT are negative on the sticks.
+#Left stick: surge + yaw, right stick: heave + roll, L2/R2: pitch up/down.
+AXES_TO_MOTION = np.zeros((DOF_COUNT, protocol.AXIS_COUNT))
+AXES_TO_MOTION[SURGE, protocol.AXIS_LY] = -1.0
+AXES_TO_MOTION[YAW, protocol.AXIS_LX] = 1.0
+AXES_TO_MOTION[HEAVE, protocol.AXIS_RY] = -1.0
+AXES_TO_MOTION[ROLL, protocol.AXIS_RX] = 1.0
+AXES_TO_MOTION[PITCH, protocol.AXIS_L2] = 1.0
+AXES_TO_MOTION[PITCH, protocol.AXIS_R2] = -1.0
+AXES_TO_MOTION /= protocol.AXIS_MAX
+
+SNAPSHOT_MIX = MIX @ AXES_TO_MOTION             #Snapshot -> duty offset, folded into one matrix at startup
+
+
+def mix(motion):                                #[surge, heave, yaw, pitch, roll] in -1~1 -> duty for thrusters 1~5
+    return np.clip(STOP + MIX @ np.asarray(motion, dtype=float), MIN_DUTY, MAX_DUTY)
+
+def mix_snapshot(axes):                         #Raw snapshot axes -> duty for thrusters 1~5
+    return np.clip(STOP + SNAPSHOT_MIX @ np.asarray(axes, dtype=float), MIN_DUTY, MAX_DUTY)
@@ -0,0 +1,58 @@
+#Read-only console for the ROUV_Pi: connects as an observer and prints the pilot's commands and the ROUV's telemetry
+#Any number of these can watch while the BUOY pilots (see PILOT + OBSERVERS in rouv_pi_continuous.py), none of them
+#can drive. A console that falls behind loses its oldest frames, the pilot never waits for it.
+#Usage: python3 observe.py [host] [seconds]
+import os
+import socket
+import sys
+import time
+import framing
+import protocol
+
+ROUV_PORT = 42069
+QUIET_OPCODES = (protocol.OP_ECHO,)             #Not shown
+
+
+def describe(command):
+    opcode, arg, seq, payload, timestamp = command
+    if opcode == protocol.OP_TELEMETRY and len(payload) >= protocol.TELEMETRY.size:
+        telemetry = protocol.decode_telemetry(payload)
+        flags = [name for name, flag in protocol.TELEMETRY_FLAGS if telemetry[name]]
+        return "TELEMETRY duties=%s temp=%s seq=%d apply=%dus %s" % (
+            "/".join(str(telemetry[channel]) for channel in protocol.TELEMETRY_CHANNELS), telemetry["temp"],
+            telemetry["seq"], telemetry["apply_us"], " ".join(flags))
+    if opcode == protocol.OP_CONTROL:
+        return "In control" if arg == protocol.CONTROL_PILOT else "Observing"
+    return "%s arg=%d seq=%s" % (protocol.OPCODE_NAMES.get(opcode, "UNKNOWN"), arg, seq)
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else os.getenv("ROUV_HOST", "127.0.0.1")
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    s = socket.create_connection((host, ROUV_PORT))
+    s.send(protocol.encode_frame(protocol.OP_SUBSCRIBE))
+    reader = framing.FrameReader(s)
+    deadline = time.monotonic() + seconds if seconds is not None else None
+    frames_seen = 0
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            if deadline is not None:
+                s.settimeout(max(0.001, deadline - time.monotonic()))
+            try:
+                frames = reader.recv_frames()
+            except socket.timeout:
+                break
+            for msg in frames:
+                command = protocol.decode_frame(msg)
+                frames_seen += 1
+                if command is not None and command[0] not in QUIET_OPCODES:
+                    print(describe(command))
+    except KeyboardInterrupt:
+        pass
+    except OSError:
+        print("ROUV closed the connection")
+    finally:
+        s.close()
+    print("%d frames received" % frames_seen)
+
+if __name__ == "__main__":
+    main()
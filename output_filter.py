@@ -0,0 +1,124 @@
+#Current budget and slew limiting for the ROUV_Pi's thruster outputs
+#Sits between the handlers' target duties and the PWM writes (see ActuatorState.commit()). Two limits:
+#- Budget: the T200 current curve (thrust_curve.py) gives each thruster's draw at its target duty. If the five add up
+#  to more than budget_amps, every thruster's offset from STOP is scaled down by the same factor until they fit.
+#- Slew: a thruster speeds up by at most slew_rate us per second, so several thrusters starting at once don't pull
+#  a spike out of the pack. Slowing down, stopping and cutting power (duty 0) are never delayed.
+#While a ramp is still going, ramping is True and the ROUV keeps committing until it's done.
+import time
+import thrust_curve
+
+STOP = thrust_curve.STOP
+SCALE_STEPS = 12                                #Binary search steps for the budget scale, 1/4096 resolution
+
+
+class OutputFilter:
+
+    def __init__(self, pins, budget_amps=40.0, slew_rate=2000.0, tick=0.01):
+        self.pins = frozenset(pins)             #Thruster pins, lights pass straight through
+        self.budget_amps = budget_amps          #None: no budget
+        self.slew_rate = slew_rate              #us per second, None: no ramping
+        self.tick = tick                        #Most ramp time one apply() can use, the ROUV commits this often while ramping
+        self.goals = {}                         #pin -> duty the handlers want
+        self.reached = {}                       #pin -> us from STOP a ramp has reached, fractions kept between commits
+        self.ramping = False
+        self.scale = 1.0                        #Budget scale applied to the goals, 1.0 when within budget
+        self.amps = 0.0                         #Estimated draw of the duties last written
+        self.amp_hours = 0.0                    #Estimated charge used by the thrusters so far
+        self.limited_seconds = 0.0              #Time the budget was holding the thrusters back
+        self.started = time.monotonic()
+        self.last_time = None
+
+    def budget_scale(self, goals):              #Largest factor (<= 1) on every offset from STOP that fits the budget
+        if self.budget_amps is None or sum(thrust_curve.current_for_pwm(duty) for duty in goals.values()) <= self.budget_amps:
+            return 1.0
+        low, high = 0.0, 1.0
+        for i in range(SCALE_STEPS):
+            middle = (low + high) / 2
+            amps = sum(thrust_curve.current_for_pwm(scaled(duty, middle)) for duty in goals.values())
+            if amps <= self.budget_amps:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def step(self, pin, current, goal, dt):     #Duty to write now on the way from current to goal
+        if current is None or not goal or self.slew_rate is None:
+            self.reached.pop(pin, None)
+            return goal                         #First write, power cut, or no ramping
+        offset, goal_offset = (current or STOP) - STOP, goal - STOP
+        if offset * goal_offset >= 0 and abs(goal_offset) <= abs(offset):
+            self.reached.pop(pin, None)
+            return goal                         #Slowing down (or holding) on the same side of STOP
+        if offset * goal_offset < 0:
+            offset = 0                          #Reversing: stop at once, then ramp up the other way
+        reach = abs(offset)
+        reached = self.reached.get(pin)
+        if reached is not None and int(reached) == reach:
+            reach = reached                     #Commits closer together than 1us of ramp still add up
+        reach += self.slew_rate * dt
+        if reach >= abs(goal_offset):
+            self.reached.pop(pin, None)
+            return goal
+        self.reached[pin] = reach
+        return STOP + int(reach) * (1 if goal_offset > 0 else -1)
+
+    def apply(self, target, commanded):         #Target duties -> duties to write now. commanded: what the pins hold.
+        now = time.monotonic()
+        dt = 0.0 if self.last_time is None else now - self.last_time
+        self.last_time = now
+        if self.scale < 1.0:
+            self.limited_seconds += dt
+        self.amp_hours += self.amps * dt / 3600.0
+        out = {}
+        for pin, duty in target.items():
+            if pin in self.pins:
+                self.goals[pin] = duty
+            else:
+                out[pin] = duty
+        self.scale = self.budget_scale(self.goals)
+        self.ramping = False
+        amps = 0.0
+        for pin, goal in self.goals.items():
+            limited = scaled(goal, self.scale)
+            duty = self.step(pin, commanded.get(pin), limited, min(dt, self.tick))     #A command after a quiet spell starts its ramp now
+            if duty != commanded.get(pin) or pin in target:
+                out[pin] = duty
+            if duty != limited:
+                self.ramping = True
+            amps += thrust_curve.current_for_pwm(duty)
+        self.amps = amps
+        return out
+
+    def limited_fraction(self):                 #Share of the time since start the budget was limiting
+        elapsed = time.monotonic() - self.started
+        return self.limited_seconds / elapsed if elapsed > 0 else 0.0
+
+
+def scaled(duty, scale):                        #Offset from STOP scaled, power cut (0) left alone
+    if not duty or scale >= 1.0:
+        return duty
+    return STOP + int((duty - STOP) * scale)
+
+
+def check_ramp_time(goal=1800, rate=10000, slew_rate=2000.0):    #A ramp must take as long at rate commits/s as at ramp_rate
+    pin = 12
+    output_filter = OutputFilter((pin,), None, slew_rate)
+    commanded = {pin: STOP}
+    output_filter.apply(commanded, {})
+    expected = (goal - STOP) / slew_rate
+    start = time.monotonic()
+    deadline = start + expected * 4
+    target = {pin: goal}
+    while commanded[pin] != goal and time.monotonic() < deadline:
+        commanded.update(output_filter.apply(target, commanded))
+        target = {}
+        due = time.monotonic() + 1.0 / rate
+        while time.monotonic() < due:
+            pass
+    took = time.monotonic() - start
+    print("%d -> %d at %d commits/s: %.3fs (expected %.3fs), reached %d" % (STOP, goal, rate, took, expected, commanded[pin]))
+    return commanded[pin] == goal and abs(took - expected) <= expected * 0.2
+
+if __name__ == "__main__":
+    raise SystemExit(0 if check_ramp_time() else 1)
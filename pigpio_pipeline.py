@@ -0,0 +1,103 @@
+#Pipelined client for the pigpio daemon, used by the ROUV_Pi in place of pigpio.pi()
+#pigpio.pi() sends one 16 byte command and waits for its 16 byte reply before the next one, so every call is a
+#full round trip to the daemon. The daemon answers commands on a socket in order, so PipelinedPi queues writes
+#and sends them in one batch on flush(), then reads all the replies together: a five thruster update is one round trip.
+#Writes wait for flush(). Reads flush whatever is queued first, so they always see earlier writes.
+import os
+import socket
+import struct
+import threading
+
+COMMAND = struct.Struct("<IIII")                #cmd, p1, p2, p3 (extension length, always 0 here)
+REPLY = struct.Struct("<IIIi")                  #cmd, p1, p2, result (negative = pigpio error code)
+
+#Daemon command numbers, from pigpio.py
+CMD_MODES = 0
+CMD_READ = 3
+CMD_PWM = 5
+CMD_PRS = 6
+CMD_PFS = 7
+CMD_GDC = 83
+
+INPUT = 0
+OUTPUT = 1
+
+
+class PigpioError(Exception):
+    pass
+
+
+class PipelinedPi:
+
+    def __init__(self, host=None, port=None):
+        host = host or os.getenv("PIGPIO_ADDR") or "localhost"          #Same environment variables as pigpio.pi()
+        port = int(port or os.getenv("PIGPIO_PORT") or 8888)
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.RLock()
+        self.pending = []                       #(cmd, p1, p2) waiting for flush()
+        self.round_trips = 0
+        self.commands = 0
+        self.connected = True
+
+    def queue(self, cmd, p1, p2=0):
+        with self.lock:
+            self.pending.append((cmd, p1, p2))
+
+    def recv_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionResetError("pigpio daemon closed the connection")
+            received += n
+        return data
+
+    def flush(self):                            #Send everything queued in one write, return every result in order
+        with self.lock:
+            if not self.pending:
+                return []
+            batch, self.pending = self.pending, []
+            self.sock.sendall(b"".join(COMMAND.pack(cmd, p1, p2, 0) for cmd, p1, p2 in batch))
+            replies = self.recv_exact(len(batch) * REPLY.size)
+            self.round_trips += 1
+            self.commands += len(batch)
+        results = [reply[3] for reply in REPLY.iter_unpack(replies)]
+        for (cmd, p1, p2), result in zip(batch, results):
+            if result < 0:                      #Only raised once every reply is read, so the stream stays in step
+                raise PigpioError("pigpio command %d (%d, %d) failed with %d" % (cmd, p1, p2, result))
+        return results
+
+    def call(self, cmd, p1, p2=0):              #Flush anything queued, then run one command and return its result
+        with self.lock:
+            self.queue(cmd, p1, p2)
+            return self.flush()[-1]
+
+    #pigpio.pi() compatible subset. Writes are queued until flush().
+    def set_mode(self, gpio, mode):
+        self.queue(CMD_MODES, gpio, mode)
+
+    def set_PWM_frequency(self, user_gpio, frequency):
+        self.queue(CMD_PFS, user_gpio, frequency)
+
+    def set_PWM_range(self, user_gpio, range_):
+        self.queue(CMD_PRS, user_gpio, range_)
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        self.queue(CMD_PWM, user_gpio, int(dutycycle))
+
+    def read(self, gpio):
+        return self.call(CMD_READ, gpio)
+
+    def get_PWM_dutycycle(self, user_gpio):
+        return self.call(CMD_GDC, user_gpio)
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.flush()
+            finally:
+                self.sock.close()
+                self.connected = False
@@ -0,0 +1,246 @@
+#Binary command protocol shared by the BUOY_Pi and ROUV_Pi
+#Every frame on the wire is still prefixed with the 2 byte little endian length used by create_message(),
+#so old and new frames can share the same TCP stream.
+import struct
+import time
+
+#-----------FRAME FORMAT-----------
+#Binary frame: magic, version, opcode, arg (axis/level, signed), sequence number, sender timestamp, then an optional payload.
+#Legacy text frames always start with a printable ASCII character, so the magic byte can never be confused with one.
+#Version 1 frames had no timestamp and are still accepted.
+PROTOCOL_MAGIC = 0xA5
+PROTOCOL_VERSION = 2
+
+LENGTH = struct.Struct("<H")                    #Length prefix, same as create_message()
+HEADER_V1 = struct.Struct("<BBBbH")             #magic, version, opcode, arg, seq
+HEADER = struct.Struct("<BBBbHQ")               #magic, version, opcode, arg, seq, sender's monotonic clock in us
+FRAME = struct.Struct("<HBBBbHQ")               #Length prefix + header, used when there is no payload
+SEQ_MASK = 0xFFFF                               #Sequence numbers wrap at 16 bits
+
+def now_us():                                   #Timestamp carried in every frame. Each Pi has its own clock, see latency.py
+    return time.monotonic_ns() // 1000
+
+#-----------OPCODES-----------
+OP_HELLO = 0x01
+OP_ECHO = 0x02                                  #ROUV -> BUOY, payload: ECHO with the ROUV's send time
+OP_ECHO_REPLY = 0x03                            #BUOY -> ROUV, payload: ECHO_REPLY with the ROUV's send time and the BUOY's clock
+OP_HEARTBEAT = 0x04                             #BUOY -> ROUV at a fixed rate, keeps the ROUV's link watchdog fed
+OP_ACK = 0x05                                   #ROUV -> BUOY over UDP, payload: ACK with the sequence number received
+OP_READY = 0x06                                 #ROUV -> BUOY once its ESCs are armed, the BUOY waits for it before sending commands
+OP_TELEMETRY = 0x07                             #ROUV -> BUOY at a fixed rate and on a leak/overheat, payload: TELEMETRY
+OP_SUBSCRIBE = 0x08                             #Observer -> ROUV instead of HELLO: read-only, gets telemetry and the pilot's commands
+OP_CONTROL = 0x09                               #Either way, arg: CONTROL_* below
+
+OP_PS_PRESS = 0x10                              #Emergency shutdown
+OP_SHARE_PRESS = 0x11
+OP_OPTIONS_PRESS = 0x12
+
+OP_X_PRESS = 0x20
+OP_X_RELEASE = 0x21
+OP_SQUARE_PRESS = 0x22
+OP_SQUARE_RELEASE = 0x23
+OP_CIRCLE_PRESS = 0x24
+OP_CIRCLE_RELEASE = 0x25
+OP_TRIANGLE_PRESS = 0x26
+OP_TRIANGLE_RELEASE = 0x27
+
+OP_UP_ARROW_PRESS = 0x30
+OP_DOWN_ARROW_PRESS = 0x31
+OP_UP_DOWN_ARROW_RELEASE = 0x32
+OP_LEFT_ARROW_PRESS = 0x33
+OP_RIGHT_ARROW_PRESS = 0x34
+OP_LEFT_RIGHT_ARROW_RELEASE = 0x35
+
+OP_L1_PRESS = 0x40
+OP_L1_RELEASE = 0x41
+OP_R1_PRESS = 0x42
+OP_R1_RELEASE = 0x43
+OP_L2_PRESS = 0x44
+OP_L2_RELEASE = 0x45
+OP_R2_PRESS = 0x46
+OP_R2_RELEASE = 0x47
+
+OP_L3_UP = 0x50                                 #arg = level 1~3
+OP_L3_DOWN = 0x51                               #arg = level 1~3
+OP_L3_Y_REST = 0x52
+OP_L3_X_REST = 0x53
+
+OP_SNAPSHOT = 0x60                              #Proportional mode: payload is a SNAPSHOT of every stick and trigger
+
+OPCODE_NAMES = {value: name[3:] for name, value in list(globals().items()) if name.startswith("OP_")}
+
+#-----------SNAPSHOT PAYLOAD-----------
+#Full-resolution controller state for proportional mode, sent at a fixed rate.
+#Sticks are -32767~32767 (UP and LEFT negative, as pyPS4Controller reports them), triggers are 0~32767.
+SNAPSHOT = struct.Struct("<6h")
+AXIS_LX = 0                                     #Left stick, left/right
+AXIS_LY = 1                                     #Left stick, up/down
+AXIS_RX = 2                                     #Right stick, left/right
+AXIS_RY = 3                                     #Right stick, up/down
+AXIS_L2 = 4                                     #L2 trigger
+AXIS_R2 = 5                                     #R2 trigger
+AXIS_COUNT = 6
+AXIS_MAX = 32767
+
+ECHO = struct.Struct("<Q")                      #ROUV send time (us)
+ECHO_REPLY = struct.Struct("<QQ")               #ROUV send time copied from the ECHO, BUOY time when it answered (us)
+
+def encode_snapshot(axes):
+    return SNAPSHOT.pack(*axes)
+
+def decode_snapshot(payload):
+    return SNAPSHOT.unpack_from(payload)
+
+
+#-----------TELEMETRY PAYLOAD-----------
+#Vehicle state sent down the tether, 25 bytes. Duties are in the order of TELEMETRY_CHANNELS (0: not written yet).
+TELEMETRY = struct.Struct("<7HhBHHHH")          #duties, CPU temp (0.1 deg C), flags, last applied seq, apply time (us),
+                                                #hold loop jitter p99 (us), hold loop overruns
+TELEMETRY_CHANNELS = ("thruster1", "thruster2", "thruster3", "thruster4", "thruster5", "left_light", "right_light")
+TELEMETRY_NO_TEMP = -32768                      #No temperature reading yet
+TELEMETRY_LEAK = 0x01                           #Flags
+TELEMETRY_OVERHEAT = 0x02
+TELEMETRY_HOVER = 0x04
+TELEMETRY_PROPORTIONAL = 0x08
+TELEMETRY_FLAGS = (("leak", TELEMETRY_LEAK), ("overheat", TELEMETRY_OVERHEAT), ("hover", TELEMETRY_HOVER),
+                   ("proportional", TELEMETRY_PROPORTIONAL))
+U16_MAX = 0xFFFF
+
+def encode_telemetry(duties, temp, flags, seq, apply_us, hold_jitter_us, hold_overruns):
+    return TELEMETRY.pack(*[duty or 0 for duty in duties],
+                          TELEMETRY_NO_TEMP if temp is None else max(-32767, min(32767, int(round(temp * 10)))),
+                          flags, seq & SEQ_MASK, min(int(apply_us), U16_MAX), min(int(hold_jitter_us), U16_MAX),
+                          hold_overruns & U16_MAX)
+
+def decode_telemetry(payload):                  #dict of the fields, temp in deg C (None if unknown)
+    fields = TELEMETRY.unpack_from(payload)
+    telemetry = dict(zip(TELEMETRY_CHANNELS, fields[:7]))
+    temp, flags, seq, apply_us, hold_jitter_us, hold_overruns = fields[7:]
+    telemetry["temp"] = None if temp == TELEMETRY_NO_TEMP else temp / 10.0
+    for name, flag in TELEMETRY_FLAGS:
+        telemetry[name] = bool(flags & flag)
+    telemetry.update(seq=seq, apply_us=apply_us, hold_jitter_us=hold_jitter_us, hold_overruns=hold_overruns)
+    return telemetry
+
+
+#-----------CONTROL HANDOVER-----------
+#One connection is the pilot, the rest observe. A new connection's HELLO makes it the pilot if there is none, or if
+#the pilot's link has gone quiet (a BUOY reconnecting over a half-open socket). Otherwise it observes.
+CONTROL_RELEASE = 0                             #Pilot -> ROUV: give up control (thrusters stopped, becomes an observer)
+CONTROL_REQUEST = 1                             #Observer -> ROUV: take control if the pilot is gone or has released it
+CONTROL_TAKE = 2                                #Observer -> ROUV: take control from the pilot regardless (surface console override)
+CONTROL_OBSERVER = 0                            #ROUV -> client: you observe
+CONTROL_PILOT = 1                               #ROUV -> client: you are the pilot
+
+
+#-----------UDP DELIVERY-----------
+#Over UDP (see udp_transport.py) each input is its own channel: a frame older than the newest one already
+#applied on its channel is stale and dropped, so a late "L3 up 2" can't undo the stick being released.
+#Toggles and the emergency stop aren't state, applying one twice or not at all changes the outcome,
+#so they are acked and retried instead. Heartbeats, echoes and anything not listed are always applied.
+ACK = struct.Struct("<H")                       #Sequence number being acknowledged
+
+CHANNELS = {
+    OP_X_PRESS: "X", OP_X_RELEASE: "X",
+    OP_SQUARE_PRESS: "SQUARE", OP_SQUARE_RELEASE: "SQUARE",
+    OP_CIRCLE_PRESS: "CIRCLE", OP_CIRCLE_RELEASE: "CIRCLE",
+    OP_UP_ARROW_PRESS: "UP_DOWN", OP_DOWN_ARROW_PRESS: "UP_DOWN", OP_UP_DOWN_ARROW_RELEASE: "UP_DOWN",
+    OP_LEFT_ARROW_PRESS: "LEFT_RIGHT", OP_RIGHT_ARROW_PRESS: "LEFT_RIGHT", OP_LEFT_RIGHT_ARROW_RELEASE: "LEFT_RIGHT",
+    OP_L1_PRESS: "L1", OP_L1_RELEASE: "L1",
+    OP_R1_PRESS: "R1", OP_R1_RELEASE: "R1",
+    OP_L2_PRESS: "L2", OP_L2_RELEASE: "L2",
+    OP_R2_PRESS: "R2", OP_R2_RELEASE: "R2",
+    OP_L3_UP: "L3", OP_L3_DOWN: "L3", OP_L3_Y_REST: "L3", OP_L3_X_REST: "L3",
+    OP_SNAPSHOT: "SNAPSHOT",
+}
+RELIABLE_OPCODES = frozenset((OP_PS_PRESS, OP_SHARE_PRESS, OP_OPTIONS_PRESS, OP_TRIANGLE_PRESS))
+
+def frame_opcode_seq(frame):                    #(opcode, seq) of a binary frame, length prefix included, without decoding it
+    return frame[4], frame[6] | (frame[7] << 8)
+
+#-----------PRIORITY LANE-----------
+#Emergency stops are looked for before anything else in a batch, and the BUOY also sends them as a lone datagram to
+#the ROUV's safety port, ahead of whatever is queued in the stream (see PRIORITY LANE in rouv_pi_continuous.py).
+PRIORITY_OPCODES = frozenset((OP_PS_PRESS,))
+
+
+#-----------LEGACY TEXT FRAMES-----------
+#Text sent by older BUOY scripts through create_message(), mapped to (opcode, arg)
+LEGACY_COMMANDS = {
+    b"Hello World!": (OP_HELLO, 0),
+    b"PS press": (OP_PS_PRESS, 0),
+    b"Share press": (OP_SHARE_PRESS, 0),
+    b"Options press": (OP_OPTIONS_PRESS, 0),
+    b"X press": (OP_X_PRESS, 0),
+    b"X release": (OP_X_RELEASE, 0),
+    b"Square press": (OP_SQUARE_PRESS, 0),
+    b"Square release": (OP_SQUARE_RELEASE, 0),
+    b"Circle press": (OP_CIRCLE_PRESS, 0),
+    b"Circle release": (OP_CIRCLE_RELEASE, 0),
+    b"Triangle press": (OP_TRIANGLE_PRESS, 0),
+    b"Triangle release": (OP_TRIANGLE_RELEASE, 0),
+    b"UpArrow press": (OP_UP_ARROW_PRESS, 0),
+    b"DownArrow press": (OP_DOWN_ARROW_PRESS, 0),
+    b"UpDownArrow release": (OP_UP_DOWN_ARROW_RELEASE, 0),
+    b"LeftArrow press": (OP_LEFT_ARROW_PRESS, 0),
+    b"RightArrow press": (OP_RIGHT_ARROW_PRESS, 0),
+    b"LeftRightArrow release": (OP_LEFT_RIGHT_ARROW_RELEASE, 0),
+    b"L1 press": (OP_L1_PRESS, 0),
+    b"L1 release": (OP_L1_RELEASE, 0),
+    b"R1 press": (OP_R1_PRESS, 0),
+    b"R1 release": (OP_R1_RELEASE, 0),
+    b"L2 press": (OP_L2_PRESS, 0),
+    b"L2 release": (OP_L2_RELEASE, 0),
+    b"R2 press": (OP_R2_PRESS, 0),
+    b"R2 release": (OP_R2_RELEASE, 0),
+    b"L3 up 1": (OP_L3_UP, 1),
+    b"L3 up 2": (OP_L3_UP, 2),
+    b"L3 up 3": (OP_L3_UP, 3),
+    b"L3 down 1": (OP_L3_DOWN, 1),
+    b"L3 down 2": (OP_L3_DOWN, 2),
+    b"L3 down 3": (OP_L3_DOWN, 3),
+    b"L3 y rest": (OP_L3_Y_REST, 0),
+    b"L3 x rest": (OP_L3_X_REST, 0),
+}
+LEGACY_TEXT = {command: text.decode('utf-8') for text, command in LEGACY_COMMANDS.items()}   #(opcode, arg) -> text, for BUOYs talking to an old ROUV
+
+
+#-----------ENCODING-----------
+def encode_frame(opcode, arg=0, seq=0, payload=b"", timestamp=None):   #Fully formatted binary frame, length prefix included
+    if timestamp is None:
+        timestamp = now_us()
+    if not payload:
+        return FRAME.pack(HEADER.size, PROTOCOL_MAGIC, PROTOCOL_VERSION, opcode, arg, seq & SEQ_MASK, timestamp)
+    return (FRAME.pack(HEADER.size + len(payload), PROTOCOL_MAGIC, PROTOCOL_VERSION, opcode, arg, seq & SEQ_MASK, timestamp)
+            + bytes(payload))
+
+def legacy_text(opcode, arg=0):                                         #Text equivalent of a command, None if there is none
+    return LEGACY_TEXT.get((opcode, arg))
+
+
+#-----------DECODING-----------
+#Both decoders take the message without its length prefix and return (opcode, arg, seq, payload, timestamp),
+#or None if the message is not a command this version understands.
+#Legacy frames have no sequence number or timestamp, and version 1 frames have no timestamp (None).
+def decode_frame(msg):
+    if len(msg) >= HEADER_V1.size and msg[0] == PROTOCOL_MAGIC:
+        version = msg[1]
+        if version == PROTOCOL_VERSION and len(msg) >= HEADER.size:
+            magic, version, opcode, arg, seq, timestamp = HEADER.unpack_from(msg)
+            return opcode, arg, seq, msg[HEADER.size:], timestamp
+        if version == 1:
+            magic, version, opcode, arg, seq = HEADER_V1.unpack_from(msg)
+            return opcode, arg, seq, msg[HEADER_V1.size:], None
+        return None
+    return decode_legacy(msg)
+
+def message_opcode(msg):                        #Opcode of a binary frame without decoding it, None for legacy text
+    if len(msg) >= HEADER_V1.size and msg[0] == PROTOCOL_MAGIC:
+        return msg[2]
+    return None
+
+def decode_legacy(msg):
+    command = LEGACY_COMMANDS.get(bytes(msg).strip())                   #Exact lookup instead of a substring scan per command
+    if command is None:
+        return None
+    return command[0], command[1], None, b"", None
@@ -0,0 +1,111 @@
+#Replays a recorded pilot session (see session.py) through the real BUOY and ROUV code on this machine
+#The BUOY's MyController gets the recorded callbacks on the simulated controller backend, and its frames go over a
+#loopback TCP connection to the ROUV's asyncio runtime on the simulated hardware backend. Reports commands applied
+#per second, the ROUV's per-command latency, and writes the thruster/light duty trace so runs can be diffed.
+#Usage: python3 replay.py session.rses [speed] [trace.tsv]
+#speed: 1 = real time (default), 10 = ten times faster, 0 = as fast as possible
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+os.environ["BUOY_BACKEND"] = "sim"              #Before the BUOY script picks its controller
+import buoy_pi_continuous as buoy
+import protocol
+import rouv_pi_continuous as rouv
+import session
+
+NOT_COMMANDS = ("HEARTBEAT", "ECHO_REPLY", "HELLO")     #Frames that aren't the pilot's
+
+
+def tcp_pair():
+    server = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(server.getsockname())
+    accepted, addr = server.accept()
+    server.close()
+    return client, accepted
+
+def counted(metrics, name):                     #command -> count, from a Metrics counter labelled by command
+    return {dict(labels)["command"]: value for (counter, labels), value in list(metrics.counters.items()) if counter == name}
+
+def commands(counts):
+    return sum(value for command, value in counts.items() if command not in NOT_COMMANDS)
+
+def applied_commands():                         #Pilot frames the ROUV acted on, one pwm latency sample each (not the ones dropped)
+    return sum(count for command, stage, count, p50, p99, worst in rouv.latency.summary()
+               if stage == "pwm" and command not in NOT_COMMANDS)
+
+def start_rouv(sock):                           #ROUV runtime on its own loop and thread, returns a function that stops it
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(rouv.run(sock))
+
+    def serve():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=serve, name="rouv", daemon=True)
+    thread.start()
+
+    def stop():
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+    return stop
+
+def replay(events, speed):                      #Returns (seconds taken, duty trace)
+    sim = rouv.setup_hardware("sim")
+    for pin in rouv.thrusters:                  #Same starting point as main()
+        rouv.set_duty(pin, 1500)
+    rouv.set_duty(rouv.left_light, 1100)
+    rouv.set_duty(rouv.right_light, 1100)
+    rouv.commit_outputs()
+    sim.take_trace()
+    rouv.autopilot.start()                      #Triangle holds depth/heading/pitch on the simulated vehicle, as in main()
+    buoy_sock, rouv_sock = tcp_pair()
+    stop_rouv = start_rouv(rouv_sock)
+    buoy_sock.send(buoy.create_command(protocol.OP_HELLO))
+    controller = buoy.MyController(buoy_sock, interface=None, events=events)
+    start = time.monotonic()
+    controller.listen(speed=speed)
+    controller.coalescer.stop()                 #Sends anything still pending, heartbeats carry on until close()
+    sent = commands(counted(buoy.metrics, "buoy_frames_sent_total"))
+    deadline = time.monotonic() + 5.0
+    while commands(counted(rouv.metrics, "rouv_frames_received_total")) < sent and time.monotonic() < deadline:
+        time.sleep(0.001)
+    elapsed = time.monotonic() - start
+    while rouv.output_filter.ramping and time.monotonic() < deadline:     #Last thruster ramps finishing
+        time.sleep(0.001)
+    controller.close()
+    trace = [(when - start, pin, duty) for when, pin, duty in sim.take_trace()]
+    stop_rouv()
+    rouv.stop_hold_loop()
+    buoy_sock.close()
+    rouv_sock.close()
+    return elapsed, trace
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python3 replay.py session.rses [speed] [trace.tsv]")
+        return
+    events = session.read_session(sys.argv[1])
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    elapsed, trace = replay(events, speed)
+    applied = applied_commands()
+    recorded = events[-1][0] if events else 0.0
+    print("%d controller events (%.1fs recorded) replayed at %s in %.2fs" %
+          (len(events), recorded, "%gx" % speed if speed else "full speed", elapsed))
+    print("%d commands applied, %.0f commands/s, %d duty changes" % (applied, applied / elapsed if elapsed else 0.0, len(trace)))
+    print(rouv.latency.report())
+    print("Final state: " + ", ".join("%s %d" % (rouv.channel_names[pin], rouv.actuators.commanded[pin]) for pin in rouv.channel_names))
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], "w") as f:       #channel, duty, ms since the replay started. diff on the first two columns.
+            for when, pin, duty in trace:
+                f.write("%s\t%d\t%.3f\n" % (rouv.channel_names[pin], duty, when * 1000))
+        print("Trace written to " + sys.argv[3])
+
+if __name__ == "__main__":
+    main()
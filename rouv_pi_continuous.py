@@ -1,10 +1,26 @@
 #Continuous Listening Mode
+import asyncio
+import concurrent.futures
+import os
 import socket
 import struct
-import pigpio
 import time
-import os
 import math
+import protocol
+import framing
+import hal
+import mixer
+import thrust_curve
+import udp_transport
+from actuators import ActuatorState
+from actuator_process import ActuatorProcess
+from autopilot import Autopilot
+from fanout import Fanout
+from output_filter import OutputFilter
+from latency import Histogram, LatencyTracker
+from link_watchdog import LinkWatchdog
+from buffered_log import BufferedLog
+from metrics import Metrics
 
 ROUV_ADDRESS = ('', 42069)                 
 
@@ -26,28 +42,84 @@ ROUV_ADDRESS = ('', 42069)
 #Level 3: Input value between +/- 201 and 327
 
 #-----------CONSTANTS-----------
+started_at = time.monotonic()                   #Process start, for the cold start metrics
 overheat = False                                #Assume temp is under 75 deg C
 leak_detected = False                           #Assume there is no leak present
 left_light_on = False                           #Left light initially off
 right_light_on = False                          #Right light initially off
 hover_on = False                                #Hovering initially off
+proportional_mode = False                       #Switched on by the first stick snapshot from the BUOY, off again by a new Hello
+#_14 values come from the T200 thrust tables (see thrust_curve.py), so thrusters 1 & 4 match the others' thrust
 up_speed = 1600                                 #Setting baseline upward speed to 16% DC
-up_speed_14 = 1386                              #Baseline upward speed for thrusters 1 & 4
+up_speed_14 = thrust_curve.matching_pwm(up_speed)       #Baseline upward speed for thrusters 1 & 4 (1386)
 down_speed = 1400                               #Setting baseline downward speed to 14% DC
-down_speed_14 = 1588                            #Baseline upward speed for thrusters 1 & 4
+down_speed_14 = thrust_curve.matching_pwm(down_speed)   #Baseline downward speed for thrusters 1 & 4 (1588)
 
 fwd_1 = 1600                                    #Joystick forward level 1 is 16% DC
-fwd_1_14 = 1386                                 #fwd_1 for thrusters 1 & 4
+fwd_1_14 = thrust_curve.matching_pwm(fwd_1)     #fwd_1 for thrusters 1 & 4 (1386)
 fwd_2 = 1700                                    #Joystick forward level 2 is 17% DC
-fwd_2_14 = 1268                                 #fwd_2 for thrusters 1 & 4
+fwd_2_14 = thrust_curve.matching_pwm(fwd_2)     #fwd_2 for thrusters 1 & 4 (1268)
 fwd_3 = 1800                                    #Joystick forward level 3 is 18% DC
-fwd_3_14 = 1148                                 #fwd_3 for thrusters 1 & 4
+fwd_3_14 = thrust_curve.matching_pwm(fwd_3)     #fwd_3 for thrusters 1 & 4 (1148)
 rev_1 = 1400                                    #Joystick reverse level 1 is 14% DC
-rev_1_14 = 1588                                 #rev_1 for thrusters 1 & 4
+rev_1_14 = thrust_curve.matching_pwm(rev_1)     #rev_1 for thrusters 1 & 4 (1588)
 rev_2 = 1300                                    #Joystick reverse level 2 is 13% DC
-rev_2_14 = 1672                                 #rev_2 for thrusters 1 & 4
+rev_2_14 = thrust_curve.matching_pwm(rev_2)     #rev_2 for thrusters 1 & 4 (1672)
 rev_3 = 1200                                    #Joystick reverse level 3 is 12% DC
-rev_3_14 = 1764                                 #rev_3 for thrusters 1 & 4
+rev_3_14 = thrust_curve.matching_pwm(rev_3)     #rev_3 for thrusters 1 & 4 (1764)
+
+hover_2 = 1586                                  #Hover duty for thruster 2
+hover_1 = thrust_curve.matching_pwm(hover_2)    #Same thrust on thruster 1 (1402)
+hover_3 = 1618                                  #Hover duty for thruster 3 (center vertical)
+hover_heave = (hover_3 - mixer.STOP) / mixer.SPAN       #Same lift as a motion vector, where the depth hold starts from
+
+rise_2 = 1682                                   #Up arrow, thruster 2
+rise_1 = thrust_curve.matching_pwm(rise_2)      #Same thrust on thruster 1 (1289)
+rise_3 = 1760                                   #Up arrow, thruster 3 (center vertical)
+sink_2 = 1358                                   #Down arrow, thruster 2
+sink_1 = thrust_curve.matching_pwm(sink_2)      #Same thrust on thruster 1 (1626)
+sink_3 = 1300                                   #Down arrow, thruster 3 (center vertical)
+single_speed = 1652                             #X and Circle run thruster 3 or 5 alone at this
+single_speed_14 = thrust_curve.matching_pwm(single_speed)   #Square runs thruster 4 alone at the same thrust (1327)
+roll_speed = 1600                               #Left/right arrows, one offset thruster
+roll_speed_14 = thrust_curve.matching_pwm(roll_speed)       #roll_speed for thruster 1 (1386)
+turn_speed = 1700                               #L1/R1, offset thrusters
+turn_speed_14 = thrust_curve.matching_pwm(turn_speed)       #turn_speed matched the other way round (1268)
+turn_rear = 1600                                #L1/R1, rear thruster
+turn_rear_14 = thrust_curve.matching_pwm(turn_rear)         #turn_rear for thruster 4 (1386)
+hold_rate = 100                                 #Hz, depth/heading/pitch hold loop (see autopilot.py)
+
+overheat_temp = 75                              #deg C, thrusters are cut above this
+temp_sample_period = 1.0                        #Seconds between CPU temp samples
+safety_rate = 20                                #Hz, leak pin + temp checks, whether or not commands are arriving
+output_rate = 1                                 #Hz, status output
+metrics_port = int(os.getenv("ROUV_METRICS_PORT", "9420"))     #Prometheus-style text on http://127.0.0.1:9420/metrics
+verify_period = 5.0                             #Seconds between hardware read-backs of the duty cache
+hardware_backend = os.getenv("ROUV_BACKEND", "pigpio")     #"pigpio" on the ROUV, "sim" to run anywhere without hardware (see hal.py)
+pipelined_pigpio = True                         #Batch pigpio commands into one daemon round trip (False: plain pigpio.pi())
+actuator_process = os.getenv("ROUV_ACTUATOR_PROCESS") == "1"     #PWM writes, budget and ramps in their own process (see actuator_process.py)
+actuator_cpu = 3                                #Core the actuator process is pinned to (the Pi 4 has 0~3), None: any core
+actuator_priority = 50                          #SCHED_FIFO priority of the actuator process (needs root), None: normal scheduling
+echo_rate = 1                                   #Hz, clock offset echoes to the BUOY for latency tracing
+link_timeout = 0.08                             #Seconds without a frame before thrusters are stopped (4 BUOY heartbeats, every 0.02s)
+watchdog_rate = 200                             #Hz, link watchdog checks
+use_udp = False                                 #UDP datagrams instead of the TCP stream, same port. Must match the BUOY's USE_UDP.
+esc_arm_time = 10.0                             #Seconds of STOP signal the ESCs need before they take commands
+esc_armed_at = None                             #time.monotonic() the ESCs will be armed, set by main() (None: don't wait)
+first_command_at = None                         #time.monotonic() the first pilot command was applied
+current_budget = 40.0                           #Amps, most the five thrusters may draw together (None: no limit)
+slew_rate = 2000                                #us per second a thruster may speed up by, 1500 -> 1800 takes 0.15s (None: no ramps)
+ramp_rate = 100                                 #Hz, output commits while a ramp is in progress
+telemetry_rate = 10                             #Hz, vehicle state frames to the BUOY (see protocol.TELEMETRY)
+last_seq = 0                                    #Sequence number of the last command applied, reported in telemetry
+last_apply_us = 0                               #Receive to PWM written for the last batch of frames
+pilot_link = None                               #BuoyLink of the connection in control, None when nobody is
+max_clients = 8                                 #Pilot + observers connected at once, more are turned away
+observer_queue = 64                             #Frames an observer may fall behind by before its oldest are dropped
+priority_lane = True                            #Emergency stops and leaks jump queued commands (see PRIORITY LANE)
+safety_port = 42070                             #UDP, the BUOY's out-of-band emergency stops. Must match the BUOY's SAFETY_PORT.
+stop_requested = None                           #(reason, BUOY timestamp, received at) of a stop not applied yet
+stop_barrier = None                             #BUOY timestamp of the last stop: the pilot's frames sent before it are dropped
 
 #-----------PIN DEFINITIONS-----------
 thrust1 = 12                                    #Thruster 1 (left offset) using pin 26 (SOFTWARE PWM)
@@ -58,43 +130,107 @@ thrust5 = 18                                    #Thruster 5 (right rear) using p
 left_light = 27                                 #Left light using pin 22 (SOFWTWARE PWM)
 right_light = 17                                #Right light using pin 17 (SOFTWARE PWM)
 leak_sensor = 23
+thrusters = (thrust1, thrust2, thrust3, thrust4, thrust5)      #In mixer order
+
+#-----------HARDWARE SETUP-----------
+#Nothing touches the hardware until main() calls setup_hardware(), so this file can be imported anywhere.
+pi1 = None                                      #Hardware backend, pigpio or simulated
+actuators = None                                #Commanded duty for all seven channels (see OUTPUT STATE)
+output_filter = None                            #Current budget and slew limits on the thrusters, applied by actuators.commit()
+thermal_monitor = None                          #Samples the CPU temp in the background, started in main()
+autopilot = None                                #Closed-loop hold, None without an IMU and depth sensor (Triangle hovers open-loop)
+output_stage = None                             #ActuatorProcess writing the PWM outputs, None: written from this process
+
+def setup_hardware(backend=None):
+    global pi1, actuators, output_filter, thermal_monitor, autopilot, output_stage
+    pi1 = hal.open_backend(backend or hardware_backend, pipelined_pigpio)
+    for pin in thrusters + (left_light, right_light):
+        pi1.setup_output(pin, 100, 9999)        #100Hz = 1/100s period = 0.01s = 10,000us, range 0-9999 instead of 0-255
+                                                #so thrusters and lights are accurate to 0.01% DC. 15% DC is STOP,
+                                                #PWM DC should be set to 0 or between 1100 and 1900
+    pi1.setup_input(leak_sensor)
+    if priority_lane:
+        pi1.watch_input(leak_sensor, leak_edge) #Thrust is cut on the edge, safety_tick() still polls the pin as well
+    if pi1.flush is not None:
+        pi1.flush()                             #All 22 setup commands go out in one round trip
+    if actuator_process:                        #The sim backend's duties then live in the other process, so no simulated vehicle
+        output_stage = ActuatorProcess(backend or hardware_backend, channel_names, thrusters, current_budget, slew_rate,
+                                       ramp_rate, actuator_cpu, actuator_priority, verify_period, pipelined_pigpio).start()
+        output_filter = output_stage.status     #Budget and ramps are applied over there
+        actuators = ActuatorState(output_stage.output, channel_names, verify_period)
+    else:
+        output_filter = OutputFilter(thrusters, current_budget, slew_rate, 1.0 / ramp_rate)
+        actuators = ActuatorState(pi1, channel_names, verify_period, output_filter)
+    thermal_monitor = pi1.thermal_monitor(temp_sample_period)
+    sensors = pi1.motion_sensors(thrusters)
+    autopilot = Autopilot(sensors, queue_hold_output, hold_rate, hover_heave) if sensors is not None else None
+    return pi1
+
+#-----------LOGGING + METRICS-----------
+log = BufferedLog(sample_every={"frame": 10, "readback": 5})    #Written by a background thread, never on the control path
+metrics = Metrics()
+channel_names = {thrust1: "thruster1", thrust2: "thruster2", thrust3: "thruster3", thrust4: "thruster4",
+                 thrust5: "thruster5", left_light: "left_light", right_light: "right_light"}
+metrics.describe("rouv_frames_received_total", "Frames received from the BUOY, by command")
+metrics.describe("rouv_duty", "Last commanded duty cycle, by channel")
+metrics.describe("rouv_first_command_seconds", "Seconds from boot / process start to the first pilot command applied")
+metrics.describe("rouv_ready_seconds", "Seconds from process start to the last READY sent to the BUOY")
+metrics.gauge_function("rouv_cpu_temp_celsius", lambda: thermal_monitor.current_temp())
+metrics.gauge_function("rouv_leak_detected", lambda: int(leak_detected))
+metrics.gauge_function("rouv_hover_on", lambda: int(hover_on))
+metrics.gauge_function("rouv_proportional_mode", lambda: int(proportional_mode))
+metrics.gauge_function("rouv_queue_depth", log.depth, queue="log")
+metrics.gauge_function("rouv_queue_depth", lambda: pilot_link.reader.pending() if pilot_link is not None else 0, queue="rx_bytes")
+latency = LatencyTracker()                                      #BUOY event -> PWM write, per command (see latency.py)
+metrics.describe("rouv_latency_us", "BUOY send to PWM write latency by command and stage, microseconds")
+metrics.collector(latency.samples)
+metrics.describe("rouv_hold_loop_us", "Hold loop tick lateness (jitter) and tick time, microseconds")
+metrics.collector(lambda: autopilot.samples() if autopilot is not None else ())
+metrics.describe("rouv_actuator_late_us", "Actuator process tick lateness, microseconds")
+metrics.collector(lambda: output_stage.status.samples() if output_stage is not None else ())
+
+#-----------OUTPUT STATE-----------
+metrics.gauge_function("rouv_daemon_calls_saved", lambda: actuators.calls_saved())
+metrics.gauge_function("rouv_daemon_writes", lambda: actuators.writes)
+metrics.gauge_function("rouv_duty_mismatches", lambda: actuators.mismatches)
+metrics.describe("rouv_current_estimate_amps", "Thruster current estimated from the duties written (T200 curve)")
+metrics.gauge_function("rouv_current_estimate_amps", lambda: output_filter.amps)
+metrics.gauge_function("rouv_budget_scale", lambda: output_filter.scale)
+metrics.gauge_function("rouv_budget_limited_fraction", lambda: output_filter.limited_fraction())
+metrics.gauge_function("rouv_thruster_amp_hours", lambda: output_filter.amp_hours)
 
-#-----------PIGPIO SETUP-----------
-pi1 = pigpio.pi()
-#Set mode for each pin:
-pi1.set_mode(thrust1, pigpio.OUTPUT)
-pi1.set_mode(thrust2, pigpio.OUTPUT)
-pi1.set_mode(thrust3, pigpio.OUTPUT)
-pi1.set_mode(thrust4, pigpio.OUTPUT)
-pi1.set_mode(thrust5, pigpio.OUTPUT)
-pi1.set_mode(left_light, pigpio.OUTPUT)
-pi1.set_mode(right_light, pigpio.OUTPUT)
-pi1.set_mode(leak_sensor, pigpio.INPUT)
-
-#Set frequency for each pin:
-pi1.set_PWM_frequency(thrust1, 100)             #100Hz = 1/100s period = 0.01s = 10,000us
-pi1.set_PWM_frequency(thrust2, 100)             #This enables full control of thrusters and lights between 11% and 19% DC
-pi1.set_PWM_frequency(thrust3, 100)             #with 15% DC being the STOP signal for the thrusters
-pi1.set_PWM_frequency(thrust4, 100)
-pi1.set_PWM_frequency(thrust5, 100)
-pi1.set_PWM_frequency(left_light, 100)
-pi1.set_PWM_frequency(right_light, 100)
-
-#Set range for each pin:
-pi1.set_PWM_range(thrust1, 9999)                  #Scaling the range to 0-9999 (instead of 0-255)
-pi1.set_PWM_range(thrust2, 9999)                  #This enables control of thrusters accurate to 0.01% DC
-pi1.set_PWM_range(thrust3, 9999)                  #PWM DC should be set to 0 or between 1100 and 1900
-pi1.set_PWM_range(thrust4, 9999)
-pi1.set_PWM_range(thrust5, 9999)
-pi1.set_PWM_range(left_light, 9999)
-pi1.set_PWM_range(right_light, 9999)
+def set_duty(pin, duty):                                        #Takes effect at the next commit_outputs()
+    actuators.set(pin, duty)
+
+def commit_outputs(force=False):                                #Send only the channels that changed
+    for pin in actuators.commit(force):
+        metrics.set("rouv_duty", actuators.commanded[pin], channel=channel_names[pin])
+    if force and output_stage is not None:
+        output_stage.drain()                                    #Power cuts: wait until the actuator process has written them
+
+def local_outputs():                                            #Actuator process died: write the pins from here again, thrusters stopped
+    global actuators, output_filter, output_stage
+    log.write("safety", "Actuator process died, writing outputs from the network process")
+    commanded = actuators.commanded
+    output_stage.stop()                                         #Frees the ring
+    output_stage = None
+    output_filter = OutputFilter(thrusters, current_budget, slew_rate, 1.0 / ramp_rate)
+    actuators = ActuatorState(pi1, channel_names, verify_period, output_filter)
+    actuators.set_frame({pin: duty for pin, duty in commanded.items() if duty is not None})
+    actuators.set_frame(dict.fromkeys(thrusters, 1500))
+    commit_outputs(force=True)
+
+def ramp_outputs(seconds):                                      #Outside the event loop: keep committing so slew ramps finish
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        commit_outputs()
+        time.sleep(1.0 / ramp_rate)
 
 #-----------MISC. FUNCTIONS-----------
 def check_temp():
     global overheat
-    temp_read = os.popen('vcgencmd measure_temp').readline()
-    cpu_temp = float(temp_read.replace("temp=","").replace("'C\n", ""))
-    if (cpu_temp > 75):
+    cpu_temp = thermal_monitor.current_temp()           #Cached value, no process is forked
+    if (cpu_temp is not None and cpu_temp > overheat_temp):
         overheat = True
         
 def check_leak():
@@ -103,17 +239,156 @@ def check_leak():
         leak_detected = True
 
 def hover():
-    print("Hovering")
-    pi1.set_PWM_dutycycle(thrust1, 1402)
-    pi1.set_PWM_dutycycle(thrust2, 1586)
-    pi1.set_PWM_dutycycle(thrust3, 1618)
-    pi1.set_PWM_dutycycle(thrust4, 1500)
-    pi1.set_PWM_dutycycle(thrust5, 1500)
-    print("Thruster 1: " + str(pi1.get_PWM_dutycycle(thrust1)))
-    print("Thruster 2: " + str(pi1.get_PWM_dutycycle(thrust2)))
-    print("Thruster 3: " + str(pi1.get_PWM_dutycycle(thrust3)))
-    print("Thruster 4: " + str(pi1.get_PWM_dutycycle(thrust4)))
-    print("Thruster 5: " + str(pi1.get_PWM_dutycycle(thrust5)))        
+    log.write("cmd", "Hovering")
+    set_duty(thrust1, hover_1)
+    set_duty(thrust2, hover_2)
+    set_duty(thrust3, hover_3)
+    set_duty(thrust4, 1500)
+    set_duty(thrust5, 1500)
+    log.write("readback", "Thruster 1", duty=actuators.get(thrust1))
+    log.write("readback", "Thruster 2", duty=actuators.get(thrust2))
+    log.write("readback", "Thruster 3", duty=actuators.get(thrust3))
+    log.write("readback", "Thruster 4", duty=actuators.get(thrust4))
+    log.write("readback", "Thruster 5", duty=actuators.get(thrust5))
+        
+def engage_hold():                                              #Triangle: closed-loop hold if there are sensors, else the fixed hover duties
+    global hover_on
+    hover_on = True
+    if autopilot is None:
+        hover()
+        return
+    log.write("cmd", "Holding depth, heading and pitch")
+    autopilot.engage()
+
+def release_hold():                                             #Thrusters are left where they are, callers set them next
+    global hover_on
+    hover_on = False
+    if autopilot is not None:
+        autopilot.disengage()
+
+def holding():                                                  #Hold loop owns the thrusters
+    return hover_on and autopilot is not None
+
+def stop_hold_loop():                                           #Shutting down: nothing may write the thrusters behind our back
+    release_hold()
+    if autopilot is not None:
+        autopilot.stop()
+
+def queue_hold_output(motion):                                  #On the autopilot thread: duties are written on the output thread, in order with commands
+    output_executor.submit(apply_hold_output, motion)
+
+def apply_hold_output(motion):
+    if not hover_on:                                            #Released since this was queued
+        return
+    for thruster, duty in zip(thrusters, mixer.mix(motion)):
+        set_duty(thruster, int(duty))
+    commit_outputs()
+
+def link_lost(reason, silent):                                  #Link watchdog tripped: don't keep running on the last command
+    if holding():                                               #Keep holding depth/heading/pitch, but drop the pilot's surge
+        autopilot.surge = 0.0
+    stop_thrusters(*thrusters)                                  #STOP, or hover if hovering
+    commit_outputs()
+    metrics.inc("rouv_link_losses_total", reason=reason)
+    metrics.set("rouv_link_detection_seconds", silent)
+    log.write("safety", "Link lost, failsafe applied", reason=reason, silent_ms=round(silent * 1000, 1))
+
+link_watchdog = LinkWatchdog(link_timeout, link_lost)           #Fed by every frame, see ingest_task()
+metrics.gauge_function("rouv_link_silent_seconds", link_watchdog.silent_for)
+
+#-----------PRIORITY LANE-----------
+#An emergency stop must not wait behind the joystick updates queued ahead of it. A stop comes from the PS button,
+#either as a datagram on safety_port (sent by the BUOY before the same press goes down the stream) or as a PS frame
+#spotted in a batch before it is dispatched, or from the leak pin's edge callback. request_stop() flags it from any
+#thread. handle_frames() checks the flag before every frame and applies the stop there and then, or the output
+#thread picks it up next if it is idle. The pilot's frames sent before the stop are then dropped (stop_barrier),
+#so a backlog of older commands can't power the thrusters back up. Stop latency is kept per reason.
+stop_latency = {}                                               #Reason -> Histogram, stop received -> outputs written, us
+
+def stop_samples():                                             #For the metrics endpoint
+    for reason, histogram in list(stop_latency.items()):
+        for quantile, fraction in (("0.5", 0.5), ("0.99", 0.99), ("1", 1.0)):
+            yield "rouv_stop_latency_us", {"reason": reason, "quantile": quantile}, histogram.percentile(fraction)
+
+metrics.describe("rouv_stop_latency_us", "Emergency stop or leak received to outputs written, microseconds")
+metrics.collector(stop_samples)
+metrics.describe("rouv_frames_superseded_total", "Pilot frames dropped because they were sent before an emergency stop")
+
+def request_stop(reason, sent_at=None, received_at=None):       #Any thread. sent_at: the BUOY's timestamp of the stop.
+    global stop_requested, stop_barrier
+    if sent_at is not None and (stop_barrier is None or sent_at > stop_barrier):
+        stop_barrier = sent_at
+    stop_requested = (reason, sent_at, received_at or protocol.now_us())
+    output_executor.submit(apply_stop)                          #Only waits for the batch in progress, which checks the flag
+
+def apply_stop():                                               #Output thread
+    global stop_requested
+    request = stop_requested
+    if request is None:                                         #Applied from handle_frames() already
+        return
+    stop_requested = None
+    reason, sent_at, received_at = request
+    if reason == "leak":
+        release_hold()
+        for thruster in thrusters:                              #Cut thrust, main() surfaces once safety_tick() raises
+            set_duty(thruster, 1500)
+    else:
+        handle_ps_press(0, b"")
+    commit_outputs(force=True)
+    histogram = stop_latency.get(reason)
+    if histogram is None:
+        histogram = stop_latency[reason] = Histogram()
+    histogram.add(protocol.now_us() - received_at)
+    metrics.inc("rouv_priority_stops_total", reason=reason)
+    log.write("safety", "Priority stop applied", reason=reason)
+
+def superseded(timestamp):                                      #Pilot frame sent before the last stop (or any frame after a leak)
+    global stop_barrier
+    if leak_detected:
+        return True
+    if stop_barrier is None or timestamp is None:               #Legacy text frames carry no timestamp
+        return False
+    if timestamp < stop_barrier:
+        return True
+    stop_barrier = None                                         #Caught up with the stop, the rest are newer
+    return False
+
+def priority_frames(frames, received_at):                       #A PS frame anywhere in the batch is applied before the others
+    for msg in reversed(frames):
+        if protocol.message_opcode(msg) in protocol.PRIORITY_OPCODES:
+            command = protocol.decode_frame(msg)
+            if command is None:                                 #Malformed, handle_message() counts it as UNKNOWN
+                continue
+            request_stop("estop", command[4], received_at)
+            return
+
+def leak_edge():                                                #pigpio's callback thread, as soon as the leak pin goes high
+    global leak_detected
+    leak_detected = True
+    request_stop("leak")
+
+def pilot_host():                                               #Stops from the pilot's machine share its clock, so they set the barrier
+    link = pilot_link
+    if link is None:
+        return None
+    if use_udp:
+        return link.reader.peer[0] if link.reader.peer else None
+    try:
+        return link.sock.getpeername()[0]
+    except OSError:
+        return None
+
+async def safety_task(sock):                                    #Out-of-band stops, whoever sends them and whatever is queued
+    loop = asyncio.get_running_loop()
+    sock.setblocking(False)
+    while True:
+        data, addr = await loop.sock_recvfrom(sock, 64)
+        received_at = protocol.now_us()
+        for msg in udp_transport.split_frames(data):
+            command = protocol.decode_frame(msg)
+            if command is not None and command[0] in protocol.PRIORITY_OPCODES:
+                request_stop("estop", command[4] if addr[0] == pilot_host() else None, received_at)
+                break
         
 class LeakDetectedException(Exception):
     pass
@@ -126,288 +401,670 @@ def create_message(text):
     return struct.pack("<H", len(text)) + bytes(text, 'utf-8')      #Struct is a bytes object. "<H" is for formatting (< for little endian, H denotes short). 
                                                                     #This function provides the fully formatted message.
 
-def recv_all(socket, packet_size):                                  #Receive until all bytes have been accounted for.
-    data = bytes()
-    while len(data) < packet_size:
-        data += socket.recv(packet_size - len(data))
-    return data
-
-def handle_client(csock):
-    packet_len = csock.recv(2)                                      #Receive 2 bytes of data. First two bytes of every packet will contain packet length.
-    print(int.from_bytes(packet_len, "little"))                     #Print number of bytes of message
-    msg = recv_all(csock, int.from_bytes(packet_len, "little"))     #Little endian, most significant bit on the right
-    print(msg)
-    
-    #Controller inputs & their respective functions
-    if (bytes("PS press", 'utf-8') in msg):                                         #Emergency shutdown
-        pi1.set_PWM_dutycycle(thrust1, 0)                                           #Cut power to everything
-        pi1.set_PWM_dutycycle(thrust2, 0)
-        pi1.set_PWM_dutycycle(thrust3, 0)
-        pi1.set_PWM_dutycycle(thrust4, 0)
-        pi1.set_PWM_dutycycle(thrust5, 0)
-        pi1.set_PWM_dutycycle(left_light, 0)
-        pi1.set_PWM_dutycycle(right_light, 0)
-        print("Emergency shutdown")
-        print("Thruster 1: " + str(pi1.get_PWM_dutycycle(thrust1)))                 #Confirm power is 0
-        print("Thruster 2: " + str(pi1.get_PWM_dutycycle(thrust2)))
-        print("Thruster 3: " + str(pi1.get_PWM_dutycycle(thrust3)))
-        print("Thruster 4: " + str(pi1.get_PWM_dutycycle(thrust4)))
-        print("Thruster 5: " + str(pi1.get_PWM_dutycycle(thrust5)))
-        print("Left Light: " + str(pi1.get_PWM_dutycycle(left_light)))
-        print("Right Light: " + str(pi1.get_PWM_dutycycle(right_light)))
+def telemetry_payload():                                            #Current vehicle state, see protocol.TELEMETRY
+    flags = ((protocol.TELEMETRY_LEAK if leak_detected else 0) | (protocol.TELEMETRY_OVERHEAT if overheat else 0) |
+             (protocol.TELEMETRY_HOVER if hover_on else 0) | (protocol.TELEMETRY_PROPORTIONAL if proportional_mode else 0))
+    jitter = autopilot.jitter.percentile(0.99) if autopilot is not None and autopilot.ticks else 0
+    return protocol.encode_telemetry([actuators.commanded[pin] for pin in thrusters + (left_light, right_light)],
+                                     thermal_monitor.current_temp(), flags, last_seq, last_apply_us, jitter,
+                                     autopilot.overruns if autopilot is not None else 0)
 
-    elif(bytes("X press", 'utf-8') in msg):
-        print("Running thruster 3 only")
-        pi1.set_PWM_dutycycle(thrust3, 1652)
-        print("Thruster 3: " + str(pi1.get_PWM_dutycycle(thrust3)))
-        
-    elif(bytes("X release", 'utf-8') in msg):
-        print("Stopping thruster 3 only")
-        pi1.set_PWM_dutycycle(thrust3, 1500)
-        
-    elif(bytes("Square press", 'utf-8') in msg):
-        print("Running thruster 4 only")
-        pi1.set_PWM_dutycycle(thrust4, 1324)
-        print("Thruster 4: " + str(pi1.get_PWM_dutycycle(thrust4)))
-    
-    elif(bytes("Square release", 'utf-8') in msg):
-        print("Stopping thruster 4 only")
-        pi1.set_PWM_dutycycle(thrust4, 1500)
-        
-    elif(bytes("Circle press", 'utf-8') in msg):
-        print("Running thruster 5 only")
-        pi1.set_PWM_dutycycle(thrust5, 1652)
-        print("Thruster 5: " + str(pi1.get_PWM_dutycycle(thrust5)))
-    
-    elif(bytes("Circle release", 'utf-8') in msg):
-        print("Stopping thruster 5 only")
-        pi1.set_PWM_dutycycle(thrust5, 1500)
-
-    elif(bytes("Triangle press", 'utf-8') in msg):
-        #ADJUST AFTER POOL TEST
-        global hover_on
-        if not hover_on:
-            hover()
-            hover_on = True
-        else:
-            print("Stopping hover")
-            pi1.set_PWM_dutycycle(thrust1, 1500)
-            pi1.set_PWM_dutycycle(thrust2, 1500)
-            pi1.set_PWM_dutycycle(thrust3, 1500)
-            pi1.set_PWM_dutycycle(thrust4, 1500)
-            pi1.set_PWM_dutycycle(thrust5, 1500)
-            hover_on = False
-
-    #elif(bytes("Triangle release", 'utf-8') in msg):
-   
-    elif (bytes("Share press", 'utf-8') in msg):
-        global left_light_on
-        if not left_light_on:
-            print("Let there be light! On the left side.")
-            pi1.set_PWM_dutycycle(left_light, 1700)                   #If left light is off, turn it on
-            left_light_on = True                                      #Left light is now on
-        else:
-            print("Nighty night")
-            pi1.set_PWM_dutycycle(left_light, 1100)                   #If left light is on, turn it off
-            left_light_on = False                                     #Left light is now off
-
-    elif (bytes("Options press", 'utf-8') in msg):
-        global right_light_on
-        if not right_light_on:
-            print("Let there be light! On the right side.")
-            pi1.set_PWM_dutycycle(right_light, 1700)                  #If left light is off, turn it on
-            right_light_on = True                                     #Right light is now on
-        else:
-            print("Righty night")
-            pi1.set_PWM_dutycycle(right_light, 1100)                  #If left light is on, turn it off        
-            right_light_on = False                                    #Right light is now off
-
-    elif (bytes("UpArrow press", 'utf-8') in msg):
-        print("Going up!")
-        pi1.set_PWM_dutycycle(thrust1, 1290)
-        pi1.set_PWM_dutycycle(thrust2, 1682)
-        pi1.set_PWM_dutycycle(thrust3, 1760)
-
-    elif (bytes("DownArrow press", 'utf-8') in msg):
-        print("Going down!")
-        pi1.set_PWM_dutycycle(thrust1, 1624)
-        pi1.set_PWM_dutycycle(thrust2, 1358)
-        pi1.set_PWM_dutycycle(thrust3, 1300)
-
-    elif (bytes("UpDownArrow release", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters")
-            pi1.set_PWM_dutycycle(thrust1, 1500)
-            pi1.set_PWM_dutycycle(thrust2, 1500)
-            pi1.set_PWM_dutycycle(thrust3, 1500)
-
-    elif (bytes("LeftArrow press", 'utf-8') in msg):
-        print("Left Roll")
-        pi1.set_PWM_dutycycle(thrust2, 1600)
-
-    elif (bytes("RightArrow press", 'utf-8') in msg):
-        print("Right Roll")
-        pi1.set_PWM_dutycycle(thrust1, 1386)
-
-    elif (bytes("LeftRightArrow release", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters")
-            pi1.set_PWM_dutycycle(thrust1, 1500)
-            pi1.set_PWM_dutycycle(thrust2, 1500)
-
-    elif (bytes("L1 press", 'utf-8') in msg):
-        print("Left turn")
-        pi1.set_PWM_dutycycle(thrust1, 1700)
-        pi1.set_PWM_dutycycle(thrust2, 1700)
-        pi1.set_PWM_dutycycle(thrust5, 1600)
-
-    elif (bytes("L1 release", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters.")
-            pi1.set_PWM_dutycycle(thrust1, 1500)
-            pi1.set_PWM_dutycycle(thrust2, 1500)
-            pi1.set_PWM_dutycycle(thrust5, 1500)
-
-    elif (bytes("R1 press", 'utf-8') in msg):
-        print("Right turn")
-        pi1.set_PWM_dutycycle(thrust1, 1268)
-        pi1.set_PWM_dutycycle(thrust2, 1268)
-        pi1.set_PWM_dutycycle(thrust4, 1386)
-
-    elif (bytes("R1 release", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters.")
-            pi1.set_PWM_dutycycle(thrust1, 1500)
-            pi1.set_PWM_dutycycle(thrust2, 1500)
-            pi1.set_PWM_dutycycle(thrust4, 1500)
-    
-    elif (bytes("L2 press", 'utf-8') in msg):
-        print("Pitch up")
-        pi1.set_PWM_dutycycle(thrust1, up_speed_14)                   
-        pi1.set_PWM_dutycycle(thrust2, up_speed)                                            
-
-    elif (bytes("L2 release", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters.")                   
-            pi1.set_PWM_dutycycle(thrust1, 1500)
-            pi1.set_PWM_dutycycle(thrust2, 1500)
-
-    elif (bytes("R2 press", 'utf-8') in msg):
-        print("Pitch down")                 
-        pi1.set_PWM_dutycycle(thrust1, down_speed_14)                   
-        pi1.set_PWM_dutycycle(thrust2, down_speed)                                            
-
-    elif (bytes("R2 release", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters.")                   
-            pi1.set_PWM_dutycycle(thrust1, 1500)
-            pi1.set_PWM_dutycycle(thrust2, 1500)
-                          
-    elif (bytes("L3 up 1", 'utf-8') in msg):                    #Level 1 Forward
-        print("Moving forward. Level 1.")
-        pi1.set_PWM_dutycycle(thrust4, fwd_1_14)
-        pi1.set_PWM_dutycycle(thrust5, fwd_1)
-
-    elif(bytes("L3 up 2", 'utf-8') in msg):                     #Level 2 Forward
-        print("Moving forward. Level 2.")
-        pi1.set_PWM_dutycycle(thrust4, fwd_2_14)
-        pi1.set_PWM_dutycycle(thrust5, fwd_2)
-
-    elif(bytes("L3 up 3", 'utf-8') in msg):                     #Level 3 Forward
-        print("Moving forward. Level 3.")
-        pi1.set_PWM_dutycycle(thrust4, fwd_3_14)
-        pi1.set_PWM_dutycycle(thrust5, fwd_3)
-
-    elif (bytes("L3 down 1", 'utf-8') in msg):                    #Level 1 Reverse
-        print("Moving forward. Level 1.")
-        pi1.set_PWM_dutycycle(thrust4, rev_1_14)
-        pi1.set_PWM_dutycycle(thrust5, rev_1)
-
-    elif(bytes("L3 down 2", 'utf-8') in msg):                     #Level 2 Reverse
-        print("Moving forward. Level 2.")
-        pi1.set_PWM_dutycycle(thrust4, rev_2_14)
-        pi1.set_PWM_dutycycle(thrust5, rev_2)
-
-    elif(bytes("L3 down 3", 'utf-8') in msg):                     #Level 3 Reverse
-        print("Moving forward. Level 3.")
-        pi1.set_PWM_dutycycle(thrust4, rev_3_14)
-        pi1.set_PWM_dutycycle(thrust5, rev_3)
-
-    elif (bytes("L3 y rest", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters.")
-            pi1.set_PWM_dutycycle(thrust4, 1500)                          
-            pi1.set_PWM_dutycycle(thrust5, 1500)
+def handle_client(reader):
+    handle_frames(reader.recv_frames())                             #One recv_into(), then every complete frame it holds
 
-    elif (bytes("L3 x rest", 'utf-8') in msg):
-        if hover_on:
-            hover()
-        else:
-            print("Stopping thrusters.")
-            pi1.set_PWM_dutycycle(thrust4, 1500)                          
-            pi1.set_PWM_dutycycle(thrust5, 1500)
+def handle_frames(frames, received_at=None):                        #received_at: protocol.now_us() when the frames were read
+    global last_apply_us
+    if received_at is None:
+        received_at = protocol.now_us()
+    traces = []
+    for msg in frames:
+        if stop_requested is not None:                              #Priority lane: the stop goes before the rest of the batch
+            apply_stop()
+        trace = handle_message(msg)
+        if trace is not None:
+            traces.append(trace)
+    commit_outputs()                                                #One write per changed channel for the whole batch
+    pwm_at = protocol.now_us()
+    last_apply_us = pwm_at - received_at
+    for name, sent_at, decoded_at, dispatched_at in traces:
+        latency.record(name, sent_at, received_at, decoded_at, dispatched_at, pwm_at)
+        if first_command_at is None and name != "HELLO":
+            record_first_command()
+
+def record_first_command():                                         #Cold start: power on (or process start) to the first command applied
+    global first_command_at
+    first_command_at = time.monotonic()
+    metrics.set("rouv_first_command_seconds", first_command_at - started_at, since="process")
+    metrics.set("rouv_first_command_seconds", time.clock_gettime(time.CLOCK_BOOTTIME), since="boot")
+    log.write("status", "First command applied", seconds=round(first_command_at - started_at, 2))
+
+def handle_message(msg):                                            #Returns (name, BUOY timestamp, decoded at, dispatched at) for latency tracing
+    global last_seq
+    command = protocol.decode_frame(msg)                            #Binary frames and legacy text frames both decode to (opcode, arg, seq, payload, timestamp)
+    decoded_at = protocol.now_us()
+    if command is None:
+        metrics.inc("rouv_frames_received_total", command="UNKNOWN")
+        return None
+    name = protocol.OPCODE_NAMES.get(command[0], "UNKNOWN")
+    metrics.inc("rouv_frames_received_total", command=name)
+    log.write("frame", name, arg=command[1], seq=command[2], length=len(msg))
+    if priority_lane and (stop_barrier is not None or leak_detected) and superseded(command[4]):
+        metrics.inc("rouv_frames_superseded_total")
+        return None
+    if proportional_mode and command[0] in LEVEL_MODE_OPCODES:      #Snapshots own the thrusters in proportional mode
+        return None
+    if command[0] in HOLD_IGNORED_OPCODES and holding():
+        return None
+    handler = DISPATCH.get(command[0])                              #Same cost for every command, no matter where it sits in the table
+    if handler is None:
+        return None
+    handler(command[1], command[3])
+    if command[2] is not None:                                      #Legacy text frames have no sequence number
+        last_seq = command[2]
+    if command[0] in (protocol.OP_ECHO_REPLY, protocol.OP_HEARTBEAT):  #Not pilot commands
+        return None
+    return name, command[4], decoded_at, protocol.now_us()
+
+
+#-----------COMMAND HANDLERS-----------
+#Controller inputs & their respective functions. Every handler takes the frame's arg (axis/level, 0 if unused) and payload.
+def stop_thrusters(*thrusters):
+    if hover_on:
+        if autopilot is None:
+            hover()                                             #The hold loop keeps the thrusters itself
+    else:
+        log.write("cmd", "Stopping thrusters.")
+        for thruster in thrusters:
+            set_duty(thruster, 1500)
+
+def handle_hello(arg, payload):
+    global proportional_mode
+    log.write("cmd", "Hello from BUOY")
+    proportional_mode = False
+
+def handle_ps_press(arg, payload):                                                  #Emergency shutdown
+    release_hold()                                                                  #Or the hold loop would power them straight back up
+    set_duty(thrust1, 0)                                                            #Cut power to everything
+    set_duty(thrust2, 0)
+    set_duty(thrust3, 0)
+    set_duty(thrust4, 0)
+    set_duty(thrust5, 0)
+    set_duty(left_light, 0)
+    set_duty(right_light, 0)
+    log.write("cmd", "Emergency shutdown")
+    log.write("readback", "Thruster 1", duty=actuators.get(thrust1))       #Confirm power is 0
+    log.write("readback", "Thruster 2", duty=actuators.get(thrust2))
+    log.write("readback", "Thruster 3", duty=actuators.get(thrust3))
+    log.write("readback", "Thruster 4", duty=actuators.get(thrust4))
+    log.write("readback", "Thruster 5", duty=actuators.get(thrust5))
+    log.write("readback", "Left Light", duty=actuators.get(left_light))
+    log.write("readback", "Right Light", duty=actuators.get(right_light))
+
+def handle_x_press(arg, payload):
+    log.write("cmd", "Running thruster 3 only")
+    set_duty(thrust3, single_speed)
+    log.write("readback", "Thruster 3", duty=actuators.get(thrust3))
+
+def handle_x_release(arg, payload):
+    log.write("cmd", "Stopping thruster 3 only")
+    set_duty(thrust3, 1500)
+
+def handle_square_press(arg, payload):
+    log.write("cmd", "Running thruster 4 only")
+    set_duty(thrust4, single_speed_14)
+    log.write("readback", "Thruster 4", duty=actuators.get(thrust4))
+
+def handle_square_release(arg, payload):
+    log.write("cmd", "Stopping thruster 4 only")
+    set_duty(thrust4, 1500)
+
+def handle_circle_press(arg, payload):
+    log.write("cmd", "Running thruster 5 only")
+    set_duty(thrust5, single_speed)
+    log.write("readback", "Thruster 5", duty=actuators.get(thrust5))
+
+def handle_circle_release(arg, payload):
+    log.write("cmd", "Stopping thruster 5 only")
+    set_duty(thrust5, 1500)
+
+def handle_triangle_press(arg, payload):
+    if not hover_on:
+        engage_hold()
+    else:
+        release_hold()
+        log.write("cmd", "Stopping hover")
+        set_duty(thrust1, 1500)
+        set_duty(thrust2, 1500)
+        set_duty(thrust3, 1500)
+        set_duty(thrust4, 1500)
+        set_duty(thrust5, 1500)
+
+def handle_share_press(arg, payload):
+    global left_light_on
+    if not left_light_on:
+        log.write("cmd", "Let there be light! On the left side.")
+        set_duty(left_light, 1700)                   #If left light is off, turn it on
+        left_light_on = True                                      #Left light is now on
+    else:
+        log.write("cmd", "Nighty night")
+        set_duty(left_light, 1100)                   #If left light is on, turn it off
+        left_light_on = False                                     #Left light is now off
+
+def handle_options_press(arg, payload):
+    global right_light_on
+    if not right_light_on:
+        log.write("cmd", "Let there be light! On the right side.")
+        set_duty(right_light, 1700)                  #If right light is off, turn it on
+        right_light_on = True                                     #Right light is now on
+    else:
+        log.write("cmd", "Righty night")
+        set_duty(right_light, 1100)                  #If right light is on, turn it off
+        right_light_on = False                                    #Right light is now off
+
+def handle_up_arrow_press(arg, payload):
+    log.write("cmd", "Going up!")
+    set_duty(thrust1, rise_1)
+    set_duty(thrust2, rise_2)
+    set_duty(thrust3, rise_3)
+
+def handle_down_arrow_press(arg, payload):
+    log.write("cmd", "Going down!")
+    set_duty(thrust1, sink_1)
+    set_duty(thrust2, sink_2)
+    set_duty(thrust3, sink_3)
+
+def handle_up_down_arrow_release(arg, payload):
+    stop_thrusters(thrust1, thrust2, thrust3)
+
+def handle_left_arrow_press(arg, payload):
+    log.write("cmd", "Left Roll")
+    set_duty(thrust2, roll_speed)
+
+def handle_right_arrow_press(arg, payload):
+    log.write("cmd", "Right Roll")
+    set_duty(thrust1, roll_speed_14)
+
+def handle_left_right_arrow_release(arg, payload):
+    stop_thrusters(thrust1, thrust2)
+
+def handle_l1_press(arg, payload):
+    log.write("cmd", "Left turn")
+    set_duty(thrust1, turn_speed)
+    set_duty(thrust2, turn_speed)
+    set_duty(thrust5, turn_rear)
+
+def handle_l1_release(arg, payload):
+    stop_thrusters(thrust1, thrust2, thrust5)
+
+def handle_r1_press(arg, payload):
+    log.write("cmd", "Right turn")
+    set_duty(thrust1, turn_speed_14)
+    set_duty(thrust2, turn_speed_14)
+    set_duty(thrust4, turn_rear_14)
+
+def handle_r1_release(arg, payload):
+    stop_thrusters(thrust1, thrust2, thrust4)
+
+def handle_l2_press(arg, payload):
+    log.write("cmd", "Pitch up")
+    set_duty(thrust1, up_speed_14)
+    set_duty(thrust2, up_speed)
+
+def handle_l2_release(arg, payload):
+    stop_thrusters(thrust1, thrust2)
+
+def handle_r2_press(arg, payload):
+    log.write("cmd", "Pitch down")
+    set_duty(thrust1, down_speed_14)
+    set_duty(thrust2, down_speed)
+
+def handle_r2_release(arg, payload):
+    stop_thrusters(thrust1, thrust2)
+
+FWD_LEVELS = {1: (fwd_1_14, fwd_1), 2: (fwd_2_14, fwd_2), 3: (fwd_3_14, fwd_3)}     #Joystick level -> (thrusters 1 & 4, thruster 5)
+REV_LEVELS = {1: (rev_1_14, rev_1), 2: (rev_2_14, rev_2), 3: (rev_3_14, rev_3)}
+
+def handle_l3_up(level, payload):
+    if level not in FWD_LEVELS:
+        return
+    if holding():                                               #Drive forward at the held depth/heading/pitch
+        autopilot.surge = (FWD_LEVELS[level][1] - mixer.STOP) / mixer.SPAN
+        return
+    log.write("cmd", "Moving forward", level=level)
+    set_duty(thrust4, FWD_LEVELS[level][0])
+    set_duty(thrust5, FWD_LEVELS[level][1])
+
+def handle_l3_down(level, payload):
+    if level not in REV_LEVELS:
+        return
+    if holding():
+        autopilot.surge = (REV_LEVELS[level][1] - mixer.STOP) / mixer.SPAN
+        return
+    log.write("cmd", "Moving backward", level=level)
+    set_duty(thrust4, REV_LEVELS[level][0])
+    set_duty(thrust5, REV_LEVELS[level][1])
+
+def handle_l3_rest(arg, payload):
+    if holding():
+        autopilot.surge = 0.0
+        return
+    stop_thrusters(thrust4, thrust5)
+
+def handle_heartbeat(arg, payload):                                 #Nothing to do but start the link watchdog, every frame feeds it
+    link_watchdog.arm()
+
+def handle_echo_reply(arg, payload):                                #Clock offset sample for latency tracing
+    if len(payload) < protocol.ECHO_REPLY.size:
+        return
+    sent_at, buoy_time = protocol.ECHO_REPLY.unpack_from(payload)
+    latency.on_echo_reply(sent_at, buoy_time, protocol.now_us())
+
+def handle_snapshot(arg, payload):                                  #Proportional mode: every stick and trigger at once
+    global proportional_mode
+    if len(payload) < protocol.SNAPSHOT.size:
+        return
+    proportional_mode = True
+    if holding():                                                   #The sticks take over from the hold loop
+        release_hold()
+    duties = mixer.mix_snapshot(protocol.decode_snapshot(payload))  #Same cost however many inputs are held
+    for thruster, duty in zip(thrusters, duties):
+        set_duty(thruster, int(duty))
+
+#Commands that drive thrusters by level, ignored while snapshots are in control
+LEVEL_MODE_OPCODES = frozenset((
+    protocol.OP_X_PRESS, protocol.OP_X_RELEASE, protocol.OP_SQUARE_PRESS, protocol.OP_SQUARE_RELEASE,
+    protocol.OP_CIRCLE_PRESS, protocol.OP_CIRCLE_RELEASE, protocol.OP_TRIANGLE_PRESS,
+    protocol.OP_UP_ARROW_PRESS, protocol.OP_DOWN_ARROW_PRESS, protocol.OP_UP_DOWN_ARROW_RELEASE,
+    protocol.OP_LEFT_ARROW_PRESS, protocol.OP_RIGHT_ARROW_PRESS, protocol.OP_LEFT_RIGHT_ARROW_RELEASE,
+    protocol.OP_L1_PRESS, protocol.OP_L1_RELEASE, protocol.OP_R1_PRESS, protocol.OP_R1_RELEASE,
+    protocol.OP_L2_PRESS, protocol.OP_L2_RELEASE, protocol.OP_R2_PRESS, protocol.OP_R2_RELEASE,
+    protocol.OP_L3_UP, protocol.OP_L3_DOWN, protocol.OP_L3_Y_REST, protocol.OP_L3_X_REST,
+))
+#Ignored while the hold loop owns the thrusters: only Triangle (release) and L3 (surge) get through
+HOLD_IGNORED_OPCODES = LEVEL_MODE_OPCODES - frozenset((protocol.OP_TRIANGLE_PRESS, protocol.OP_L3_UP, protocol.OP_L3_DOWN,
+                                                       protocol.OP_L3_Y_REST, protocol.OP_L3_X_REST))
+
+#Opcode -> handler, built once at startup
+DISPATCH = {
+    protocol.OP_HELLO: handle_hello,
+    protocol.OP_ECHO_REPLY: handle_echo_reply,
+    protocol.OP_HEARTBEAT: handle_heartbeat,
+    protocol.OP_PS_PRESS: handle_ps_press,
+    protocol.OP_SHARE_PRESS: handle_share_press,
+    protocol.OP_OPTIONS_PRESS: handle_options_press,
+    protocol.OP_X_PRESS: handle_x_press,
+    protocol.OP_X_RELEASE: handle_x_release,
+    protocol.OP_SQUARE_PRESS: handle_square_press,
+    protocol.OP_SQUARE_RELEASE: handle_square_release,
+    protocol.OP_CIRCLE_PRESS: handle_circle_press,
+    protocol.OP_CIRCLE_RELEASE: handle_circle_release,
+    protocol.OP_TRIANGLE_PRESS: handle_triangle_press,
+    protocol.OP_UP_ARROW_PRESS: handle_up_arrow_press,
+    protocol.OP_DOWN_ARROW_PRESS: handle_down_arrow_press,
+    protocol.OP_UP_DOWN_ARROW_RELEASE: handle_up_down_arrow_release,
+    protocol.OP_LEFT_ARROW_PRESS: handle_left_arrow_press,
+    protocol.OP_RIGHT_ARROW_PRESS: handle_right_arrow_press,
+    protocol.OP_LEFT_RIGHT_ARROW_RELEASE: handle_left_right_arrow_release,
+    protocol.OP_L1_PRESS: handle_l1_press,
+    protocol.OP_L1_RELEASE: handle_l1_release,
+    protocol.OP_R1_PRESS: handle_r1_press,
+    protocol.OP_R1_RELEASE: handle_r1_release,
+    protocol.OP_L2_PRESS: handle_l2_press,
+    protocol.OP_L2_RELEASE: handle_l2_release,
+    protocol.OP_R2_PRESS: handle_r2_press,
+    protocol.OP_R2_RELEASE: handle_r2_release,
+    protocol.OP_L3_UP: handle_l3_up,
+    protocol.OP_L3_DOWN: handle_l3_down,
+    protocol.OP_L3_Y_REST: handle_l3_rest,
+    protocol.OP_L3_X_REST: handle_l3_rest,
+    protocol.OP_SNAPSHOT: handle_snapshot,
+}
+
+
+#-----------RUNTIME-----------
+#One asyncio loop runs command ingest, safety checks and status output side by side, each at its own rate,
+#so leak/overheat checks keep running when no commands arrive. pigpio calls block on a round trip to the daemon,
+#so they run on executor threads: one for outputs (keeps commands in order) and one for sensor reads.
+output_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="pigpio-out")
+sensor_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="pigpio-in")
+
+async def run_periodic(rate, tick):                                     #Call tick() at a fixed rate without drifting
+    loop = asyncio.get_running_loop()
+    period = 1.0 / rate
+    deadline = loop.time()
+    while True:
+        await tick()
+        deadline += period
+        delay = deadline - loop.time()
+        if delay < 0:                                                   #Overran, start again from now instead of bursting
+            deadline = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+
+async def ingest_task(link):
+    loop = asyncio.get_running_loop()
+    reader = link.reader
+    peer = None
+    while True:
+        try:
+            frames = list(await reader.recv_frames_async(loop))         #Looked at more than once: roles, dispatch, fan-out
+        except OSError:                                                 #Client closed the connection, no need to wait for the timeout
+            if link is pilot_link:
+                await loop.run_in_executor(output_executor, link_watchdog.trip, "closed")
+            return                                                      #Safety checks keep running
+        if use_udp:
+            if reader.peer != peer:                                     #UDP has no connections, a new BUOY address is a new session
+                peer = reader.peer
+                await start_session(link)
+        elif link is not pilot_link or any(protocol.message_opcode(msg) == protocol.OP_CONTROL for msg in frames):
+            if not await control_frames(link, frames):                  #Observers' frames stop here
+                continue
+        received_at = protocol.now_us()
+        link_watchdog.feed()
+        if priority_lane:
+            priority_frames(frames, received_at)
+        await loop.run_in_executor(output_executor, handle_frames, frames, received_at)     #Frames are views into the reader, so wait before the next read
+        if observers.subscribers:
+            publish_commands(frames)
+
+async def watchdog_tick():
+    if not link_watchdog.armed or link_watchdog.lost or link_watchdog.silent_for() <= link_watchdog.timeout:
+        return                                                          #Cheap path, nothing to do
+    await asyncio.get_running_loop().run_in_executor(output_executor, link_watchdog.check)    #In order with the command writes
+
+async def safety_tick():
+    check_temp()                                                        #Cached, doesn't block
+    await asyncio.get_running_loop().run_in_executor(sensor_executor, check_leak)
+    if leak_detected or overheat:
+        await telemetry_tick()                                          #Tell the BUOY straight away, the connection closes next
+    if leak_detected:
+        raise LeakDetectedException
+    if overheat:
+        raise OverheatException
+
+async def ramp_tick():                                                  #Carry on any thruster ramps between commands
+    if output_filter.ramping:
+        await asyncio.get_running_loop().run_in_executor(output_executor, commit_outputs)
+
+async def output_tick():
+    if output_stage is not None and not output_stage.alive():
+        await asyncio.get_running_loop().run_in_executor(output_executor, local_outputs)
+    if output_stage is None:                                            #The actuator process reads back its own writes
+        mismatched = await asyncio.get_running_loop().run_in_executor(sensor_executor, actuators.verify)
+        if mismatched:
+            log.write("readback", "Duty cache out of step with hardware", pins=mismatched)
+    log.write("status", "ROUV", temp=thermal_monitor.current_temp(), leak=leak_detected, hover=hover_on,
+              amps=round(output_filter.amps, 1), budget_limited=round(output_filter.limited_fraction(), 3))
+
+class BuoyLink:                                                         #One client connection, the pilot's BUOY or an observer
+
+    def __init__(self, sock, reader):
+        self.sock = sock
+        self.reader = reader                                            #UdpReceiver over UDP, it knows the BUOY's address
+        self.lock = asyncio.Lock()
+        self.subscriber = None                                          #fanout.Subscriber while observing
+
+    async def send(self, frame):                                        #Over whichever transport is in use
+        if use_udp:
+            self.reader.send(frame)
+            return
+        async with self.lock:                                           #Echo, READY and telemetry tasks: a partial send must not interleave
+            await asyncio.get_running_loop().sock_sendall(self.sock, frame)
+
+async def echo_tick(link):                                              #The BUOY answers at once, see handle_echo_reply()
+    if link is not pilot_link:                                          #Latency is traced for the pilot's commands only
+        return
+    try:
+        await link.send(protocol.encode_frame(protocol.OP_ECHO, payload=protocol.ECHO.pack(protocol.now_us())))
+    except OSError:                                                     #Connection going away, ingest_task() deals with it
+        pass
+
+async def telemetry_tick():                                             #Vehicle state to the pilot and every observer, encoded once
+    link = pilot_link
+    if link is None and not observers.subscribers:
+        return
+    frame = protocol.encode_frame(protocol.OP_TELEMETRY, payload=telemetry_payload())
+    observers.publish(frame)
+    if link is None:
+        return
+    try:
+        await link.send(frame)
+    except OSError:
+        pass
+
+def publish_commands(frames):                                           #Pilot's frames to the observers, one copy shared by all of them
+    for msg in frames:
+        if protocol.message_opcode(msg) not in NOT_PUBLISHED_OPCODES:
+            observers.publish(protocol.LENGTH.pack(len(msg)) + bytes(msg))
+
+def restore_safe_state():                                               #Nothing carries over from the last BUOY connection
+    global proportional_mode, stop_barrier
+    release_hold()
+    proportional_mode = False
+    stop_barrier = None                                                 #A new BUOY's clock has nothing to do with the old one's
+    link_watchdog.reset()
+    for thruster in thrusters:
+        set_duty(thruster, 1500)
+    commit_outputs()
+
+async def start_session(link):                                          #New BUOY: safe state, then READY once the ESCs are armed
+    await asyncio.get_running_loop().run_in_executor(output_executor, restore_safe_state)
+    metrics.inc("rouv_connections_total")
+    if esc_armed_at is not None and esc_armed_at > time.monotonic():
+        log.write("status", "Waiting for ESCs to arm", seconds=round(esc_armed_at - time.monotonic(), 1))
+        await asyncio.sleep(esc_armed_at - time.monotonic())
+    await link.send(protocol.encode_frame(protocol.OP_READY))
+    metrics.set("rouv_ready_seconds", time.monotonic() - started_at)
+    log.write("status", "READY sent to BUOY")
+
+#-----------PILOT + OBSERVERS-----------
+#Over TCP any number of clients (up to max_clients) can be connected. One is the pilot: its frames drive the ROUV and
+#it gets READY, echoes and telemetry. The rest observe: they get telemetry and the pilot's commands through the
+#fan-out (see fanout.py), and everything they send is ignored apart from SUBSCRIBE and CONTROL.
+#A new connection's first frame decides its role: SUBSCRIBE observes, anything else (HELLO) asks to be the pilot.
+#See protocol.py (CONTROL HANDOVER) for how control changes hands.
+observers = Fanout(observer_queue)
+NOT_PUBLISHED_OPCODES = frozenset((protocol.OP_HEARTBEAT, protocol.OP_ECHO_REPLY, protocol.OP_CONTROL))
+metrics.gauge_function("rouv_observers", lambda: len(observers.subscribers))
+metrics.describe("rouv_observer_frames_dropped", "Frames dropped because an observer fell behind")
+metrics.gauge_function("rouv_observer_frames_dropped", observers.dropped_total)
+metrics.describe("rouv_control_handovers_total", "Times control passed from one connected pilot to another")
+
+def pilot_gone():                                                       #Pilot's link has gone quiet, its socket may be half-open
+    return link_watchdog.lost or (link_watchdog.armed and link_watchdog.silent_for() > link_watchdog.timeout)
+
+def observe(link):                                                      #link gets the fan-out from now on, and is told so
+    if link.subscriber is None:
+        link.subscriber = observers.add(link.sock, link.lock)
+    link.subscriber.push(protocol.encode_frame(protocol.OP_CONTROL, protocol.CONTROL_OBSERVER))
+
+async def take_control(link):                                           #link becomes the pilot, the old one (if any) observes
+    global pilot_link
+    old = pilot_link
+    pilot_link = link
+    if link.subscriber is not None:
+        await observers.detach(link.subscriber)
+        link.subscriber = None
+    if old is not None:
+        metrics.inc("rouv_control_handovers_total")
+        log.write("status", "Control handed over, old pilot observes")
+        observe(old)
+    await start_session(link)                                           #Safe state, READY once the ESCs are armed
+    await link.send(protocol.encode_frame(protocol.OP_CONTROL, protocol.CONTROL_PILOT))
+
+async def release_control(link):                                        #Pilot gives up control, the thrusters stop
+    global pilot_link
+    pilot_link = None
+    await asyncio.get_running_loop().run_in_executor(output_executor, restore_safe_state)
+    log.write("status", "Pilot released control")
+    observe(link)
+
+async def control_frames(link, frames):                                 #Frames deciding who is in control. True if link is the pilot after them.
+    for msg in frames:
+        command = protocol.decode_frame(msg)
+        if command is None:
+            continue
+        opcode, arg = command[0], command[1]
+        if opcode == protocol.OP_SUBSCRIBE:
+            if link is not pilot_link and link.subscriber is None:
+                observe(link)
+        elif opcode == protocol.OP_CONTROL:
+            if link is pilot_link:
+                if arg == protocol.CONTROL_RELEASE:
+                    await release_control(link)
+            elif arg == protocol.CONTROL_TAKE or (arg == protocol.CONTROL_REQUEST and (pilot_link is None or pilot_gone())):
+                await take_control(link)
+            else:
+                observe(link)                                           #Refused, still observing
+        elif link is not pilot_link and link.subscriber is None:        #First frame of a new connection, HELLO from a BUOY
+            if pilot_link is None or pilot_gone():
+                await take_control(link)
+            else:
+                log.write("status", "Pilot already connected, new BUOY observes")
+                observe(link)
+    return link is pilot_link
+
+async def connection(clientsock):                                       #One client connection, returns when it closes
+    global pilot_link
+    clientsock.setblocking(False)
+    if use_udp:
+        reader = udp_transport.UdpReceiver(clientsock)              #Drops stale frames, acks toggles and the emergency stop
+        metrics.gauge_function("rouv_udp_stale_dropped", lambda: reader.stale)
+        metrics.gauge_function("rouv_udp_duplicates", lambda: reader.duplicates)
+    else:
+        reader = framing.FrameReader(clientsock)
+    link = BuoyLink(clientsock, reader)
+    if use_udp:
+        pilot_link = link                                               #Whoever is sending is the pilot, no observers over UDP
+    echo = asyncio.ensure_future(run_periodic(echo_rate, lambda: echo_tick(link)))
+    try:
+        await ingest_task(link)
+    except OSError:                                                     #Gone again before the ESCs were armed
+        pass
+    finally:
+        if pilot_link is link:
+            pilot_link = None
+        if link.subscriber is not None:
+            observers.remove(link.subscriber)
+        echo.cancel()
+        await asyncio.gather(echo, return_exceptions=True)
+
+async def client_task(clientsock, client_addr):
+    try:
+        await connection(clientsock)
+    finally:
+        clientsock.close()                                              #Also on shutdown, so the client sees it go
+    log.write("status", "Client disconnected", addr=client_addr[0])
+
+async def accept_loop(listener):                                        #Client connections side by side, for as long as the ROUV runs
+    if use_udp:
+        await connection(listener)                                      #One socket for every BUOY, see ingest_task()
+        return
+    loop = asyncio.get_running_loop()
+    listener.setblocking(False)
+    clients = set()
+    try:
+        while True:
+            clientsock, client_addr = await loop.sock_accept(listener)  #"Come on in!"
+            if len(clients) >= max_clients:
+                log.write("status", "Too many connections, turned away", addr=client_addr[0])
+                clientsock.close()
+                continue
+            log.write("status", "Connection Established", addr=client_addr[0])
+            client = asyncio.ensure_future(client_task(clientsock, client_addr))
+            clients.add(client)
+            client.add_done_callback(clients.discard)
+    finally:
+        for client in clients:
+            client.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+
+async def supervise(main, safety_sock=None):                            #Runs main next to the watchdog, safety and status tasks
+    tasks = [asyncio.ensure_future(main),
+             asyncio.ensure_future(run_periodic(watchdog_rate, watchdog_tick)),
+             asyncio.ensure_future(run_periodic(safety_rate, safety_tick)),
+             asyncio.ensure_future(run_periodic(output_rate, output_tick)),
+             asyncio.ensure_future(run_periodic(telemetry_rate, telemetry_tick)),
+             asyncio.ensure_future(run_periodic(ramp_rate, ramp_tick))]
+    if safety_sock is not None:
+        tasks.append(asyncio.ensure_future(safety_task(safety_sock)))
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()                                               #Leak or overheat
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def serve(listener, safety_sock=None):                            #Runs until a leak, overheat or Ctrl+C
+    await supervise(accept_loop(listener), safety_sock)
+
+async def run(clientsock):                                              #Just one, already accepted, connection (replay.py)
+    await supervise(connection(clientsock))
 
 
 #-----------MAIN-----------
 def main():
+    global esc_armed_at
+    log.start()
     try:
-        #Initialize socket connection
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)           #Socket setup
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)         #Hopefully prevents the "Address already in use" error
-        s.bind(ROUV_ADDRESS)                                            #"Unlocking the door"
-        s.listen()                                                      #Poll for message
-        (clientsock, client_addr) = s.accept()                          #"Come on in!"
-        print("Connection Established")                                 #Confirm connection
+        metrics.serve(metrics_port)
+    except OSError as e:                                        #Port taken (e.g. the BUOY on this machine): run without metrics
+        log.write("status", "Metrics not served", port=metrics_port, error=str(e))
+    setup_hardware()
+    try:
+        thermal_monitor.start()
+        if autopilot is not None:
+            autopilot.start()                                           #Reads the sensors from now on, holds once Triangle engages it
         
         #Initialize thrusters + lights
-        pi1.set_PWM_dutycycle(thrust1, 1500)                              #Send STOP signal to thruster 1
+        set_duty(thrust1, 1500)                                         #Send STOP signal to thruster 1
         print("Thruster 1 @ 15% DC")
-        pi1.set_PWM_dutycycle(thrust2, 1500)                              #Send STOP signal to thruster 2
+        set_duty(thrust2, 1500)                                         #Send STOP signal to thruster 2
         print("Thruster 2 @ 15% DC")
-        pi1.set_PWM_dutycycle(thrust3, 1500)                              #Send STOP signal to thruster 3
+        set_duty(thrust3, 1500)                                         #Send STOP signal to thruster 3
         print("Thruster 3 @ 15% DC")
-        pi1.set_PWM_dutycycle(thrust4, 1500)                              #Send STOP signal to thruster 4
+        set_duty(thrust4, 1500)                                         #Send STOP signal to thruster 4
         print("Thruster 4 @ 15% DC")
-        pi1.set_PWM_dutycycle(thrust5, 1500)                              #Send STOP signal to thruster 5
+        set_duty(thrust5, 1500)                                         #Send STOP signal to thruster 5
         print("Thruster 5 @ 15% DC")
-        pi1.set_PWM_dutycycle(left_light, 1100)                           #Send OFF signal to left light
+        set_duty(left_light, 1100)                                      #Send OFF signal to left light
         print("Left Light @ 11% DC")
-        pi1.set_PWM_dutycycle(right_light, 1100)                          #Send OFF signal to right light
+        set_duty(right_light, 1100)                                     #Send OFF signal to right light
         print("Right Light @ 11% DC")
-        time.sleep(10)
+        commit_outputs()                                                #Cache starts empty, so all seven are written
+        esc_armed_at = time.monotonic() + esc_arm_time                  #ESCs arm while we wait for the BUOY, READY goes out once they have
 
-        while True:
-            check_temp()
-            check_leak()
-            if leak_detected:
-                raise LeakDetectedException
-            if overheat:
-                raise OverheatException
-            handle_client(clientsock)
+        #Initialize socket connection
+        if use_udp:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)            #No connection, the BUOY's address comes with its datagrams
+            s.bind(ROUV_ADDRESS)
+            print("Listening for UDP datagrams")
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)           #Socket setup
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)         #Hopefully prevents the "Address already in use" error
+            s.bind(ROUV_ADDRESS)                                            #"Unlocking the door"
+            s.listen()                                                      #Poll for message
+            print("Waiting for the BUOY")
+
+        safety_sock = None
+        if priority_lane:
+            safety_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  #Emergency stops that skip the command stream
+            safety_sock.bind((ROUV_ADDRESS[0], safety_port))
+        asyncio.run(serve(s, safety_sock))                              #Takes every BUOY connection until a leak, overheat or Ctrl+C
 
 
     except KeyboardInterrupt: 
-        pi1.set_PWM_dutycycle(thrust1, 0)                                           #Cut power to thruster 1
-        pi1.set_PWM_dutycycle(thrust2, 0)                                           #Cut power to thruster 2
-        pi1.set_PWM_dutycycle(thrust3, 0)                                           #Cut power to thruster 3
-        pi1.set_PWM_dutycycle(thrust4, 0)                                           #Cut power to thruster 4
-        pi1.set_PWM_dutycycle(thrust5, 0)                                           #Cut power to thruster 5
-        pi1.set_PWM_dutycycle(left_light, 0)                                        #Cut power to left light
-        pi1.set_PWM_dutycycle(right_light, 0)                                       #Cut power to right light
+        stop_hold_loop()
+        set_duty(thrust1, 0)                                                        #Cut power to thruster 1
+        set_duty(thrust2, 0)                                                        #Cut power to thruster 2
+        set_duty(thrust3, 0)                                                        #Cut power to thruster 3
+        set_duty(thrust4, 0)                                                        #Cut power to thruster 4
+        set_duty(thrust5, 0)                                                        #Cut power to thruster 5
+        set_duty(left_light, 0)                                                     #Cut power to left light
+        set_duty(right_light, 0)                                                    #Cut power to right light
+        commit_outputs(force=True)                                                  #Write even if the cache says it's already 0
         print("KeyboardInterrupt detected")
         print("Thruster 1: " + str(pi1.get_PWM_dutycycle(thrust1)))
         print("Thruster 2: " + str(pi1.get_PWM_dutycycle(thrust2)))
@@ -418,20 +1075,22 @@ def main():
         print("Right Light: " + str(pi1.get_PWM_dutycycle(right_light)))
     
     except LeakDetectedException:
-        csock.send(create_message("LEAK"))                                          #Send leak alert to BUOY, BUOY will then light up leak LED
-        pi1.set_PWM_dutycycle(thrust1, 1800)                                        #Go up!!!
-        pi1.set_PWM_dutycycle(thrust2, 1800)
-        pi1.set_PWM_dutycycle(thrust3, 1800)
-        pi1.set_PWM_dutycycle(thrust4, 1500)                                         
-        pi1.set_PWM_dutycycle(thrust5, 1500)
-        time.sleep(10)
-        pi1.set_PWM_dutycycle(thrust1, 0)                                           #Cut power to thruster 1
-        pi1.set_PWM_dutycycle(thrust2, 0)                                           #Cut power to thruster 2
-        pi1.set_PWM_dutycycle(thrust3, 0)                                           #Cut power to thruster 3
-        pi1.set_PWM_dutycycle(thrust4, 0)                                           #Cut power to thruster 4
-        pi1.set_PWM_dutycycle(thrust5, 0)                                           #Cut power to thruster 5
-        pi1.set_PWM_dutycycle(left_light, 0)                                        #Cut power to left light
-        pi1.set_PWM_dutycycle(right_light, 0)                                       #Cut power to right light
+        stop_hold_loop()                                                            #The BUOY was told by safety_tick(), telemetry with the leak flag
+        set_duty(thrust1, 1800)                                                     #Go up!!!
+        set_duty(thrust2, 1800)
+        set_duty(thrust3, 1800)
+        set_duty(thrust4, 1500)
+        set_duty(thrust5, 1500)
+        commit_outputs(force=True)
+        ramp_outputs(10)                                                            #Thrusters ramp up within the current budget
+        set_duty(thrust1, 0)                                                        #Cut power to thruster 1
+        set_duty(thrust2, 0)                                                        #Cut power to thruster 2
+        set_duty(thrust3, 0)                                                        #Cut power to thruster 3
+        set_duty(thrust4, 0)                                                        #Cut power to thruster 4
+        set_duty(thrust5, 0)                                                        #Cut power to thruster 5
+        set_duty(left_light, 0)                                                     #Cut power to left light
+        set_duty(right_light, 0)                                                    #Cut power to right light
+        commit_outputs(force=True)
         print("Thruster 1: " + str(pi1.get_PWM_dutycycle(thrust1)))
         print("Thruster 2: " + str(pi1.get_PWM_dutycycle(thrust2)))
         print("Thruster 3: " + str(pi1.get_PWM_dutycycle(thrust3)))
@@ -440,6 +1099,20 @@ def main():
         print("Left Light: " + str(pi1.get_PWM_dutycycle(left_light)))
         print("Right Light: " + str(pi1.get_PWM_dutycycle(right_light)))
 
+    finally:
+        stop_hold_loop()
+        print(latency.report())                                                     #Per-command latency histograms
+        for reason, histogram in stop_latency.items():
+            print("Priority stops (%s): %d, received to outputs written p99 %.0fus, max %.0fus" %
+                  (reason, histogram.count, histogram.percentile(0.99), histogram.max))
+        if autopilot is not None:
+            print(autopilot.report())                                               #Hold loop jitter and overruns
+        print("Current budget limited thrust %.1f%% of the time, ~%.2fAh used by the thrusters" %
+              (output_filter.limited_fraction() * 100, output_filter.amp_hours))
+        if output_stage is not None:
+            output_stage.stop()                                                     #After the last writes above have gone out
+        log.stop()                                                                  #Write out whatever is still queued
+
 
 if __name__ == '__main__':
     main()
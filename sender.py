@@ -0,0 +1,90 @@
+#Non-blocking frame sender for the BUOY_Pi
+#Controller callbacks only enqueue() fully formatted frames. A sender thread takes everything queued and writes
+#it with a single sendmsg() (scatter/gather, no joining), so a slow or stalled tether never stalls reading the
+#controller. Partial sends are finished off instead of being silently ignored.
+import collections
+import socket
+import threading
+import time
+
+MAX_IOV = 512                                   #Buffers per sendmsg(), Linux refuses more than IOV_MAX (1024)
+
+
+class FrameSender:
+
+    def __init__(self, sock, capacity=256):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     #Don't let Nagle hold small frames back
+        self.capacity = capacity
+        self.queue = collections.deque()        #(time queued, frame)
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.error = None                       #Socket error that stopped the sender, if any
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.sendmsg_calls = 0
+        self.dropped = 0                        #Oldest frames thrown away because the queue was full
+        self.last_wait = 0.0                    #How long the oldest frame of the last batch waited before sending
+
+    def enqueue(self, frame):                   #Never blocks
+        if not frame:
+            return
+        with self.cond:
+            if len(self.queue) >= self.capacity:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((time.monotonic(), frame))
+            self.cond.notify()
+
+    def depth(self):
+        return len(self.queue)
+
+    def oldest_wait(self):                      #Seconds the oldest unsent frame has been waiting
+        with self.cond:
+            return time.monotonic() - self.queue[0][0] if self.queue else 0.0
+
+    def send_batch(self, frames):
+        buffers = [memoryview(frame) for frame in frames]
+        first = 0                                               #First buffer not completely sent
+        while first < len(buffers):
+            sent = self.sock.sendmsg(buffers[first:first + MAX_IOV])
+            self.sendmsg_calls += 1
+            self.sent_bytes += sent
+            while first < len(buffers) and sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            if sent:                                            #Partial send, the rest of this frame goes next
+                buffers[first] = buffers[first][sent:]
+        self.sent_frames += len(frames)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                frames = [frame for queued, frame in self.queue]
+                self.last_wait = time.monotonic() - self.queue[0][0]
+                self.queue.clear()
+            try:
+                self.send_batch(frames)
+            except OSError as e:
+                self.error = e
+                with self.cond:
+                    self.running = False
+                return
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="sender", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):                             #Sends whatever is still queued, then stops
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,74 @@
+#Recorded pilot sessions: every MyController callback with its time, for replaying real dives (see replay.py)
+#File: MAGIC, then one EVENT per callback: microseconds since the previous event, callback number, value (0 if the
+#callback takes none). 7 bytes an event, so an hour of heavy stick work is a few MB.
+#Callback numbers are positions in CALLBACKS: only ever append to it, or old recordings replay the wrong buttons.
+import struct
+import time
+
+MAGIC = b"ROUVSES1"
+EVENT = struct.Struct("<IBh")                   #us since previous event, callback number, value
+
+CALLBACKS = (                                   #(name, takes a value)
+    ("on_x_press", False), ("on_x_release", False),
+    ("on_square_press", False), ("on_square_release", False),
+    ("on_triangle_press", False), ("on_triangle_release", False),
+    ("on_circle_press", False), ("on_circle_release", False),
+    ("on_L1_press", False), ("on_L1_release", False),
+    ("on_L2_press", True), ("on_L2_release", False),
+    ("on_R1_press", False), ("on_R1_release", False),
+    ("on_R2_press", True), ("on_R2_release", False),
+    ("on_up_arrow_press", False), ("on_down_arrow_press", False), ("on_up_down_arrow_release", False),
+    ("on_left_arrow_press", False), ("on_right_arrow_press", False), ("on_left_right_arrow_release", False),
+    ("on_playstation_button_press", False), ("on_share_press", False), ("on_options_press", False),
+    ("on_L3_up", True), ("on_L3_down", True), ("on_L3_left", True), ("on_L3_right", True),
+    ("on_L3_y_at_rest", False), ("on_L3_x_at_rest", False),
+    ("on_R3_up", True), ("on_R3_down", True), ("on_R3_left", True), ("on_R3_right", True),
+    ("on_R3_y_at_rest", False), ("on_R3_x_at_rest", False),
+)
+MAX_GAP_US = 0xFFFFFFFF                         #Longer pauses (over an hour) are shortened to this
+
+
+class SessionRecorder:
+
+    def __init__(self, path):
+        self.file = open(path, "wb")            #Buffered, a record is a 7 byte copy on the callback thread
+        self.file.write(MAGIC)
+        self.last = None
+        self.events = 0
+
+    def record(self, index, value=0):
+        now = time.monotonic_ns() // 1000
+        gap = 0 if self.last is None else min(now - self.last, MAX_GAP_US)
+        self.last = now
+        self.file.write(EVENT.pack(gap, index, value))
+        self.events += 1
+
+    def wrap(self, index, method):
+        def recorded(*args):
+            self.record(index, args[0] if args else 0)
+            return method(*args)
+        return recorded
+
+    def attach(self, controller):               #Record every callback the controller is given from now on
+        for index, (name, takes_value) in enumerate(CALLBACKS):
+            method = getattr(controller, name, None)
+            if method is not None:
+                setattr(controller, name, self.wrap(index, method))
+        return self
+
+    def close(self):
+        self.file.close()
+
+
+def read_session(path):                         #[(seconds from start, callback name, args)], as hal.SimController takes them
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a recorded session" % path)
+    events = []
+    offset = 0
+    for gap, index, value in EVENT.iter_unpack(data[len(MAGIC):len(data) - (len(data) - len(MAGIC)) % EVENT.size]):
+        offset += gap
+        name, takes_value = CALLBACKS[index]
+        events.append((offset / 1e6, name, (value,) if takes_value else ()))
+    return events
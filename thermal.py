@@ -0,0 +1,85 @@
+#Cached CPU temperature sampler for the ROUV_Pi
+#Reads the kernel's thermal zone from an open file descriptor on a background thread, instead of forking
+#vcgencmd every time the temperature is needed. current_temp() only ever returns the cached value.
+import glob
+import os
+import threading
+import time
+
+THERMAL_GLOB = "/sys/class/thermal/thermal_zone*/temp"
+
+
+def default_path():                                     #First thermal zone, the CPU on a Pi 4
+    zones = sorted(glob.glob(THERMAL_GLOB))
+    return zones[0] if zones else None
+
+
+class ThermalMonitor:
+
+    def __init__(self, path=None, period=1.0, smoothing=0.3):
+        self.path = path if path is not None else default_path()    #Injectable so a fake file can stand in for sysfs
+        self.period = period                            #Seconds between samples
+        self.smoothing = smoothing                      #Weight of the newest sample in the smoothed value (0~1)
+        self.temp = None                                #Smoothed temperature, deg C
+        self.raw_temp = None                            #Last raw sample, deg C
+        self.trend = 0.0                                #Smoothed rate of change, deg C per second
+        self.samples = 0
+        self.last_sample_time = None
+        self.fd = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def open(self):
+        if self.fd is None and self.path is not None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+
+    def read(self):                                     #One raw reading, in deg C. sysfs reports millidegrees.
+        self.open()
+        return int(os.pread(self.fd, 16, 0)) / 1000.0
+
+    def sample(self):
+        now = time.monotonic()
+        reading = self.read()
+        if self.temp is None:
+            self.temp = reading
+        else:
+            previous = self.temp
+            self.temp += self.smoothing * (reading - self.temp)
+            elapsed = now - self.last_sample_time
+            if elapsed > 0:
+                self.trend += self.smoothing * ((self.temp - previous) / elapsed - self.trend)
+        self.raw_temp = reading
+        self.last_sample_time = now
+        self.samples += 1
+        return self.temp
+
+    def current_temp(self):                             #Never blocks. None until the first sample.
+        return self.temp
+
+    def current_trend(self):
+        return self.trend
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.sample()
+            except (OSError, ValueError) as e:
+                print("Thermal read failed: " + str(e))
+            self.stop_event.wait(self.period)
+
+    def start(self):
+        if self.path is None:
+            print("No thermal zone found, temperature will not be monitored")
+            return self
+        self.sample()                                   #First value is ready before anyone asks for it
+        self.thread = threading.Thread(target=self.run, name="thermal", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
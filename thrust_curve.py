@@ -0,0 +1,114 @@
+#T200 thrust vs PWM calibration for the ROUV_Pi (14.8V)
+#Builds dense lookup tables once at import, so "PWM for N kgf on thruster k" and "kgf for this PWM" are one list index.
+#Thrusters 1 and 4 have reversed propellers: their forward thrust comes from the motor's reverse spin,
+#which is weaker, so they need a larger offset from STOP for the same thrust. The tables apply that automatically.
+#Run this file to check the tables against the measured points, and that they still reproduce the hand-tuned constants.
+import bisect
+
+STOP = 1500
+MIN_DUTY = 1100
+MAX_DUTY = 1900
+RESOLUTION = 0.001                              #kgf per step of the inverse tables
+
+#T200 at 14.8V: (us away from STOP, kgf). Max ~4.53kgf forward spin, ~3.52kgf reverse spin, deadband ~+/-25us.
+#18% DC = 3kgf forward, and the reverse spin needs ~11.5% DC for the same 3kgf.
+#The forward points and the end points of the reverse curve are read off the published T200 chart. The reverse points
+#from 100us to 350us are not measured: they were fitted so matching_pwm() gives the values tuned at the pool (HAND_TUNED).
+FORWARD_CURVE = [(0, 0.0), (25, 0.0), (50, 0.25), (100, 0.80), (150, 1.30), (200, 1.85),
+                 (250, 2.40), (300, 3.00), (350, 3.75), (400, 4.53)]
+REVERSE_CURVE = [(0, 0.0), (25, 0.0), (50, 0.20), (100, 0.668), (150, 1.138), (200, 1.542),
+                 (250, 2.025), (300, 2.568), (350, 2.983), (400, 3.52)]
+
+#T200 at 14.8V: (us away from STOP, amps). Current follows motor speed, so it's about the same either way round.
+CURRENT_CURVE = [(0, 0.0), (25, 0.0), (50, 0.3), (100, 1.5), (150, 3.4), (200, 6.0),
+                 (250, 9.1), (300, 12.6), (350, 16.3), (400, 20.0)]
+
+REVERSED_PROP = (True, False, False, True, False)   #Thrusters 1~5
+
+#Values tuned by hand at the pool, before these tables existed: normal PWM -> PWM on thrusters 1 & 4
+HAND_TUNED = {1600: 1386, 1700: 1268, 1800: 1148, 1400: 1588, 1300: 1672, 1200: 1764, 1586: 1402}
+
+
+#-----------TABLE CONSTRUCTION-----------
+def interpolate(curve, offset):                 #Piecewise linear kgf at an offset (us)
+    offsets = [point[0] for point in curve]
+    i = min(max(bisect.bisect_right(offsets, offset), 1), len(curve) - 1)
+    (x0, y0), (x1, y1) = curve[i - 1], curve[i]
+    return y0 + (y1 - y0) * (offset - x0) / (x1 - x0)
+
+def invert(curve, kgf):                         #Smallest offset (us, fractional) that reaches kgf
+    if kgf <= curve[0][1]:                      #No thrust is STOP, not the edge of the deadband
+        return curve[0][0]
+    for (x0, y0), (x1, y1) in zip(curve, curve[1:]):
+        if y1 >= kgf and y1 > y0:
+            return x0 + (x1 - x0) * max(kgf - y0, 0.0) / (y1 - y0)
+    return curve[-1][0]
+
+def build_inverse(curve):                       #kgf step -> whole us offset
+    steps = int(round(curve[-1][1] / RESOLUTION))
+    return [int(round(invert(curve, step * RESOLUTION))) for step in range(steps + 1)]
+
+#PWM -> signed kgf for a normal thruster (+ is forward spin), indexed by PWM - MIN_DUTY
+THRUST_TABLE = [interpolate(FORWARD_CURVE, pwm - STOP) if pwm >= STOP else -interpolate(REVERSE_CURVE, STOP - pwm)
+                for pwm in range(MIN_DUTY, MAX_DUTY + 1)]
+CURRENT_TABLE = [interpolate(CURRENT_CURVE, abs(pwm - STOP)) for pwm in range(MIN_DUTY, MAX_DUTY + 1)]    #Amps, same indexing
+FORWARD_INVERSE = build_inverse(FORWARD_CURVE)
+REVERSE_INVERSE = build_inverse(REVERSE_CURVE)
+
+
+#-----------LOOKUPS-----------
+#Thrust is in the thruster's own push direction: + is the way a normal thruster pushes above STOP.
+def pwm_for_thrust(kgf, reversed_prop=False):
+    forward_spin = (kgf >= 0) != reversed_prop
+    step = int(round(abs(kgf) / RESOLUTION))
+    if forward_spin:
+        return STOP + FORWARD_INVERSE[min(step, len(FORWARD_INVERSE) - 1)]
+    return STOP - REVERSE_INVERSE[min(step, len(REVERSE_INVERSE) - 1)]
+
+def thrust_for_pwm(pwm, reversed_prop=False):
+    kgf = THRUST_TABLE[min(max(int(pwm), MIN_DUTY), MAX_DUTY) - MIN_DUTY]
+    return -kgf if reversed_prop else kgf
+
+def current_for_pwm(pwm):                       #Amps one thruster draws at this PWM, 0 when powered off
+    if not pwm:
+        return 0.0
+    return CURRENT_TABLE[min(max(int(pwm), MIN_DUTY), MAX_DUTY) - MIN_DUTY]
+
+def pwm_for_thruster(kgf, thruster):            #thruster is 1~5
+    return pwm_for_thrust(kgf, REVERSED_PROP[thruster - 1])
+
+def matching_pwm(pwm):                          #PWM on thrusters 1 & 4 that gives the same thrust as pwm on the others
+    return pwm_for_thrust(thrust_for_pwm(pwm), reversed_prop=True)
+
+
+def check_measured_points():                    #Independent of the fitted points: the tables against the published ones
+    failures = []
+    for offset, kgf in FORWARD_CURVE[2:]:       #Past the deadband, PWM -> kgf -> PWM comes back to the same point
+        if thrust_for_pwm(STOP + offset) != kgf or pwm_for_thrust(kgf) != STOP + offset:
+            failures.append("forward %+dus %.3fkgf" % (offset, kgf))
+    for offset, kgf in (REVERSE_CURVE[2], REVERSE_CURVE[-1]):   #Measured reverse points, on both kinds of thruster
+        if thrust_for_pwm(STOP - offset) != -kgf or pwm_for_thrust(-kgf) != STOP - offset:
+            failures.append("reverse %+dus %.3fkgf" % (-offset, kgf))
+        if thrust_for_pwm(STOP - offset, reversed_prop=True) != kgf or pwm_for_thrust(kgf, reversed_prop=True) != STOP - offset:
+            failures.append("reversed prop %+dus %.3fkgf" % (-offset, kgf))
+    if thrust_for_pwm(MAX_DUTY, reversed_prop=True) != -FORWARD_CURVE[-1][1]:     #Full forward spin pushes a reversed prop back
+        failures.append("reversed prop at %d" % MAX_DUTY)
+    if matching_pwm(STOP) != STOP:
+        failures.append("STOP")
+    if any(b < a for a, b in zip(THRUST_TABLE, THRUST_TABLE[1:])):
+        failures.append("thrust table not monotonic")
+    print("Measured points: " + (", ".join(failures) + " wrong" if failures else "all reproduced"))
+    return not failures
+
+def check_against_hand_tuned(tolerance=5):    #Regression lock on the fit: the reverse points were fitted to these values
+    worst = 0
+    for pwm, tuned in sorted(HAND_TUNED.items()):
+        generated = matching_pwm(pwm)
+        worst = max(worst, abs(generated - tuned))
+        print("%d -> %d (hand-tuned %d, %+d)" % (pwm, generated, tuned, generated - tuned))
+    print("Worst difference: " + str(worst) + "us")
+    return worst <= tolerance
+
+if __name__ == "__main__":
+    measured = check_measured_points()
+    raise SystemExit(0 if check_against_hand_tuned() and measured else 1)
@@ -0,0 +1,235 @@
+#UDP transport between the BUOY_Pi and ROUV_Pi, an alternative to the TCP stream on the same port (42069)
+#Over TCP one lost segment holds back every later frame until it is retransmitted, so a stale command can arrive
+#after the pilot has moved on. Over UDP every frame travels on its own and the ROUV applies only the newest frame
+#per input channel (see protocol.CHANNELS). Datagrams carry the same length-prefixed frames as the TCP stream.
+#State frames (stick levels, button press/release) are repeated a couple of times, newest only, to cover loss.
+#Toggles and the emergency stop (protocol.RELIABLE_OPCODES) are acked by the ROUV and retried until they are.
+import collections
+import threading
+import time
+import protocol
+
+MAX_DATAGRAM = 65535
+
+
+def split_frames(data):                         #Every complete frame in a datagram, without the length prefix
+    view = memoryview(data)
+    start = 0
+    while len(view) - start >= 2:
+        begin = start + 2
+        start = begin + (view[start] | (view[start + 1] << 8))
+        if start > len(view):                   #Truncated, not worth keeping
+            return
+        yield view[begin:start]
+
+
+#-----------BUOY SIDE-----------
+class UdpSender:                                #Same interface as sender.FrameSender, so the controller can use either
+
+    def __init__(self, sock, capacity=256, retry_interval=0.02, max_retries=25, state_repeats=2):
+        self.sock = sock                        #Connected UDP socket
+        self.capacity = capacity                #Most reliable frames waiting for an ack
+        self.retry_interval = retry_interval    #Seconds between copies of a frame
+        self.max_retries = max_retries          #Reliable frames are given up after this many copies (0.5s)
+        self.state_repeats = state_repeats      #Extra copies of each state frame, newest per channel only
+        self.cond = threading.Condition()
+        self.unacked = collections.OrderedDict()    #seq -> [frame, next copy due, copies left, first sent]
+        self.repeats = {}                           #channel -> [frame, next copy due, copies left, first sent]
+        self.running = False
+        self.thread = None
+        self.error = None                       #Last send error (the ROUV not listening yet shows up here)
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.sendmsg_calls = 0                  #Datagrams sent, copies included
+        self.retries = 0                        #Copies of reliable frames
+        self.acked = 0
+        self.dropped = 0                        #Reliable frames given up on, or pushed out by a full queue
+        self.last_wait = 0.0                    #Nothing waits to be sent, kept for FrameSender's metrics
+
+    def transmit(self, frame):
+        try:
+            self.sock.send(frame)
+        except OSError as e:                    #ECONNREFUSED from an earlier datagram, or a full socket buffer
+            self.error = e
+            return
+        self.sendmsg_calls += 1
+        self.sent_bytes += len(frame)
+
+    def enqueue(self, frame):                   #Sent straight away, never blocks
+        if not frame:
+            return
+        self.transmit(frame)
+        self.sent_frames += 1
+        if frame[2] != protocol.PROTOCOL_MAGIC:     #Text frame, nothing to track
+            return
+        opcode, seq = protocol.frame_opcode_seq(frame)
+        now = time.monotonic()
+        with self.cond:
+            if opcode in protocol.RELIABLE_OPCODES:
+                if len(self.unacked) >= self.capacity:
+                    self.unacked.popitem(last=False)
+                    self.dropped += 1
+                self.unacked[seq] = [frame, now + self.retry_interval, self.max_retries, now]
+            elif opcode in protocol.CHANNELS and self.state_repeats:
+                self.repeats[protocol.CHANNELS[opcode]] = [frame, now + self.retry_interval, self.state_repeats, now]    #Latest wins
+            else:
+                return
+            self.cond.notify()
+
+    def on_ack(self, seq):
+        with self.cond:
+            if self.unacked.pop(seq, None) is not None:
+                self.acked += 1
+
+    def depth(self):                            #Frames still waiting for an ack or a repeat
+        return len(self.unacked) + len(self.repeats)
+
+    def oldest_wait(self):                      #Seconds the oldest unacked frame has been waiting
+        with self.cond:
+            if not self.unacked:
+                return 0.0
+            return time.monotonic() - next(iter(self.unacked.values()))[3]
+
+    def resend_due(self, now):                  #Returns seconds until the next copy is due, None if nothing is waiting
+        with self.cond:
+            due = []
+            next_due = None
+            for table in (self.unacked, self.repeats):
+                for key, entry in list(table.items()):
+                    if entry[1] <= now:
+                        if entry[2] == 0:
+                            del table[key]
+                            if table is self.unacked:
+                                self.dropped += 1
+                            continue
+                        due.append(entry[0])
+                        entry[1] = now + self.retry_interval
+                        entry[2] -= 1
+                        if table is self.unacked:
+                            self.retries += 1
+                    next_due = entry[1] if next_due is None else min(next_due, entry[1])
+        for frame in due:
+            self.transmit(frame)
+        return None if next_due is None else max(0.0, next_due - now)
+
+    def run(self):
+        while self.running:
+            wait = self.resend_due(time.monotonic())
+            with self.cond:
+                if self.running:
+                    self.cond.wait(wait)
+
+    def recv_frames(self):                      #Blocks for one datagram. Acks are handled here, other frames returned.
+        data = self.sock.recv(MAX_DATAGRAM)
+        frames = []
+        for msg in split_frames(data):
+            if len(msg) >= protocol.HEADER.size + protocol.ACK.size and msg[0] == protocol.PROTOCOL_MAGIC and msg[2] == protocol.OP_ACK:
+                self.on_ack(protocol.ACK.unpack_from(msg, protocol.HEADER.size)[0])
+            else:
+                frames.append(msg)
+        return frames
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="udp-sender", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):                             #Unacked frames are not waited for
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+
+#-----------ROUV SIDE-----------
+class UdpReceiver:                              #Filters datagrams down to the frames that should be applied
+
+    def __init__(self, sock, reliable_window=256):
+        self.sock = sock                        #Bound UDP socket
+        self.peer = None                        #BUOY address, learned from its datagrams
+        self.newest = {}                        #channel -> newest seq applied, unwrapped (see unwrap())
+        self.last_seq = None                    #Newest 16 bit seq from the BUOY on any channel
+        self.extended = 0                       #The same, counted past the wrap
+        self.reliable_window = reliable_window
+        self.reliable_seen = collections.OrderedDict()      #Recent reliable seqs, to apply retries only once
+        self.datagrams = 0
+        self.stale = 0                          #State frames dropped because a newer one was already applied
+        self.duplicates = 0                     #Reliable frames received again (lost ack)
+        self.acks_sent = 0
+
+    def reset(self, peer):                      #A new BUOY (or a restarted one) starts its sequence numbers again
+        self.peer = peer
+        self.newest.clear()
+        self.last_seq = None
+        self.reliable_seen.clear()
+
+    def send(self, frame):                      #To the BUOY, dropped if it hasn't been heard from yet
+        if self.peer is None:
+            return
+        try:
+            self.sock.sendto(frame, self.peer)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def unwrap(self, seq):                      #16 bit seq -> running count. Every frame moves it on, heartbeats included, so
+        if self.last_seq is None:               #a channel quiet for more than half the 16 bit range still compares right.
+            self.last_seq = seq
+            self.extended = seq
+            return seq
+        gap = (seq - self.last_seq) & protocol.SEQ_MASK
+        extended = self.extended + (gap if gap < 0x8000 else gap - 0x10000)
+        if extended > self.extended:            #Late frames don't move it back
+            self.last_seq = seq
+            self.extended = extended
+        return extended
+
+    def accept(self, msg):                      #True if the frame should be applied
+        if len(msg) < protocol.HEADER.size or msg[0] != protocol.PROTOCOL_MAGIC:
+            return True                         #Text frames have no sequence number
+        opcode = msg[2]
+        seq = msg[4] | (msg[5] << 8)
+        extended = self.unwrap(seq)
+        if opcode in protocol.RELIABLE_OPCODES:
+            self.send(protocol.encode_frame(protocol.OP_ACK, payload=protocol.ACK.pack(seq)))
+            self.acks_sent += 1
+            if seq in self.reliable_seen:
+                self.duplicates += 1
+                return False
+            self.reliable_seen[seq] = True
+            if len(self.reliable_seen) > self.reliable_window:
+                self.reliable_seen.popitem(last=False)
+            return True
+        channel = protocol.CHANNELS.get(opcode)
+        if channel is None:
+            return True
+        newest = self.newest.get(channel)
+        if newest is not None and extended <= newest:
+            self.stale += 1
+            return False
+        self.newest[channel] = extended
+        return True
+
+    def accept_datagram(self, data, addr):      #Frames from one datagram that should be applied
+        self.datagrams += 1
+        if addr != self.peer:
+            self.reset(addr)
+        return [msg for msg in split_frames(data) if self.accept(msg)]
+
+    def recv_frames(self):                      #Blocking socket: one datagram
+        data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+        return self.accept_datagram(data, addr)
+
+    async def recv_frames_async(self, loop):    #Non-blocking socket: waits for one datagram, then takes whatever else has arrived
+        data, addr = await loop.sock_recvfrom(self.sock, MAX_DATAGRAM)
+        frames = self.accept_datagram(data, addr)
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return frames
+            frames += self.accept_datagram(data, addr)
+
+    def pending(self):                          #Nothing is buffered between datagrams, kept for FrameReader's metrics
+        return 0
@@ -0,0 +1,89 @@
+#Simulated ROUV in the water, for tuning the hold loop (autopilot.py) off the Pi
+#Reads the five thruster duties from a hal.SimBackend, turns them into thrust with the T200 tables (thrust_curve.py)
+#and integrates depth, heading and pitch. read() returns what an IMU and depth sensor would, noise included.
+#Rough numbers for a ~12kg box: slightly heavy in water (the open-loop hover duties held it up), nose-heavy trim, and
+#a weak current turning it. Good enough to get the gains in the right place before a pool test, not to replace one.
+import math
+import random
+import time
+import mixer
+import thrust_curve
+
+GRAVITY = 9.81
+NET_WEIGHT = 2.2                                #kgf, weight minus buoyancy
+HEAVE_MASS = 20.0                               #kg, added mass included
+HEAVE_DRAG = 60.0                               #N per (m/s)^2
+YAW_ARM = 0.15                                  #m, yaw thrust lever arm
+YAW_INERTIA = 0.4                               #kg m^2
+YAW_DRAG = 1.5                                  #N m per (rad/s)^2
+PITCH_ARM = 0.12                                #m
+PITCH_INERTIA = 0.5
+PITCH_DRAG = 1.5
+RIGHTING_MOMENT = 3.0                           #N m at 90 deg, centre of buoyancy above centre of gravity
+TRIM_MOMENT = -0.3                              #N m, nose down
+CURRENT_TORQUE = 0.05                           #N m, turns it right
+THRUSTER_LAG = 0.1                              #s, ESC + propeller spin-up time constant
+COLUMNS = mixer.ALLOCATION.T.tolist()           #Motion -> share of each thruster's push, as plain lists for speed
+MAX_STEP = 0.001                                #s, integration step
+DEPTH_NOISE = 0.003                             #m, standard deviation of each sensor reading
+ANGLE_NOISE = 0.2                               #deg
+GYRO_NOISE = 0.5                                #deg/s
+
+
+class SimVehicle:
+
+    def __init__(self, backend, pins, depth=1.0, heading=0.0, pitch=0.0, clock=time.monotonic, seed=0):
+        self.backend = backend                  #Duties come from backend.duty
+        self.pins = pins                        #Thruster pins, in mixer order
+        self.depth = depth                      #m, + down
+        self.heave_speed = 0.0                  #m/s, + up
+        self.heading = math.radians(heading)
+        self.yaw_rate = 0.0                     #rad/s, + right
+        self.pitch = math.radians(pitch)        #+ nose up
+        self.pitch_rate = 0.0
+        self.thrust = [0.0] * len(pins)         #kgf each thruster is actually giving, in its push direction
+        self.clock = clock                      #Pass a fake clock to run faster than real time
+        self.last_time = clock()
+        self.rng = random.Random(seed)
+
+    def commanded_thrust(self):                 #kgf in each thruster's push direction, the same one mixer.ALLOCATION uses
+        return [thrust_curve.thrust_for_pwm(self.backend.duty.get(pin) or mixer.STOP, reversed_prop)    #Duty 0 is powered off
+                for pin, reversed_prop in zip(self.pins, thrust_curve.REVERSED_PROP)]
+
+    def force(self, motion):                    #N along one motion (N m once times its arm)
+        return sum(share * thrust for share, thrust in zip(COLUMNS[motion], self.thrust)) * GRAVITY
+
+    def step(self, dt, commanded):
+        self.thrust = [actual + (target - actual) * min(1.0, dt / THRUSTER_LAG) for actual, target in zip(self.thrust, commanded)]
+        heave = self.force(mixer.HEAVE) - NET_WEIGHT * GRAVITY - HEAVE_DRAG * self.heave_speed * abs(self.heave_speed)
+        self.heave_speed += heave / HEAVE_MASS * dt
+        self.depth -= self.heave_speed * dt
+        if self.depth < 0.0:                    #Surfaced, can't go any higher
+            self.depth = 0.0
+            self.heave_speed = min(self.heave_speed, 0.0)
+        yaw = self.force(mixer.YAW) * YAW_ARM + CURRENT_TORQUE - YAW_DRAG * self.yaw_rate * abs(self.yaw_rate)
+        self.yaw_rate += yaw / YAW_INERTIA * dt
+        self.heading += self.yaw_rate * dt
+        pitch = (self.force(mixer.PITCH) * PITCH_ARM + TRIM_MOMENT - RIGHTING_MOMENT * math.sin(self.pitch)
+                 - PITCH_DRAG * self.pitch_rate * abs(self.pitch_rate))
+        self.pitch_rate += pitch / PITCH_INERTIA * dt
+        self.pitch += self.pitch_rate * dt
+
+    def advance(self):                          #Integrate up to now
+        now = self.clock()
+        elapsed = now - self.last_time
+        self.last_time = now
+        commanded = self.commanded_thrust()     #Taken as held since the last read
+        while elapsed > 0:
+            dt = min(elapsed, MAX_STEP)
+            self.step(dt, commanded)
+            elapsed -= dt
+
+    def read(self):                             #(depth m, heading deg 0~360, pitch deg, yaw rate deg/s, pitch rate deg/s)
+        self.advance()
+        noise = self.rng.gauss
+        return (max(0.0, self.depth + noise(0, DEPTH_NOISE)),
+                (math.degrees(self.heading) + noise(0, ANGLE_NOISE)) % 360.0,
+                math.degrees(self.pitch) + noise(0, ANGLE_NOISE),
+                math.degrees(self.yaw_rate) + noise(0, GYRO_NOISE),
+                math.degrees(self.pitch_rate) + noise(0, GYRO_NOISE))